@@ -1,11 +1,12 @@
 from datetime import datetime
-from typing import Iterator
+from typing import Iterator, Optional
 
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Query
 from fastapi.responses import StreamingResponse
 
-from ...models.schemas import ComposicionRequest
-from ...services.composicion.runner import stream_sse_logs
+from ...models.schemas import ComposicionRequest, PendientesResponse, ReprocesoPendientesRequest
+from ...services.composicion import logsink, pendientes
+from ...services.composicion.runner import ensure_logs_dir, logs_activos, stream_sse_logs, stream_sse_reproceso
 
 router = APIRouter(tags=["composicion"])
 
@@ -28,8 +29,12 @@ def run_composicion(payload: ComposicionRequest):
     def _event_stream() -> Iterator[str]:
         yield from stream_sse_logs(payload.fecha_desde, payload.fecha_hasta)
 
+    return _sse_response(_event_stream())
+
+
+def _sse_response(events: Iterator[str]) -> StreamingResponse:
     return StreamingResponse(
-        _event_stream(),
+        events,
         media_type="text/event-stream",
         headers={
             "Cache-Control": "no-cache",
@@ -37,3 +42,47 @@ def run_composicion(payload: ComposicionRequest):
             "X-Accel-Buffering": "no",
         },
     )
+
+
+@router.get("/composicion/pendientes", response_model=PendientesResponse,
+            summary="Backlog de transformaciones sin composición de origen (paginado)")
+def listar_pendientes(
+    page: int = Query(default=1, ge=1),
+    page_size: int = Query(default=100, ge=1, le=1000),
+    c_lote_origen: Optional[int] = Query(default=None, description="Sólo las pendientes de este lote origen"),
+):
+    try:
+        data = pendientes.listar(page, page_size, c_lote_origen)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"DB_ERROR: {e}")
+    if data is None:
+        raise HTTPException(status_code=501, detail=f"La tabla {pendientes.PENDIENTES_TABLE} no existe todavía.")
+    return data
+
+
+@router.post("/composicion/pendientes/reprocesar", summary="Reintentar el backlog de transformaciones (SSE)")
+def reprocesar_pendientes(payload: ReprocesoPendientesRequest):
+    # Sólo el backlog (y sus dependientes) contra la composición actual; no re-corre el período
+    return _sse_response(stream_sse_reproceso(payload.lotes_origen or None))
+
+
+@router.get("/composicion/logs", summary="Corridas con log guardado (más recientes primero)")
+def listar_logs(limit: int = Query(default=50, ge=1, le=500)):
+    return {"items": logsink.listar_logs(ensure_logs_dir(), logs_activos(), limit)}
+
+
+@router.get("/composicion/logs/{run}", summary="Log de una corrida por rango de bytes (tail incremental)")
+def leer_log(
+    run: str,
+    offset: int = Query(default=0, description="Byte desde el que leer; negativo = los últimos |offset| bytes"),
+    limit: int = Query(default=65536, ge=1, le=4 * 1024 * 1024, description="Bytes máximos a devolver"),
+):
+    """
+    Devuelve `text` con líneas completas y `next_offset` para la próxima lectura. Mientras la
+    corrida está `activo`, pedir desde `next_offset` trae sólo las líneas nuevas; con `eof` y sin
+    `activo` el log está completo.
+    """
+    data = logsink.leer_log(ensure_logs_dir(), run, offset, limit, logs_activos())
+    if data is None:
+        raise HTTPException(status_code=404, detail=f"No hay log para la corrida '{run}'.")
+    return data
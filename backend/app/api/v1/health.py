@@ -3,6 +3,7 @@ from typing import List, Union
 
 from fastapi import APIRouter, Response, status
 from .. import v1  # noqa: F401  # asegura paquete
+from ...core.config import settings
 from ...models.schemas import HealthResponse, DeepHealthResponse, ErrorItem
 from ...services import db
 
@@ -27,7 +28,7 @@ def health(response: Response, deep: bool = False) -> Union[HealthResponse, Deep
 
     # Readiness
     errors: List[ErrorItem] = []
-    oracle_ok, oracle_err = db.check_oracle_ready(timeout_seconds=3)
+    oracle_ok, oracle_err = db.check_oracle_ready(timeout_seconds=settings.health_oracle_timeout)
 
     if not oracle_ok:
         errors.append(ErrorItem(code="ORACLE_DOWN", message=oracle_err or "Oracle no disponible"))
@@ -40,6 +41,7 @@ def health(response: Response, deep: bool = False) -> Union[HealthResponse, Deep
             version="0.1.0",
             dependencies={"oracle": "down"},
             errors=errors,
+            pool=db.pool_stats() or None,
         )
 
     return DeepHealthResponse(
@@ -48,4 +50,5 @@ def health(response: Response, deep: bool = False) -> Union[HealthResponse, Deep
         version="0.1.0",
         dependencies={"oracle": "ok"},
         errors=[],
+        pool=db.pool_stats() or None,
     )
@@ -1,258 +1,212 @@
-from fastapi import APIRouter, Query, HTTPException
-from fastapi.responses import JSONResponse
-from typing import List, Optional, Dict, Any, Set, Tuple
-from sqlalchemy import text
+from fastapi import APIRouter, Query, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+from datetime import date, datetime
+from typing import Optional, Dict, Any, Iterator
+import hashlib
 
-from ...services import db as db_service
 from ...core.config import settings
-from ...utils.rows import normalize_list_upper, normalize_keys_upper
-from ...utils.convert import to_float, to_int, to_iso
+from ...models.schemas import TraceBatchRequest
+from ...services.trazabilidad import grafo as grafo_lotes, refdata
+from ...services.trazabilidad.service import TraceError, get_trace_service
+from ...utils.columnar import encode_columnar
+from ...utils.jsonfast import FastJSONResponse, dumps_str
 
-router = APIRouter(tags=["Trazabilidad"])
+router = APIRouter(tags=["Trazabilidad"], default_response_class=FastJSONResponse)
 
-TIPO_MAP: Dict[int, str] = {
-    13: "Compra",
-    28: "Descube",
-    31: "Ajuste",
-    95: "Ajuste",
-    43: "Transformación",
-    30: "Transformación",
-    46: "Transformación",
-}
+# Columnas con valores repetidos que se envían como diccionario en format=columnar
+ORIGENES_DICT_COLS = ("tipo", "tk_origen", "tk_destino", "c_lote", "parent_id")
+TIMELINE_DICT_COLS = ("tipo", "tk_origen", "tk_destino")
 
-def _tq(table_name: str) -> str:
-    schema = getattr(settings, "db_schema", None) or settings.__dict__.get("db_schema")
-    return f"{schema}.{table_name}" if schema else table_name
 
-def _tipo_legible(c_tipo: Optional[int]) -> str:
+def _print_traceback() -> None:
     try:
-        return TIPO_MAP.get(int(c_tipo)) if c_tipo is not None else "Movimiento"
+        import traceback
+        print("\n[TRAZA][ERROR] >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>")
+        print(traceback.format_exc())
+        print("[TRAZA][ERROR] <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<\n")
     except Exception:
-        return "Movimiento"
+        pass
 
-def _table_exists(conn, name: str) -> bool:
-    try:
-        conn.execute(text(f"SELECT 1 FROM {_tq(name)} WHERE 1=0"))
-        return True
-    except Exception:
-        return False
+def _http_error(e: Exception) -> HTTPException:
+    """TraceError -> su status; cualquier otra excepción -> 500 DB_ERROR."""
+    if isinstance(e, TraceError):
+        return HTTPException(status_code=e.status_code, detail=str(e))
+    _print_traceback()
+    return HTTPException(status_code=500, detail=f"DB_ERROR: {e}")
 
-# ---------- repos ----------
-def _fetch_lote_info(conn, c_lote_num: int) -> Dict[str, Any]:
-    if not _table_exists(conn, "LOTES_STOCK"):
-        return {"C_LOTE": str(c_lote_num), "D_LOTE": None}
-    sql = text(f"""
-        SELECT C_LOTE, D_LOTE
-        FROM {_tq("LOTES_STOCK")}
-        WHERE C_LOTE = :c_lote
-    """)
-    row = conn.execute(sql, {"c_lote": c_lote_num}).mappings().fetchone()
-    if not row:
-        return {"C_LOTE": str(c_lote_num), "D_LOTE": None}
-    d = normalize_keys_upper(row)
-    d["C_LOTE"] = str(d.get("C_LOTE")) if d.get("C_LOTE") is not None else None
-    return d
+def _ndjson(obj: Dict[str, Any]) -> str:
+    return dumps_str(obj) + "\n"
 
-def _fetch_movs_for_dest(conn, c_lote_num: int) -> List[Dict[str, Any]]:
+def _stream_ndjson(records: Iterator[Dict[str, Any]]) -> Iterator[str]:
     """
-    Movimientos donde el lote aparece como DESTINO → orígenes directos.
-    Volumen: CANTIDAD (NUMBER(15,5))
+    Traza en NDJSON: identificación, luego un registro por nivel a medida que se descubre,
+    y al final KPIs/balance (y destinos). Un error a mitad de camino se informa como último registro.
     """
-    sql = text(f"""
-        SELECT
-            C_TIPO_COMPRO,
-            F_MOVIMIENTO,
-            MOS_ID,
-            C_DORIGEN, D_DORIGEN,
-            C_DDESTINO, D_DDESTINO,
-            C_LOTE_ORIGEN,
-            CANTIDAD AS VOL
-        FROM {_tq("APX_TRAZA_DETALLE")}
-        WHERE C_LOTE = :c_lote
-        ORDER BY F_MOVIMIENTO ASC, MOS_ID ASC
-    """)
-    rows = conn.execute(sql, {"c_lote": c_lote_num}).mappings().all()
-    rows = normalize_list_upper(rows)  # ← claves en MAYÚSCULAS
-    for d in rows:
-        d["VOL"] = to_float(d.get("VOL"))
-    return rows
-
-def _sum_destinos_finales(conn, c_lote_num: int) -> float:
-    if not _table_exists(conn, "APX_TRAZA_DESTINO_FINAL"):
-        return 0.0
-    sql = text(f"""
-        SELECT COALESCE(SUM(CANTIDAD_USADA), 0)
-        FROM {_tq("APX_TRAZA_DESTINO_FINAL")}
-        WHERE C_LOTE = :c_lote
-    """)
-    val = conn.execute(sql, {"c_lote": c_lote_num}).scalar()
-    return to_float(val)
-
-def _build_tree(conn, root_lote_num: int, max_depth: int) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
-    nodes: List[Dict[str, Any]] = []
-    timeline: List[Dict[str, Any]] = []
-
-    root_node_id = f"ROOT-{root_lote_num}"
-    nodes.append({
-        "node_id": root_node_id,
-        "parent_id": None,
-        "nivel": 0,
-        "tipo": "Lote",
-        "fecha": None,
-        "ot": None,
-        "tk_origen": None,
-        "tk_destino": None,
-        "lts_in": None,
-        "lts_out": None,
-        "merma_lts": None,
-        "borra_lts": None,
-        "otros_uso_lts": None,
-        "contrib_pct": None,
-        "guia": None,
-        "fel": None,
-        "observacion": None,
-        "c_lote": str(root_lote_num),
-        "c_lote_origen": None,
-    })
-
-    queue: List[Tuple[int, str, int]] = [(root_lote_num, root_node_id, 0)]
-    visited: Set[int] = set([root_lote_num])
-
-    while queue:
-        current_lote, parent, level = queue.pop(0)
-        if level >= max_depth:
-            continue
-
-        movs = _fetch_movs_for_dest(conn, current_lote)
-        if not movs:
-            continue
-
-        total_lvl = sum(to_float(m.get("VOL")) for m in movs) or 0.0
-
-        for idx, m in enumerate(movs, start=1):
-            origen_int = to_int(m.get("C_LOTE_ORIGEN"))
-            cantidad = to_float(m.get("VOL"))
-            contrib = (cantidad / total_lvl * 100.0) if total_lvl > 0 else None
+    try:
+        for rec in records:
+            yield _ndjson(rec)
+    except Exception as e:
+        _print_traceback()
+        yield _ndjson({"tipo": "error", "detail": f"DB_ERROR: {e}"})
 
-            nodo_id = f"{level+1}-{current_lote}-{m.get('MOS_ID')}-{idx}"
-            node = {
-                "node_id": nodo_id,
-                "parent_id": parent,
-                "nivel": level + 1,
-                "tipo": _tipo_legible(m.get("C_TIPO_COMPRO")),
-                "fecha": to_iso(m.get("F_MOVIMIENTO")),
-                "ot": m.get("MOS_ID"),
-                "tk_origen": m.get("D_DORIGEN") or m.get("C_DORIGEN"),
-                "tk_destino": m.get("D_DDESTINO") or m.get("C_DDESTINO"),
-                "lts_in": cantidad,
-                "lts_out": cantidad,
-                "merma_lts": None,
-                "borra_lts": None,
-                "otros_uso_lts": None,
-                "contrib_pct": contrib,
-                "guia": None,
-                "fel": None,
-                "observacion": None,
-                "c_lote": str(current_lote),
-                "c_lote_origen": str(origen_int) if origen_int is not None else None,
-            }
-            nodes.append(node)
+def _wants_ndjson(request: Request, stream: bool) -> bool:
+    return stream or "application/x-ndjson" in (request.headers.get("accept") or "").lower()
 
-            timeline.append({
-                "fecha": node["fecha"],
-                "evento": node["tipo"],
-                "detalle": f"OT {node['ot']}" if node["ot"] else "",
-                "tk_origen": node["tk_origen"],
-                "tk_destino": node["tk_destino"],
-                "cantidad": cantidad,
-            })
+# ---------- GET condicional (ETag / If-None-Match) ----------
+def _generacion() -> Optional[str]:
+    """
+    Versión de los datos que lee la traza: la generación que deja cada corrida de composición
+    (releída cada TRACE_GENERACION_CHECK_SECONDS) y la versión del grafo de lotes si hay uno.
+    None = no se sabe (sin ETag).
+    """
+    if settings.trace_mode != "real":
+        return "fake"
+    gen = refdata.generacion()
+    if gen is None:
+        return None
+    g = grafo_lotes.get()
+    return f"g{gen}-{g.version}" if g is not None else f"g{gen}"
+
+def _etag(request: Request, *extra: Any) -> Optional[str]:
+    gen = _generacion()
+    if gen is None:
+        return None
+    params = sorted(f"{k}={v}" for k, v in request.query_params.multi_items())
+    clave = "|".join([gen, request.url.path, *params, *map(str, extra)])
+    return f'W/"{hashlib.sha1(clave.encode("utf-8")).hexdigest()[:24]}"'
+
+def _no_modificado(request: Request, etag: Optional[str]) -> bool:
+    pedido = request.headers.get("if-none-match")
+    if not etag or not pedido:
+        return False
+    if pedido.strip() == "*":
+        return True
+    return etag.removeprefix("W/") in {v.strip().removeprefix("W/") for v in pedido.split(",")}
 
-            if origen_int is not None and origen_int not in visited:
-                visited.add(origen_int)
-                queue.append((origen_int, nodo_id, level + 1))
+def _cache_headers(etag: Optional[str]) -> Dict[str, str]:
+    # no-cache: el cliente puede guardar la respuesta pero la revalida siempre con If-None-Match
+    return {"ETag": etag, "Cache-Control": "no-cache"} if etag else {}
 
-    timeline = sorted([t for t in timeline if t.get("fecha")], key=lambda x: x["fecha"])
-    return nodes, timeline
+def _not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers=_cache_headers(etag))
 
 # ---------- endpoint ----------
 @router.get("/lote/{c_lote}")
 def trazabilidad_lote(
+    request: Request,
     c_lote: str,
     include: Optional[str] = Query(default="timeline", description="Campos opcionales separados por coma: 'timeline,destinos'"),
     max_depth: int = Query(default=5, ge=1, le=20),
     tolerance: float = Query(default=0.005, ge=0.0, le=0.05),
+    destinos_alcance: str = Query(default="raiz", pattern="^(raiz|arbol)$", description="Destinos del lote raíz o de todos los lotes del árbol"),
+    stream: bool = Query(default=False, description="Respuesta NDJSON por niveles (equivale a Accept: application/x-ndjson)"),
+    formato: str = Query(default="json", alias="format", pattern="^(json|columnar)$", description="columnar: origenes/timeline como columnas con esquema compartido"),
+    as_of: Optional[date] = Query(default=None, description="Traza a una fecha (YYYY-MM-DD): sólo movimientos hasta ese día, en orden cronológico"),
 ):
-    include_set = set((include or "").lower().split(",")) if include else set()
-
-    c_lote_num = to_int(c_lote)
-    if c_lote_num is None:
-        raise HTTPException(status_code=422, detail="c_lote debe ser numérico (NUMBER).")
+    include_list = [s.strip() for s in (include or "").lower().split(",") if s.strip()]
+    ndjson = _wants_ndjson(request, stream)
+    etag = _etag(request, ndjson)
+    if _no_modificado(request, etag):
+        return _not_modified(etag)
+    svc = get_trace_service()
 
     try:
-        engine = db_service.get_engine()
-        with engine.connect() as conn:
-            if not _table_exists(conn, "APX_TRAZA_DETALLE"):
-                raise HTTPException(status_code=501, detail=f"No existe la tabla {_tq('APX_TRAZA_DETALLE')}.")
+        if ndjson:
+            records = svc.iter_trace_by_lote(c_lote, max_depth, include_list, tolerance, destinos_alcance, as_of)
+            return StreamingResponse(
+                _stream_ndjson(records),
+                media_type="application/x-ndjson",
+                headers={**_cache_headers(etag), "Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+            )
+
+        trace = svc.trace_by_lote(c_lote, max_depth, include_list, tolerance, destinos_alcance, as_of)
+    except Exception as e:
+        raise _http_error(e)
+
+    resp = trace.model_dump()
+    if formato == "columnar":
+        resp["origenes"] = encode_columnar(resp["origenes"], dict_cols=ORIGENES_DICT_COLS)
+        resp["timeline"] = encode_columnar(resp["timeline"] or [], dict_cols=TIMELINE_DICT_COLS)
+    return FastJSONResponse(resp, headers=_cache_headers(etag))
+
 
-            info = _fetch_lote_info(conn, c_lote_num)
+@router.get("/lote/{c_lote}/composicion")
+def composicion_lote(
+    request: Request,
+    c_lote: str,
+    as_of: Optional[date] = Query(default=None, description="Composición a una fecha (YYYY-MM-DD) en lugar de la vigente"),
+):
+    """
+    Composición resumida del lote (variedad / período / subvalle) leída de
+    APX_TRAZA_COMPOSICION_RESUMEN, que genera cada corrida de composición.
+    Con `as_of`, la composición a ese día se propaga en orden cronológico desde APX_TRAZA_DETALLE:
+    cada aporte de otro lote se reparte según lo que ese lote contenía cuando aportó.
+    """
+    etag = _etag(request)
+    if _no_modificado(request, etag):
+        return _not_modified(etag)
+    try:
+        return FastJSONResponse(get_trace_service().composicion_by_lote(c_lote, as_of).model_dump(), headers=_cache_headers(etag))
+    except Exception as e:
+        raise _http_error(e)
 
-            movs_lvl1 = _fetch_movs_for_dest(conn, c_lote_num)
-            total_in_lvl1 = sum(to_float(m.get("VOL")) for m in movs_lvl1) if movs_lvl1 else 0.0
 
-            total_dest_final = _sum_destinos_finales(conn, c_lote_num)
+@router.get("/lote/{c_lote}/children")
+def hijos_lote(
+    request: Request,
+    c_lote: str,
+    node: Optional[str] = Query(default=None, description="Lote a expandir (c_lote_origen del nodo); vacío = el lote raíz"),
+    nivel: int = Query(default=0, ge=0, description="Nivel del nodo que se expande (0 = raíz)"),
+    as_of: Optional[date] = Query(default=None, description="Traza a una fecha (YYYY-MM-DD), como en /lote/{c_lote}"),
+    hasta: Optional[datetime] = Query(default=None, description="Cota cronológica del nodo (campo `hasta` que devolvió el nivel anterior)"),
+):
+    """
+    Un nivel del árbol de orígenes para expandirlo bajo demanda: los hijos directos de `node`
+    con `n_children` (cuántos orígenes tiene cada uno). No recorre el resto del árbol.
+    """
+    etag = _etag(request)
+    if _no_modificado(request, etag):
+        return _not_modified(etag)
+    try:
+        return FastJSONResponse(get_trace_service().children_by_lote(c_lote, node, nivel, as_of, hasta).model_dump(),
+                                headers=_cache_headers(etag))
+    except Exception as e:
+        raise _http_error(e)
 
-            nodes, timeline = _build_tree(conn, c_lote_num, max_depth=max_depth)
 
-            fechas = [n.get("fecha") for n in nodes if n.get("fecha")]
-            f_ini = min(fechas) if fechas else None
-            f_fin = max(fechas) if fechas else None
+@router.get("/lote/{c_lote}/descendientes")
+def descendientes_lote(
+    request: Request,
+    c_lote: str,
+    max_depth: int = Query(default=5, ge=1, le=20),
+):
+    """
+    Traza hacia adelante: los lotes que recibieron vino del lote, por nivel (1 = directos),
+    cada uno una sola vez. Sale del grafo de lotes en memoria si hay uno (`fuente`).
+    """
+    etag = _etag(request)
+    if _no_modificado(request, etag):
+        return _not_modified(etag)
+    try:
+        return FastJSONResponse(get_trace_service().descendientes_by_lote(c_lote, max_depth).model_dump(),
+                                headers=_cache_headers(etag))
+    except Exception as e:
+        raise _http_error(e)
 
-            lts_origenes = total_in_lvl1
-            lts_destino = total_in_lvl1
-            diff = abs(lts_origenes - lts_destino)
-            ok_balance = (lts_origenes == 0.0) or (diff <= (tolerance * max(lts_origenes, 1.0)))
 
-            resp: Dict[str, Any] = {
-                "identificacion": {
-                    "c_lote": str(c_lote_num),
-                    "producto": None,
-                    "tanque_actual": (info.get("D_LOTE") if isinstance(info, dict) else None),
-                    "fecha_inicio": f_ini,
-                    "fecha_fin": f_fin,
-                    "origen_consulta": "C_LOTE",
-                },
-                "kpis": {
-                    "lts_destino": lts_destino,
-                    "rendimiento_final_pct": None,
-                    "brix_ini": None,
-                    "densidad_ini": None,
-                    "rendimiento_uva_pct": None,
-                },
-                "balance": {
-                    "ok": ok_balance,
-                    "tolerance": tolerance,
-                    "lts_origenes": lts_origenes,
-                    "lts_destino": lts_destino,
-                    "lts_borra": 0.0,
-                    "lts_merma": 0.0,
-                    "lts_otros_uso": 0.0,
-                    "ajuste_lts": 0.0,
-                    "lts_destinos_finales": total_dest_final,
-                },
-                "origenes": nodes,
-                "timeline": timeline if "timeline" in include_set else [],
-                "destinos": [] if "destinos" in include_set else [],
-            }
-            return JSONResponse(resp)
+@router.post("/lotes")
+def trazabilidad_lotes(payload: TraceBatchRequest):
+    """
+    Traza varios lotes en un único recorrido compartido.
+    - `grafo`: {C_LOTE: aristas hacia sus orígenes}, cada lote aparece una sola vez.
+    - `lotes`: por cada lote pedido, su identificación y la referencia (`subarbol`) a su entrada en `grafo`;
+      los subárboles comunes a varios lotes se comparten en lugar de repetirse.
+    """
+    if len(payload.lotes) > settings.trace_batch_max_lotes:
+        raise HTTPException(status_code=422, detail=f"Máximo {settings.trace_batch_max_lotes} lotes por pedido.")
 
-    except HTTPException:
-        raise
+    try:
+        batch = get_trace_service().trace_batch(payload.lotes, payload.max_depth, payload.include_destinos)
     except Exception as e:
-        try:
-            import traceback
-            print("\n[TRAZA][ERROR] >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>")
-            print(traceback.format_exc())
-            print("[TRAZA][ERROR] <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<\n")
-        except Exception:
-            pass
-        raise HTTPException(status_code=500, detail=f"DB_ERROR: {e}")
+        raise _http_error(e)
+    return FastJSONResponse(batch.model_dump())
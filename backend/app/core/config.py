@@ -28,6 +28,14 @@ class Settings:
     db_credentials_path: Optional[str] = _getenv("DB_CREDENTIALS_PATH")
     db_username: Optional[str] = _getenv("DB_USERNAME")
     db_password: Optional[str] = _getenv("DB_PASSWORD")
+    # Sentencias por conexión que el driver mantiene parseadas (oracledb stmtcachesize)
+    db_stmt_cache_size: int = int(_getenv("DB_STMT_CACHE_SIZE", "40"))
+    # Pool de conexiones (se precalienta al iniciar el API en TRACE_MODE=real)
+    db_pool_size: int = int(_getenv("DB_POOL_SIZE", "5"))
+    db_max_overflow: int = int(_getenv("DB_MAX_OVERFLOW", "5"))
+    db_pool_timeout: int = int(_getenv("DB_POOL_TIMEOUT", "30"))
+    # Tope del chequeo de Oracle en /health?deep=true
+    health_oracle_timeout: float = float(_getenv("HEALTH_ORACLE_TIMEOUT", "3"))
 
     # Límites / constantes
     oracle_in_clause_limit: int = int(_getenv("ORACLE_IN_CLAUSE_LIMIT", "999"))
@@ -36,12 +44,39 @@ class Settings:
     # Salidas
     csv_out_dir: str = _getenv("CSV_OUT_DIR", "./outputs")
     logs_out_dir: str = _getenv("LOGS_OUT_DIR", "./outputs/logs")
+    # Log de corridas: escritura en bloque y SSE agrupado
+    log_flush_bytes: int = int(_getenv("LOG_FLUSH_BYTES", "65536"))
+    log_flush_seconds: float = float(_getenv("LOG_FLUSH_SECONDS", "1.0"))
+    sse_batch_seconds: float = float(_getenv("SSE_BATCH_SECONDS", "0.25"))
+    sse_batch_max: int = int(_getenv("SSE_BATCH_MAX", "500"))
+    sse_heartbeat_seconds: float = float(_getenv("SSE_HEARTBEAT_SECONDS", "15"))
 
     # Módulo de composición (nombre de módulo o ruta .py)
     composicion_module_path: str = _getenv("COMPOSICION_MODULE_PATH", "composicion_enologica")
+    # Corridas en un proceso worker precargado (1) o en el hilo del request (0)
+    composicion_worker: bool = _getenv("COMPOSICION_WORKER", "1").strip().lower() in ("1", "true", "yes", "si")
+    composicion_worker_start_timeout: int = int(_getenv("COMPOSICION_WORKER_START_TIMEOUT", "120"))
+    # Límites del worker (0 / vacío = sin límite): prioridad, CPUs, memoria y CPU por corrida
+    composicion_worker_nice: int = int(_getenv("COMPOSICION_WORKER_NICE", "10"))
+    composicion_worker_cpus: str = _getenv("COMPOSICION_WORKER_CPUS", "")
+    composicion_worker_max_mem_mb: int = int(_getenv("COMPOSICION_WORKER_MAX_MEM_MB", "0"))
+    composicion_worker_max_cpu_seconds: int = int(_getenv("COMPOSICION_WORKER_MAX_CPU_SECONDS", "0"))
+    composicion_metric_seconds: float = float(_getenv("COMPOSICION_METRIC_SECONDS", "5"))
 
     # NUEVO: modo de trazabilidad (fake | real)
     trace_mode: str = _getenv("TRACE_MODE", "fake").lower().strip()
 
+    # Trazas por lote en bloque (POST /api/trazabilidad/lotes)
+    trace_batch_workers: int = int(_getenv("TRACE_BATCH_WORKERS", "4"))
+    trace_batch_max_lotes: int = int(_getenv("TRACE_BATCH_MAX_LOTES", "500"))
+
+    # Datos de referencia de la trazabilidad (tablas, LOTES_STOCK, DEPOSITOS) cacheados en el API
+    refdata_refresh_seconds: int = int(_getenv("REFDATA_REFRESH_SECONDS", "900"))
+    # Grafo de lotes mapeado en memoria que exporta cada corrida (vacío = la traza va siempre a Oracle)
+    grafo_lotes_dir: str = _getenv("GRAFO_LOTES_DIR", "")
+    grafo_check_seconds: float = float(_getenv("GRAFO_CHECK_SECONDS", "2"))
+    # Cada cuánto se relee APX_TRAZA_GENERACION para el ETag de las trazas
+    trace_generacion_check_seconds: float = float(_getenv("TRACE_GENERACION_CHECK_SECONDS", "2"))
+
 
 settings = Settings()
@@ -1,15 +1,45 @@
+import asyncio
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
+from .core.config import settings
+from .services import db
+from .services.trazabilidad import refdata
+from .services.composicion.worker import get_worker, shutdown_worker
+
 from .api.v1.health import router as health_router
 from .api.v1.composicion import router as composicion_router
 from .api.v1.trazabilidad import router as trazabilidad_router  # NUEVO
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if settings.trace_mode == "real":
+        # Pool listo antes del primer pedido: credenciales, TNS y logins se pagan acá
+        try:
+            n = await asyncio.to_thread(db.warmup_pool)
+            print(f"[DB] pool precalentado con {n} conexiones")
+        except Exception as e:
+            print(f"[DB][WARN] no se pudo precalentar el pool: {e}")
+        refdata.iniciar()
+    if settings.composicion_worker:
+        # pandas / numpy / oracledb y el módulo de composición se importan una vez, fuera del API
+        try:
+            await asyncio.to_thread(get_worker().start)
+        except Exception as e:
+            print(f"[WORKER][WARN] no se pudo iniciar el worker de composición: {e}")
+    yield
+    shutdown_worker()
+    refdata.detener()
+    db.dispose_engine()
+
 
 app = FastAPI(
     title="TRAZABILIDAD LOURDES API",
     version="0.1.0",
+    lifespan=lifespan,
     docs_url="/docs",
     redoc_url="/redoc",
     openapi_url="/openapi.json",
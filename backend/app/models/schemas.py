@@ -1,4 +1,4 @@
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional
 from pydantic import BaseModel, Field
 
 
@@ -17,6 +17,7 @@ class DeepHealthResponse(HealthResponse):
     version: str = Field(default="0.1.0")
     dependencies: Dict[str, str] = Field(default_factory=dict, description="oracle: ok/down")
     errors: List[ErrorItem] = Field(default_factory=list)
+    pool: Optional[Dict[str, Any]] = Field(default=None, description="Pool de conexiones: size, checked_out, overflow, espera_ms")
 
 
 # ===== COMPOSICIÓN (SSE request) =====
@@ -25,6 +26,39 @@ class ComposicionRequest(BaseModel):
     fecha_hasta: str = Field(..., description="Fecha fin (YYYY-MM-DD)")
 
 
+
+class ReprocesoPendientesRequest(BaseModel):
+    lotes_origen: Optional[List[int]] = Field(default=None, description="Lotes origen que recibieron composición (vacío = todo el backlog)")
+
+
+# ===== COMPOSICIÓN (backlog de transformaciones sin resolver) =====
+class PendienteItem(BaseModel):
+    mos_id: Optional[int] = None
+    dms_id: Optional[int] = None
+    dpc_id: Optional[int] = None
+    c_lote_origen: Optional[int] = Field(default=None, description="Lote origen sin composición")
+    c_lote_destino: Optional[int] = None
+    lts: float = 0.0
+    c_tipo_compro: Optional[int] = None
+    fecha: Optional[str] = None
+    motivo: Optional[str] = None
+    f_alta: Optional[str] = Field(default=None, description="Primera corrida en que quedó pendiente")
+    intentos: int = 0
+
+
+class PendientesResponse(BaseModel):
+    total: int
+    page: int
+    page_size: int
+    items: List[PendienteItem] = Field(default_factory=list)
+
+# ===== TRAZABILIDAD (request en bloque) =====
+class TraceBatchRequest(BaseModel):
+    lotes: List[str] = Field(..., min_length=1, description="Lista de C_LOTE a trazar")
+    max_depth: int = Field(default=5, ge=1, le=20)
+    include_destinos: bool = Field(default=False, description="Agrega destinos finales de todos los lotes del grafo")
+
+
 # ===== TRAZABILIDAD (response por C_LOTE) =====
 class TraceIdentification(BaseModel):
     c_lote: str
@@ -33,6 +67,7 @@ class TraceIdentification(BaseModel):
     fecha_fin: Optional[str] = None
     tanque_actual: Optional[str] = None
     origen_consulta: str = "C_LOTE"
+    as_of: Optional[str] = None
 
 
 class TraceKPIs(BaseModel):
@@ -55,6 +90,7 @@ class TraceBalance(BaseModel):
     ajuste_lts: float = 0.0
     ok: bool = True
     tolerance: float = 0.005
+    lts_destinos_finales: float = 0.0
 
 
 class TraceOriginNode(BaseModel):
@@ -77,6 +113,33 @@ class TraceOriginNode(BaseModel):
     guia: Optional[str] = None
     fel: Optional[str] = None
     observacion: Optional[str] = None
+    c_lote: Optional[str] = None
+    c_lote_origen: Optional[str] = None
+
+
+class TraceChildNode(TraceOriginNode):
+    n_children: int = Field(default=0, description="Orígenes directos del lote origen (0 = no se expande)")
+    hasta: Optional[str] = Field(default=None, description="Cota cronológica para pedir sus hijos (sólo con as_of)")
+
+
+class TraceChildrenResponse(BaseModel):
+    c_lote: str
+    node: str = Field(description="Lote expandido")
+    nivel: int = Field(description="Nivel del lote expandido (0 = raíz)")
+    as_of: Optional[str] = None
+    children: List[TraceChildNode] = Field(default_factory=list)
+
+
+class TraceDescendientesNivel(BaseModel):
+    nivel: int
+    lotes: List[str] = Field(default_factory=list)
+
+
+class TraceDescendientesResponse(BaseModel):
+    c_lote: str
+    niveles: List[TraceDescendientesNivel] = Field(default_factory=list, description="Lotes que recibieron del lote, por nivel (1 = directos)")
+    total_lotes: int = 0
+    fuente: str = Field(default="oracle", description="grafo (en memoria), oracle o fake")
 
 
 class TraceTimelineEvent(BaseModel):
@@ -85,14 +148,18 @@ class TraceTimelineEvent(BaseModel):
     ot: Optional[str] = None
     volumen_lts: Optional[float] = None
     nota: Optional[str] = None
+    tk_origen: Optional[str] = None
+    tk_destino: Optional[str] = None
 
 
 class TraceDestination(BaseModel):
-    fecha: str
+    fecha: Optional[str] = None
     destino: str
     volumen_lts: Optional[float] = None
     guia: Optional[str] = None
     fel: Optional[str] = None
+    c_lote: Optional[str] = None
+    mos_id_destino: Optional[int] = None
 
 
 class TraceResponse(BaseModel):
@@ -102,3 +169,49 @@ class TraceResponse(BaseModel):
     origenes: List[TraceOriginNode]
     timeline: Optional[List[TraceTimelineEvent]] = None
     destinos: Optional[List[TraceDestination]] = None
+
+
+# ===== TRAZABILIDAD (composición resumida por C_LOTE) =====
+class TraceComposicionItem(BaseModel):
+    c_variedad_inv: Optional[str] = None
+    c_periodo: Optional[int] = None
+    id_subvalle: Optional[str] = None
+    lts: float = 0.0
+    pct: Optional[float] = None
+
+
+class TraceComposicionResponse(BaseModel):
+    c_lote: str
+    as_of: Optional[str] = None
+    lts_total: float = 0.0
+    componentes: List[TraceComposicionItem] = Field(default_factory=list)
+
+
+# ===== TRAZABILIDAD (response en bloque) =====
+class TraceEdge(BaseModel):
+    tipo: str
+    fecha: Optional[str] = None
+    ot: Optional[str] = None
+    tk_origen: Optional[str] = None
+    tk_destino: Optional[str] = None
+    lts: float = 0.0
+    contrib_pct: Optional[float] = None
+    c_lote_origen: Optional[str] = None
+
+
+class TraceBatchLote(BaseModel):
+    c_lote: str
+    d_lote: Optional[str] = None
+    lts_origenes: float = 0.0
+    subarbol: str = Field(description="Clave en `grafo` donde empieza el árbol del lote")
+    nodos: int = 0
+    profundidad: int = 0
+    lotes_alcanzados: int = 0
+
+
+class TraceBatchResponse(BaseModel):
+    lotes: List[TraceBatchLote]
+    grafo: Dict[str, List[TraceEdge]] = Field(default_factory=dict)
+    destinos: Dict[str, List[TraceDestination]] = Field(default_factory=dict)
+    invalidos: List[str] = Field(default_factory=list)
+    stats: Dict[str, int] = Field(default_factory=dict)
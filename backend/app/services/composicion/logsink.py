@@ -0,0 +1,169 @@
+# backend/app/services/composicion/logsink.py
+"""
+Log de corridas de composición con escritura en bloque.
+
+- LogSink junta líneas en memoria y escribe al archivo cuando acumula LOG_FLUSH_BYTES
+  o pasan LOG_FLUSH_SECONDS (y siempre al cerrar): pocas syscalls aunque la corrida
+  emita decenas de miles de líneas.
+- comprimir_logs_rotados() pasa a .log.gz los logs de corridas anteriores.
+- listar_logs() / leer_log(): lectura por rango de bytes (tail incremental) para GET /api/composicion/logs.
+"""
+from __future__ import annotations
+import gzip
+import re
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+from ...core.config import settings
+
+
+class LogSink:
+    def __init__(self, path: Path, flush_bytes: Optional[int] = None, flush_seconds: Optional[float] = None):
+        self.path = path
+        self._fh = path.open("a", encoding="utf-8", newline="")
+        self._buf: List[str] = []
+        self._buf_bytes = 0
+        self._last_flush = time.monotonic()
+        self._flush_bytes = settings.log_flush_bytes if flush_bytes is None else flush_bytes
+        self._flush_seconds = settings.log_flush_seconds if flush_seconds is None else flush_seconds
+
+    def write(self, ts: str, level: str, msg: str) -> None:
+        line = f"{ts} [{level}] {msg}\n"
+        self._buf.append(line)
+        self._buf_bytes += len(line)
+        self.maybe_flush()
+
+    def maybe_flush(self) -> None:
+        if self._buf_bytes >= self._flush_bytes or (time.monotonic() - self._last_flush) >= self._flush_seconds:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._buf:
+            self._fh.write("".join(self._buf))
+            self._buf.clear()
+            self._buf_bytes = 0
+        self._fh.flush()
+        self._last_flush = time.monotonic()
+
+    def close(self) -> None:
+        if self._fh.closed:
+            return
+        self.flush()
+        self._fh.close()
+
+
+def _gzip(path: Path) -> None:
+    dst = path.with_name(path.name + ".gz")
+    tmp = dst.with_name(dst.name + ".tmp")
+    try:
+        with path.open("rb") as src, gzip.open(tmp, "wb", compresslevel=6) as out:
+            shutil.copyfileobj(src, out)
+        tmp.replace(dst)
+        path.unlink()
+    except Exception as e:
+        print(f"[LOGS][WARN] no se pudo comprimir {path.name}: {e}")
+        tmp.unlink(missing_ok=True)
+
+
+def comprimir_logs_rotados(logs_dir: Path, activos: Iterable[Path]) -> None:
+    """Comprime en segundo plano los composicion_*.log que no son de una corrida en curso."""
+    en_uso = {p.resolve() for p in activos}
+    viejos = [p for p in logs_dir.glob("composicion_*.log") if p.resolve() not in en_uso]
+    if not viejos:
+        return
+
+    def _run() -> None:
+        for p in viejos:
+            _gzip(p)
+
+    threading.Thread(target=_run, name="logs-gzip", daemon=True).start()
+
+
+# ---------- lectura (tail por offset de bytes) ----------
+RUN_PATTERN = re.compile(r"^composicion_[0-9A-Za-z_]+$")
+
+
+def _archivo_run(logs_dir: Path, run: str) -> Optional[Path]:
+    """composicion_<ts>_<sufijo> -> .log (en curso o reciente) o .log.gz (rotado). None si no existe."""
+    if not RUN_PATTERN.match(run):
+        return None
+    for nombre in (f"{run}.log", f"{run}.log.gz"):
+        p = logs_dir / nombre
+        if p.is_file():
+            return p
+    return None
+
+
+def listar_logs(logs_dir: Path, activos: Iterable[Path], limite: int = 50) -> List[Dict[str, Any]]:
+    """Corridas más recientes primero (el nombre empieza con la fecha, así que alcanza con ordenarlo)."""
+    en_uso = {p.resolve() for p in activos}
+    runs: Dict[str, Dict[str, Any]] = {}
+    for p in logs_dir.glob("composicion_*.log*"):
+        run = p.name.split(".log")[0]
+        if p.suffix not in (".log", ".gz") or run in runs:
+            continue
+        comprimido = p.suffix == ".gz"
+        runs[run] = {
+            "run": run,
+            "bytes": None if comprimido else p.stat().st_size,
+            "comprimido": comprimido,
+            "activo": p.resolve() in en_uso,
+        }
+    return [runs[r] for r in sorted(runs, reverse=True)[:limite]]
+
+
+def leer_log(logs_dir: Path, run: str, offset: int, limit: int, activos: Iterable[Path]) -> Optional[Dict[str, Any]]:
+    """
+    Hasta `limit` bytes del log desde `offset`, cortados en el último salto de línea para que
+    `next_offset` quede siempre al principio de una línea. offset < 0 = los últimos |offset| bytes
+    (arrancando en la primera línea completa). Con el log de una corrida en curso, pedir de nuevo
+    desde `next_offset` devuelve sólo lo que se escribió después (tail incremental).
+    Los .log.gz rotados se leen igual, con offsets sobre el texto descomprimido.
+    """
+    path = _archivo_run(logs_dir, run)
+    if path is None:
+        return None
+    activo = path.resolve() in {p.resolve() for p in activos}
+    comprimido = path.suffix == ".gz"
+    with (gzip.open(path, "rb") if comprimido else path.open("rb")) as fh:
+        if comprimido:
+            # GzipFile no sabe ir al final: se mide descomprimiendo
+            size = 0
+            while True:
+                bloque = fh.read(1 << 20)
+                if not bloque:
+                    break
+                size += len(bloque)
+        else:
+            size = fh.seek(0, 2)
+        start = max(0, size + offset) if offset < 0 else min(offset, size)
+        fh.seek(start)
+        data = fh.read(limit)
+    if offset < 0 and start > 0:
+        # Tail: se descarta la línea cortada del principio
+        salto = data.find(b"\n") + 1 or len(data)
+        data = data[salto:]
+        start += salto
+    fin = start + len(data)
+    if fin < size or activo:
+        # Sin líneas a medias: lo que sigue al último \n se vuelve a pedir en la próxima lectura
+        # (una línea más larga que `limit` sí sale en partes, para no quedar en el mismo offset)
+        corte = data.rfind(b"\n")
+        if corte >= 0:
+            data = data[:corte + 1]
+        elif fin >= size:
+            data = b""
+        fin = start + len(data)
+    return {
+        "run": run,
+        "offset": start,
+        "next_offset": fin,
+        "size": size,
+        "eof": fin >= size,
+        "activo": activo,
+        "comprimido": comprimido,
+        "text": data.decode("utf-8", errors="replace"),
+    }
@@ -0,0 +1,63 @@
+# backend/app/services/composicion/pendientes.py
+"""
+Backlog de transformaciones sin resolver (APX_TRAZA_PENDIENTES).
+
+Lo escribe el proceso de composición cuando el lote origen de una transformación todavía
+no tiene composición; el API sólo lo pagina. La tabla tiene índice por C_LOTE_ORIGEN.
+"""
+from __future__ import annotations
+from typing import Any, Dict, Optional
+
+from sqlalchemy import text
+
+from ...utils.convert import to_float, to_int, to_iso
+from ...utils.rows import normalize_list_upper
+from .. import db
+from ..trazabilidad.queries import probe_table, tq
+
+PENDIENTES_TABLE = "APX_TRAZA_PENDIENTES"
+
+_COLUMNAS = (
+    "MOS_ID, DMS_ID, DPC_ID, C_LOTE_ORIGEN, C_LOTE_DESTINO, Q_ORIGEN_USADA, "
+    "C_TIPO_COMPRO, F_MOVIMIENTO, MOTIVO, F_ALTA, INTENTOS"
+)
+
+
+def listar(page: int, page_size: int, c_lote_origen: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    """
+    Una página del backlog ordenada por (C_LOTE_ORIGEN, F_MOVIMIENTO, MOS_ID).
+    Devuelve None si la tabla no existe (todavía no corrió ninguna composición con pendientes).
+    """
+    filtro = "WHERE C_LOTE_ORIGEN = :c_lote_origen" if c_lote_origen is not None else ""
+    params: Dict[str, Any] = {"c_lote_origen": c_lote_origen} if c_lote_origen is not None else {}
+    with db.get_engine().connect() as conn:
+        if not probe_table(conn, PENDIENTES_TABLE):
+            return None
+        total = conn.execute(text(f"SELECT COUNT(*) FROM {tq(PENDIENTES_TABLE)} {filtro}"), params).scalar() or 0
+        rows = conn.execute(
+            text(f"""
+                SELECT {_COLUMNAS}
+                FROM {tq(PENDIENTES_TABLE)}
+                {filtro}
+                ORDER BY C_LOTE_ORIGEN ASC, F_MOVIMIENTO ASC, MOS_ID ASC, DPC_ID ASC
+                OFFSET :offset ROWS FETCH NEXT :limit ROWS ONLY
+            """),
+            {**params, "offset": (page - 1) * page_size, "limit": page_size},
+        ).mappings().all()
+    items = [
+        {
+            "mos_id": to_int(r.get("MOS_ID")),
+            "dms_id": to_int(r.get("DMS_ID")),
+            "dpc_id": to_int(r.get("DPC_ID")),
+            "c_lote_origen": to_int(r.get("C_LOTE_ORIGEN")),
+            "c_lote_destino": to_int(r.get("C_LOTE_DESTINO")),
+            "lts": to_float(r.get("Q_ORIGEN_USADA")),
+            "c_tipo_compro": to_int(r.get("C_TIPO_COMPRO")),
+            "fecha": to_iso(r.get("F_MOVIMIENTO")),
+            "motivo": r.get("MOTIVO"),
+            "f_alta": to_iso(r.get("F_ALTA")),
+            "intentos": to_int(r.get("INTENTOS")) or 0,
+        }
+        for r in normalize_list_upper(rows)
+    ]
+    return {"total": int(total), "page": page, "page_size": page_size, "items": items}
@@ -1,11 +1,15 @@
-import json
-import importlib
-import importlib.util
+import queue
+import threading
+import time
 from pathlib import Path
 from datetime import datetime, timezone
-from typing import Generator
+from typing import Any, Dict, Generator, Iterator, List, Optional, Set, Tuple
 
 from ...core.config import settings
+from ...utils.jsonfast import dumps_str
+from ..trazabilidad import refdata
+from .logsink import LogSink, comprimir_logs_rotados
+from .worker import cargar_modulo, get_worker
 
 
 def _utcnow_iso() -> str:
@@ -13,120 +17,183 @@ def _utcnow_iso() -> str:
 
 
 def _sse(event: str, data: dict) -> str:
-    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+    return f"event: {event}\ndata: {dumps_str(data)}\n\n"
 
 
 def _sse_comment(msg: str) -> str:
     return f": {msg}\n\n"
 
 
-def _load_module_from_file(py_path: Path):
-    spec = importlib.util.spec_from_file_location(py_path.stem, str(py_path))
-    if spec is None or spec.loader is None:
-        raise RuntimeError(f"No se pudo crear el spec para: {py_path}")
-    mod = importlib.util.module_from_spec(spec)
-    spec.loader.exec_module(mod)  # type: ignore[attr-defined]
-    return mod
+def _eventos_en_hilo(funcion: str, args: tuple) -> Iterator[Tuple[str, Any]]:
+    """Corrida en el hilo del request (COMPOSICION_WORKER=0): mismos eventos que el worker."""
+    try:
+        mod = cargar_modulo()
+    except Exception as imp_err:
+        yield ("error", {"code": "IMPORT_ERROR", "message": f"{imp_err}"})
+        return
+    if not hasattr(mod, funcion):
+        yield ("error", {"code": "ATTR_ERROR", "message": f"El módulo no expone '{funcion}'"})
+        return
+    try:
+        for line in getattr(mod, funcion)(*args):
+            yield ("log", str(line))
+    except Exception as run_err:
+        yield ("error", {"code": "RUNTIME_ERROR", "message": f"{run_err}"})
+        return
+    yield ("done", None)
 
 
-def _import_composicion_module():
+def _con_ticks(eventos: Iterator[Tuple[str, Any]], tick_seconds: float) -> Iterator[Tuple[str, Any]]:
     """
-    Soporta:
-      - Nombre de módulo (p.ej. 'composicion_enologica')
-      - Ruta absoluta/relativa a un .py
-    Debe exponer: ejecutar_proceso_completo(fecha_inicio_str, fecha_fin_str)
+    Corre `eventos` en un hilo y agrega ("tick", None) cuando no llega nada en `tick_seconds`.
+    Si el consumidor se va, el hilo corta el generador en el próximo evento.
     """
-    module_ref = settings.composicion_module_path
-    if not module_ref:
-        raise RuntimeError("COMPOSICION_MODULE_PATH no configurado.")
+    q: "queue.Queue[Tuple[str, Any]]" = queue.Queue(maxsize=10000)
+    parar = threading.Event()
+
+    def _producir() -> None:
+        try:
+            for ev in eventos:
+                if parar.is_set():
+                    break
+                q.put(ev)
+        finally:
+            close = getattr(eventos, "close", None)
+            if close:
+                close()
+            q.put(("_fin", None))
+
+    threading.Thread(target=_producir, name="composicion-hilo", daemon=True).start()
+    try:
+        while True:
+            try:
+                ev = q.get(timeout=tick_seconds)
+            except queue.Empty:
+                yield ("tick", None)
+                continue
+            if ev[0] == "_fin":
+                return
+            yield ev
+    finally:
+        parar.set()
 
-    p = Path(module_ref)
-    if p.suffix.lower() == ".py" or p.exists():
-        if not p.exists():
-            raise RuntimeError(f"Ruta de módulo no existe: {p}")
-        return _load_module_from_file(p)
 
-    return importlib.import_module(module_ref)
+# Logs de corridas en curso: no se comprimen
+_logs_activos: Set[Path] = set()
 
 
-def _ensure_logs_dir() -> Path:
+def logs_activos() -> Set[Path]:
+    """Logs que todavía se están escribiendo (GET /api/composicion/logs los marca `activo`)."""
+    return set(_logs_activos)
+
+
+def ensure_logs_dir() -> Path:
     logs_dir = Path(settings.logs_out_dir)
     logs_dir.mkdir(parents=True, exist_ok=True)
     return logs_dir
 
 
-def _open_log_file(fecha_desde: str, fecha_hasta: str) -> Path:
-    logs_dir = _ensure_logs_dir()
+def _open_log_file(sufijo: str) -> Path:
+    logs_dir = ensure_logs_dir()
     ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    safe_desde = fecha_desde.replace("-", "")
-    safe_hasta = fecha_hasta.replace("-", "")
-    fname = f"composicion_{ts}_{safe_desde}_{safe_hasta}.log"
+    fname = f"composicion_{ts}_{sufijo}.log"
     return logs_dir / fname
 
 
 def stream_sse_logs(fecha_desde: str, fecha_hasta: str) -> Generator[str, None, None]:
+    """SSE de una corrida completa de composición entre dos fechas."""
     print(f"[SSE] inicio stream -> {fecha_desde} .. {fecha_hasta}")
+    sufijo = f"{fecha_desde.replace('-', '')}_{fecha_hasta.replace('-', '')}"
+    yield from _stream_corrida("ejecutar_proceso_completo", (fecha_desde, fecha_hasta), sufijo,
+                               "Iniciando proceso de composición...")
 
-    # Abrir archivo de log
-    log_path = _open_log_file(fecha_desde, fecha_hasta)
-    f = log_path.open("a", encoding="utf-8", newline="")
 
-    def _write_line(level: str, msg: str):
-        ts = _utcnow_iso()
-        f.write(f"{ts} [{level}] {msg}\n")
-        f.flush()
+def stream_sse_reproceso(lotes_origen: Optional[List[int]] = None) -> Generator[str, None, None]:
+    """SSE del reproceso del backlog de transformaciones (todo, o los lotes origen pedidos)."""
+    print(f"[SSE] inicio reproceso de pendientes -> lotes_origen={lotes_origen}")
+    yield from _stream_corrida("reprocesar_pendientes", (lotes_origen,), "pendientes",
+                               "Iniciando reproceso de transformaciones pendientes...")
 
-    # “despertar” al cliente y primer log
-    yield _sse_comment("stream-open")
-    first_msg = "Iniciando proceso de composición..."
-    _write_line("INFO", first_msg)
-    yield _sse("log", {"ts": _utcnow_iso(), "level": "INFO", "msg": first_msg})
 
-    # Importar módulo
-    try:
-        mod = _import_composicion_module()
-        msg = f"Módulo importado: {settings.composicion_module_path}"
-        _write_line("INFO", msg)
-        yield _sse("log", {"ts": _utcnow_iso(), "level": "INFO", "msg": msg})
-    except Exception as imp_err:
-        err = f"{imp_err}"
-        _write_line("ERROR", f"IMPORT_ERROR: {err}")
-        yield _sse("error", {"ok": False, "code": "IMPORT_ERROR", "message": err})
-        f.close()
-        return
+def _stream_corrida(funcion: str, args: tuple, sufijo_log: str, msg_inicio: str) -> Generator[str, None, None]:
+    """
+    SSE de una corrida:
+    - `log`: mensajes sueltos del runner; `logs`: líneas de la corrida agrupadas
+      ({"items": [{ts, level, msg}, ...]}), cada SSE_BATCH_SECONDS o SSE_BATCH_MAX líneas.
+    - `run`: nombre de la corrida, para releer su log con GET /api/composicion/logs/{run}.
+    - `metric`, `error`, `done` como antes; comentarios `: heartbeat` si no hubo nada
+      que mandar en SSE_HEARTBEAT_SECONDS (consultas largas sin logs).
+    """
+    log_path = _open_log_file(sufijo_log)
+    sink = LogSink(log_path)
+    _logs_activos.add(log_path)
+    comprimir_logs_rotados(log_path.parent, _logs_activos)
 
-    if not hasattr(mod, "ejecutar_proceso_completo"):
-        msg = "El módulo no expone 'ejecutar_proceso_completo(fecha_inicio, fecha_fin)'"
-        _write_line("ERROR", f"ATTR_ERROR: {msg}")
-        yield _sse("error", {"ok": False, "code": "ATTR_ERROR", "message": msg})
-        f.close()
-        return
+    lote: List[Dict[str, str]] = []
+    ultimo_lote = time.monotonic()
+    ultimo_envio = time.monotonic()
+    tick = max(0.05, min(settings.sse_batch_seconds, settings.sse_heartbeat_seconds))
 
-    # Ejecutar el generador del proceso y retransmitir logs
-    try:
-        gen = mod.ejecutar_proceso_completo(fecha_desde, fecha_hasta)
-        msg = "Proceso lanzado, leyendo logs..."
-        _write_line("INFO", msg)
-        yield _sse("log", {"ts": _utcnow_iso(), "level": "INFO", "msg": msg})
-
-        for line in gen:
-            msg = str(line).rstrip()
-            if not msg:
-                continue
-            _write_line("INFO", msg)
-            yield _sse("log", {"ts": _utcnow_iso(), "level": "INFO", "msg": msg})
+    def _log(level: str, msg: str) -> Dict[str, str]:
+        ts = _utcnow_iso()
+        sink.write(ts, level, msg)
+        return {"ts": ts, "level": level, "msg": msg}
 
-    except Exception as run_err:
-        err = f"{run_err}"
-        _write_line("ERROR", f"RUNTIME_ERROR: {err}")
-        yield _sse("error", {"ok": False, "code": "RUNTIME_ERROR", "message": err})
-        f.close()
-        return
+    def _vaciar_lote() -> Iterator[str]:
+        nonlocal lote, ultimo_lote, ultimo_envio
+        if lote:
+            yield _sse("logs", {"items": lote})
+            lote = []
+            ultimo_envio = time.monotonic()
+        ultimo_lote = time.monotonic()
 
-    # Fin correcto
-    _write_line("INFO", "Proceso finalizado.")
-    yield _sse("done", {"ok": True})
-    # comentario final para cerrar prolijo algunos clientes
-    yield _sse_comment("stream-close")
-    f.close()
-    print(f"[SSE] fin stream - log guardado en: {log_path}")
+    try:
+        # “despertar” al cliente y primer log
+        yield _sse_comment("stream-open")
+        yield _sse("run", {"run": log_path.stem})
+        yield _sse("log", _log("INFO", msg_inicio))
+
+        # La corrida va al worker precargado (o al hilo del request si COMPOSICION_WORKER=0)
+        if settings.composicion_worker:
+            eventos = get_worker().run(*args, funcion=funcion, tick_seconds=tick)
+            msg = "Proceso lanzado en el worker de composición, leyendo logs..."
+        else:
+            eventos = _con_ticks(_eventos_en_hilo(funcion, args), tick)
+            msg = "Proceso lanzado, leyendo logs..."
+        yield _sse("log", _log("INFO", msg))
+
+        for kind, payload in eventos:
+            if kind == "log":
+                msg = str(payload).rstrip()
+                if msg:
+                    lote.append(_log("INFO", msg))
+            elif kind == "metric":
+                yield from _vaciar_lote()
+                yield _sse("metric", {"ts": _utcnow_iso(), **payload})
+                ultimo_envio = time.monotonic()
+            elif kind == "error":
+                yield from _vaciar_lote()
+                _log("ERROR", f"{payload['code']}: {payload['message']}")
+                yield _sse("error", {"ok": False, **payload})
+                return
+
+            ahora = time.monotonic()
+            if len(lote) >= settings.sse_batch_max or (lote and ahora - ultimo_lote >= settings.sse_batch_seconds):
+                yield from _vaciar_lote()
+            elif kind == "tick":
+                sink.maybe_flush()
+                if ahora - ultimo_envio >= settings.sse_heartbeat_seconds:
+                    yield _sse_comment("heartbeat")
+                    ultimo_envio = ahora
+        yield from _vaciar_lote()
+
+        # Fin correcto: las tablas APX_TRAZA_* cambiaron, refrescar los datos de referencia del API
+        refdata.pedir_refresco()
+        _log("INFO", "Proceso finalizado.")
+        yield _sse("done", {"ok": True})
+        # comentario final para cerrar prolijo algunos clientes
+        yield _sse_comment("stream-close")
+    finally:
+        sink.close()
+        _logs_activos.discard(log_path)
+        print(f"[SSE] fin stream - log guardado en: {log_path}")
@@ -0,0 +1,373 @@
+# backend/app/services/composicion/worker.py
+"""
+Proceso worker de larga vida para las corridas de composición.
+
+- Se lanza una vez (al iniciar el API) e importa pandas / numpy / sqlalchemy / oracledb
+  y el módulo de composición antes de recibir la primera corrida.
+- El módulo se vuelve a cargar sólo si cambia el mtime del archivo.
+- Cada corrida se pide por un Pipe; el worker devuelve los mensajes del generador pedido
+  (`ejecutar_proceso_completo`, `reprocesar_pendientes`) a medida que aparecen. El API no importa pandas.
+- El worker corre con prioridad baja (nice), CPUs acotadas y límites de memoria / CPU
+  por corrida (Linux), así el GIL y los núcleos del API quedan para las trazas.
+
+Protocolo (tuplas por el Pipe):
+  API -> worker: ("run", funcion, args) | ("stop",)
+  worker -> API: ("ready", info) | ("log", msg) | ("metric", {...}) | ("done", None)
+                 | ("error", {"code", "message"})
+  (del lado API, `run` agrega ("tick", None) cuando el worker no manda nada por un rato)
+"""
+from __future__ import annotations
+import importlib
+import importlib.util
+import math
+import multiprocessing as mp
+import os
+import signal
+import threading
+import time
+from pathlib import Path
+from types import ModuleType
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from ...core.config import settings
+
+try:  # sólo POSIX
+    import resource
+except ImportError:  # pragma: no cover - Windows
+    resource = None  # type: ignore[assignment]
+
+
+# ---------- carga del módulo con cache por mtime ----------
+_mod_cache: Dict[str, Tuple[float, ModuleType]] = {}
+
+
+def _load_module_from_file(py_path: Path) -> ModuleType:
+    spec = importlib.util.spec_from_file_location(py_path.stem, str(py_path))
+    if spec is None or spec.loader is None:
+        raise RuntimeError(f"No se pudo crear el spec para: {py_path}")
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)  # type: ignore[attr-defined]
+    return mod
+
+
+def _mtime(path: Optional[str]) -> float:
+    try:
+        return Path(path).stat().st_mtime if path else 0.0
+    except OSError:
+        return 0.0
+
+
+def cargar_modulo(module_ref: Optional[str] = None) -> ModuleType:
+    """
+    Soporta:
+      - Nombre de módulo (p.ej. 'composicion_enologica')
+      - Ruta absoluta/relativa a un .py
+    Devuelve el módulo cacheado mientras el archivo no cambie (mtime).
+    Debe exponer: ejecutar_proceso_completo(fecha_inicio_str, fecha_fin_str)
+    (y, para el backlog de transformaciones, reprocesar_pendientes(lotes_origen)).
+    """
+    module_ref = module_ref or settings.composicion_module_path
+    if not module_ref:
+        raise RuntimeError("COMPOSICION_MODULE_PATH no configurado.")
+
+    cached = _mod_cache.get(module_ref)
+    p = Path(module_ref)
+    if p.suffix.lower() == ".py" or p.exists():
+        if not p.exists():
+            raise RuntimeError(f"Ruta de módulo no existe: {p}")
+        mtime = _mtime(str(p))
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, _load_module_from_file(p))
+            _mod_cache[module_ref] = cached
+        return cached[1]
+
+    if cached is None:
+        mod = importlib.import_module(module_ref)
+    else:
+        mod = cached[1]
+        if _mtime(getattr(mod, "__file__", None)) != cached[0]:
+            mod = importlib.reload(mod)
+    _mod_cache[module_ref] = (_mtime(getattr(mod, "__file__", None)), mod)
+    return mod
+
+
+# ---------- lado worker ----------
+class LimiteCPU(Exception):
+    pass
+
+
+def _on_sigxcpu(signum, frame):
+    raise LimiteCPU()
+
+
+def _aplicar_limites() -> Dict[str, Any]:
+    """Prioridad, CPUs y memoria máxima del proceso worker. Lo que la plataforma no soporta se omite."""
+    aplicados: Dict[str, Any] = {}
+    if settings.composicion_worker_nice > 0 and hasattr(os, "nice"):
+        try:
+            os.nice(settings.composicion_worker_nice)
+            aplicados["nice"] = settings.composicion_worker_nice
+        except OSError:
+            pass
+    cpus = [int(c) for c in (settings.composicion_worker_cpus or "").split(",") if c.strip().isdigit()]
+    if cpus and hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, cpus)
+            aplicados["cpus"] = cpus
+        except OSError:
+            pass
+    if resource is not None and settings.composicion_worker_max_mem_mb > 0:
+        limite = settings.composicion_worker_max_mem_mb * 1024 * 1024
+        try:
+            resource.setrlimit(resource.RLIMIT_AS, (limite, limite))
+            aplicados["max_mem_mb"] = settings.composicion_worker_max_mem_mb
+        except (ValueError, OSError):
+            pass
+    if resource is not None and hasattr(signal, "SIGXCPU"):
+        signal.signal(signal.SIGXCPU, _on_sigxcpu)
+    return aplicados
+
+
+def _cpu_s() -> float:
+    t = os.times()
+    return t.user + t.system
+
+
+def _rss_mb() -> Optional[float]:
+    try:
+        with open("/proc/self/statm") as fh:
+            return round(int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1048576.0, 1)
+    except Exception:
+        if resource is not None:
+            return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1)
+        return None
+
+
+class _Canal:
+    """Pipe del worker compartido por la corrida y el hilo de métricas."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._lock = threading.Lock()
+
+    def send(self, msg) -> None:
+        with self._lock:
+            self.conn.send(msg)
+
+
+def _limite_cpu_por_corrida(budget_s: int) -> None:
+    """RLIMIT_CPU es acumulado del proceso: el tope de cada corrida es lo ya usado + budget."""
+    if resource is None or budget_s <= 0:
+        return
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    soft = math.ceil(_cpu_s()) + budget_s
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def _sin_limite_cpu() -> None:
+    if resource is None:
+        return
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    resource.setrlimit(resource.RLIMIT_CPU, (hard, hard))
+
+
+def _precargar() -> Dict[str, Any]:
+    """Importa las dependencias pesadas y el módulo de composición; informa qué quedó listo."""
+    info: Dict[str, Any] = {}
+    for name in ("numpy", "pandas", "sqlalchemy", "oracledb"):
+        try:
+            importlib.import_module(name)
+            info[name] = True
+        except Exception:
+            info[name] = False
+    try:
+        cargar_modulo()
+        info["modulo"] = settings.composicion_module_path
+    except Exception as e:
+        info["modulo_error"] = str(e)
+    return info
+
+
+def _correr(conn: _Canal, funcion: str, args: tuple) -> None:
+    t0, cpu0 = time.monotonic(), _cpu_s()
+
+    def _metricas() -> Dict[str, Any]:
+        return {"elapsed_s": round(time.monotonic() - t0, 1), "cpu_s": round(_cpu_s() - cpu0, 1), "rss_mb": _rss_mb()}
+
+    # Métricas periódicas aunque la corrida esté en una consulta larga sin logs
+    fin = threading.Event()
+
+    def _emitir_metricas() -> None:
+        while not fin.wait(settings.composicion_metric_seconds):
+            try:
+                conn.send(("metric", _metricas()))
+            except Exception:
+                return
+
+    hilo = threading.Thread(target=_emitir_metricas, name="metricas", daemon=True)
+    hilo.start()
+    try:
+        _limite_cpu_por_corrida(settings.composicion_worker_max_cpu_seconds)
+        final = _correr_modulo(conn, funcion, args)
+    finally:
+        _sin_limite_cpu()
+        fin.set()
+        hilo.join(timeout=2)
+        conn.send(("metric", _metricas()))
+    # done / error va último: el API deja de leer ahí y lo que quede en el Pipe sería de la próxima corrida
+    conn.send(final)
+
+
+def _correr_modulo(conn: _Canal, funcion: str, args: tuple) -> Tuple[str, Any]:
+    """Manda los logs de la corrida y devuelve el mensaje de cierre (("done", None) o ("error", {...}))."""
+    try:
+        mod = cargar_modulo()
+    except Exception as e:
+        return ("error", {"code": "IMPORT_ERROR", "message": str(e)})
+    if not hasattr(mod, funcion):
+        return ("error", {"code": "ATTR_ERROR", "message": f"El módulo no expone '{funcion}'"})
+    try:
+        for line in getattr(mod, funcion)(*args):
+            conn.send(("log", str(line)))
+    except LimiteCPU:
+        return ("error", {"code": "CPU_LIMIT", "message":
+                          f"La corrida superó {settings.composicion_worker_max_cpu_seconds}s de CPU."})
+    except MemoryError:
+        return ("error", {"code": "MEMORY_LIMIT", "message":
+                          f"La corrida superó {settings.composicion_worker_max_mem_mb} MB de memoria."})
+    except Exception as e:
+        return ("error", {"code": "RUNTIME_ERROR", "message": str(e)})
+    return ("done", None)
+
+
+def _worker_main(conn) -> None:
+    limites = _aplicar_limites()
+    canal = _Canal(conn)
+    canal.send(("ready", {**_precargar(), "limites": limites}))
+    while True:
+        try:
+            msg = conn.recv()
+        except (EOFError, OSError):
+            break
+        if not msg or msg[0] == "stop":
+            break
+        if msg[0] == "run":
+            _correr(canal, msg[1], tuple(msg[2]))
+    conn.close()
+
+
+# ---------- lado API ----------
+class ComposicionWorker:
+    """Un proceso worker, una corrida a la vez."""
+
+    def __init__(self):
+        self._ctx = mp.get_context("spawn")
+        self._proc: Optional[mp.process.BaseProcess] = None
+        self._conn = None
+        self._lock = threading.Lock()
+        self.info: Dict[str, Any] = {}
+
+    def _alive(self) -> bool:
+        return self._proc is not None and self._proc.is_alive()
+
+    def start(self) -> None:
+        if self._alive():
+            return
+        parent, child = self._ctx.Pipe()
+        self._proc = self._ctx.Process(target=_worker_main, args=(child,), name="composicion-worker", daemon=True)
+        self._proc.start()
+        child.close()
+        self._conn = parent
+        # espera la precarga (imports + módulo); si no llega, el worker no sirve
+        if not self._conn.poll(settings.composicion_worker_start_timeout):
+            self._descartar()
+            raise RuntimeError("El proceso worker no terminó de iniciar a tiempo.")
+        try:
+            kind, info = self._conn.recv()
+        except (EOFError, OSError):
+            self._descartar()
+            raise RuntimeError("El proceso worker terminó durante el inicio.")
+        self.info = info if kind == "ready" else {}
+        print(f"[WORKER] composición lista (pid={self._proc.pid}): {self.info}")
+
+    def stop(self) -> None:
+        if self._conn is not None:
+            try:
+                self._conn.send(("stop",))
+            except Exception:
+                pass
+        if self._proc is not None:
+            self._proc.join(timeout=5)
+            if self._proc.is_alive():
+                self._proc.terminate()
+        self._proc = None
+        self._conn = None
+
+    def run(self, *args: Any, funcion: str = "ejecutar_proceso_completo",
+            tick_seconds: Optional[float] = None) -> Iterator[Tuple[str, Any]]:
+        """
+        Corre `funcion(*args)` del módulo de composición.
+        Genera ("log", msg) / ("metric", {...}) ... y termina con ("done", None) o ("error", {...}).
+        Con `tick_seconds`, si el worker no manda nada en ese lapso se genera ("tick", None).
+        """
+        if not self._lock.acquire(blocking=False):
+            yield ("error", {"code": "BUSY", "message": "Ya hay una corrida de composición en curso."})
+            return
+        terminado = False
+        try:
+            try:
+                self.start()
+            except Exception as e:
+                terminado = True
+                yield ("error", {"code": "WORKER_ERROR", "message": str(e)})
+                return
+            self._conn.send(("run", funcion, args))
+            while True:
+                if tick_seconds and not self._conn.poll(tick_seconds):
+                    yield ("tick", None)
+                    continue
+                try:
+                    kind, payload = self._conn.recv()
+                except (EOFError, OSError):
+                    # Caída del worker (p.ej. OOM killer): se informa y la próxima corrida lo relanza
+                    terminado = True
+                    exitcode = self._proc.exitcode if self._proc is not None else None
+                    self._descartar()
+                    yield ("error", {"code": "WORKER_DIED",
+                                     "message": f"El proceso worker terminó inesperadamente (exitcode={exitcode})."})
+                    return
+                if kind in ("done", "error"):
+                    terminado = True
+                yield (kind, payload)
+                if terminado:
+                    return
+        finally:
+            if not terminado:
+                # El cliente se fue a mitad de corrida: igual que en el hilo, la corrida se corta.
+                # El Pipe queda con mensajes de la corrida vieja, así que se descarta el worker.
+                self._descartar()
+            self._lock.release()
+
+    def _descartar(self) -> None:
+        if self._proc is not None and self._proc.is_alive():
+            self._proc.terminate()
+            self._proc.join(timeout=5)
+        self._proc = None
+        self._conn = None
+
+
+_worker: Optional[ComposicionWorker] = None
+
+
+def get_worker() -> ComposicionWorker:
+    global _worker
+    if _worker is None:
+        _worker = ComposicionWorker()
+    return _worker
+
+
+def shutdown_worker() -> None:
+    if _worker is not None:
+        _worker.stop()
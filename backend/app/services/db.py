@@ -1,8 +1,11 @@
 # backend/app/services/db.py
 from __future__ import annotations
-from typing import Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import Any, Dict, Optional, Tuple
 import os
 import json
+import threading
+import time
 
 from sqlalchemy import create_engine, text
 from sqlalchemy.engine import Engine
@@ -10,6 +13,7 @@ from sqlalchemy.engine import Engine
 from ..core.config import settings
 
 _engine: Optional[Engine] = None
+_engine_lock = threading.Lock()
 
 
 def _read_credentials_from_file(path: str) -> Tuple[Optional[str], Optional[str]]:
@@ -104,7 +108,7 @@ def _build_sqlalchemy_url() -> tuple[str, dict]:
     url = f"oracle+oracledb://{user}:{pwd}@{alias}"
 
     # Pasar TNS_ADMIN si está definido (igual que tu proceso de composición)
-    connect_args = {}
+    connect_args = {"stmtcachesize": settings.db_stmt_cache_size}
     tns_admin = settings.oracle_tns_admin or os.getenv("ORACLE_TNS_ADMIN")
     if tns_admin:
         connect_args["config_dir"] = tns_admin
@@ -117,23 +121,89 @@ def get_engine() -> Engine:
     if _engine is not None:
         return _engine
 
-    url, connect_args = _build_sqlalchemy_url()
-    _engine = create_engine(
-        url,
-        connect_args=connect_args,   # 🔧 importante para usar tnsnames.ora
-        pool_pre_ping=True,
-        pool_size=int(os.getenv("DB_POOL_SIZE", "5")),
-        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "5")),
-        future=True,
-    )
+    with _engine_lock:
+        if _engine is None:
+            url, connect_args = _build_sqlalchemy_url()
+            _engine = create_engine(
+                url,
+                connect_args=connect_args,   # 🔧 importante para usar tnsnames.ora
+                pool_pre_ping=True,
+                pool_size=settings.db_pool_size,
+                max_overflow=settings.db_max_overflow,
+                pool_timeout=settings.db_pool_timeout,
+                future=True,
+            )
     return _engine
 
 
 def dispose_engine() -> None:
     global _engine
-    if _engine is not None:
-        _engine.dispose()
-        _engine = None
+    with _engine_lock:
+        if _engine is not None:
+            _engine.dispose()
+            _engine = None
+
+
+def warmup_pool(size: Optional[int] = None) -> int:
+    """
+    Abre `size` conexiones (DB_POOL_SIZE por defecto) y las devuelve al pool, así el primer
+    pedido no paga credenciales + TNS + login. Devuelve cuántas se pudieron abrir.
+    """
+    size = settings.db_pool_size if size is None else size
+    eng = get_engine()
+    conns = []
+    try:
+        for _ in range(max(0, size)):
+            conns.append(eng.connect())
+    finally:
+        for c in conns:
+            c.close()
+    return len(conns)
+
+
+# Última espera medida para obtener una conexión del pool (readiness)
+_last_wait_ms: Optional[float] = None
+
+
+def pool_stats() -> Dict[str, Any]:
+    """Estado del pool: tamaño, en uso, overflow y la última espera medida. Vacío si no hay engine."""
+    if _engine is None:
+        return {}
+    pool = _engine.pool
+    stats: Dict[str, Any] = {"espera_ms": _last_wait_ms}
+    for key, attr in (("size", "size"), ("checked_in", "checkedin"), ("checked_out", "checkedout"), ("overflow", "overflow")):
+        fn = getattr(pool, attr, None)
+        if callable(fn):
+            stats[key] = fn()
+    return stats
+
+
+# Hilos propios para el chequeo: un Oracle colgado no bloquea al worker HTTP
+_ready_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="oracle-ready")
+
+
+def _probe_oracle() -> None:
+    global _last_wait_ms
+    eng = get_engine()
+    t0 = time.perf_counter()
+    with eng.connect() as conn:
+        _last_wait_ms = round((time.perf_counter() - t0) * 1000.0, 2)
+        conn.execute(text("SELECT 1 FROM DUAL"))
+
+
+def check_oracle_ready(timeout_seconds: float = 3) -> Tuple[bool, Optional[str]]:
+    """
+    Readiness: pide una conexión al pool y ejecuta SELECT 1 FROM DUAL con tope de tiempo.
+    Devuelve (ok, error).
+    """
+    fut = _ready_pool.submit(_probe_oracle)
+    try:
+        fut.result(timeout=timeout_seconds)
+        return True, None
+    except FutureTimeout:
+        return False, f"Oracle no respondió en {timeout_seconds}s"
+    except Exception as e:
+        return False, str(e)
 
 
 def quick_health_check() -> dict:
@@ -0,0 +1,136 @@
+# backend/app/services/trazabilidad/grafo.py
+"""
+Grafo de lotes que exporta cada corrida de composición (GRAFO_LOTES_DIR), mapeado en memoria.
+
+- Arrays CSR en .npy (ver composicion_enologica.armar_grafo): hacia atrás (orígenes de cada lote,
+  para la traza) y hacia adelante (en qué lotes terminó cada uno, para /descendientes).
+  Se abren con mmap: varios procesos del API comparten las mismas páginas y sólo se leen las que se tocan.
+- El archivo CURRENT dice qué carpeta grafo_<fecha> es la vigente. Se revisa como mucho cada
+  GRAFO_CHECK_SECONDS; si cambió se carga la versión nueva y se reemplaza la instantánea de una vez
+  (los pedidos en curso terminan con la anterior).
+- Sin GRAFO_LOTES_DIR, o si falta / no se puede leer, get() devuelve None y la traza consulta Oracle.
+"""
+from __future__ import annotations
+import json
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from ...core.config import settings
+
+GRAFO_VERSION = 1
+ARRAYS = (
+    "lotes", "atras_ptr", "destino", "origen", "cantidad", "mos_id", "fecha", "tipo",
+    "c_dorigen", "c_ddestino", "adelante_ptr", "adelante_arista",
+)
+
+
+class GrafoLotes:
+    def __init__(self, ruta: Path):
+        meta = json.loads((ruta / "meta.json").read_text(encoding="utf-8"))
+        if meta.get("version") != GRAFO_VERSION:
+            raise ValueError(f"versión de grafo {meta.get('version')} no soportada (se espera {GRAFO_VERSION})")
+        self.ruta = ruta
+        self.meta = meta
+        for nombre in ARRAYS:
+            setattr(self, nombre, np.load(ruta / f"{nombre}.npy", mmap_mode="r"))
+
+    @property
+    def version(self) -> str:
+        return self.ruta.name
+
+    def indice(self, c_lote: int) -> int:
+        """Posición del lote en `lotes` (-1 si el grafo no lo conoce)."""
+        i = int(np.searchsorted(self.lotes, c_lote))
+        return i if i < len(self.lotes) and int(self.lotes[i]) == c_lote else -1
+
+    def aristas_atras(self, c_lote: int) -> range:
+        i = self.indice(c_lote)
+        return range(int(self.atras_ptr[i]), int(self.atras_ptr[i + 1])) if i >= 0 else range(0)
+
+    def _mov(self, e: int) -> Dict[str, Any]:
+        """Arista como fila de `queries.fetch_movs_for_dests` (las descripciones de tanque salen de refdata)."""
+        o = int(self.origen[e])
+        f = self.fecha[e]
+        tipo, mos, dep_o, dep_d = int(self.tipo[e]), int(self.mos_id[e]), int(self.c_dorigen[e]), int(self.c_ddestino[e])
+        return {
+            "C_LOTE": int(self.lotes[int(self.destino[e])]),
+            "C_TIPO_COMPRO": tipo if tipo >= 0 else None,
+            "F_MOVIMIENTO": None if np.isnat(f) else f.astype(datetime),
+            "MOS_ID": mos if mos >= 0 else None,
+            "C_DORIGEN": dep_o if dep_o >= 0 else None, "D_DORIGEN": None,
+            "C_DDESTINO": dep_d if dep_d >= 0 else None, "D_DDESTINO": None,
+            "C_LOTE_ORIGEN": int(self.lotes[o]) if o >= 0 else None,
+            "VOL": float(self.cantidad[e]),
+        }
+
+    def movs_for_dests(self, lotes: List[int], hasta: Optional[datetime] = None) -> Dict[int, List[Dict[str, Any]]]:
+        """Mismo resultado que queries.fetch_movs_for_dests, sin ir a Oracle."""
+        out: Dict[int, List[Dict[str, Any]]] = {}
+        cota = np.datetime64(hasta, "s") if hasta is not None else None
+        for lote in lotes:
+            movs = [self._mov(e) for e in self.aristas_atras(lote) if cota is None or self.fecha[e] < cota]
+            if movs:
+                out[lote] = movs
+        return out
+
+    def descendientes(self, c_lote: int, max_depth: int) -> List[List[int]]:
+        """Lotes que recibieron del lote, por nivel (1..max_depth), cada uno una sola vez (CSR hacia adelante)."""
+        i = self.indice(c_lote)
+        if i < 0:
+            return []
+        visto = {i}
+        frontera = [i]
+        niveles: List[List[int]] = []
+        for _ in range(max_depth):
+            siguiente: List[int] = []
+            for j in frontera:
+                aristas = self.adelante_arista[int(self.adelante_ptr[j]):int(self.adelante_ptr[j + 1])]
+                for v in self.destino[aristas].tolist():
+                    if v not in visto:
+                        visto.add(v)
+                        siguiente.append(v)
+            if not siguiente:
+                break
+            niveles.append([int(self.lotes[v]) for v in siguiente])
+            frontera = siguiente
+        return niveles
+
+
+# ---------- instantánea global + cambio en caliente ----------
+_actual: Optional[GrafoLotes] = None
+_puntero: Optional[str] = None
+_revisado_en = 0.0
+_lock = threading.Lock()
+
+
+def get() -> Optional[GrafoLotes]:
+    """Grafo vigente, o None si no está configurado o no hay ninguno exportado."""
+    global _actual, _puntero, _revisado_en
+    directorio = settings.grafo_lotes_dir
+    if not directorio:
+        return None
+    ahora = time.monotonic()
+    if ahora - _revisado_en < settings.grafo_check_seconds:
+        return _actual
+    with _lock:
+        if ahora - _revisado_en < settings.grafo_check_seconds:
+            return _actual
+        _revisado_en = ahora
+        try:
+            puntero = (Path(directorio) / "CURRENT").read_text(encoding="utf-8").strip()
+        except OSError:
+            return _actual
+        if puntero != _puntero:
+            try:
+                _actual = GrafoLotes(Path(directorio) / puntero)
+                _puntero = puntero
+                print(f"[GRAFO] versión {puntero}: {len(_actual.lotes)} lotes, {len(_actual.destino)} aristas")
+            except Exception as e:
+                # Se conserva la versión anterior (si había)
+                print(f"[GRAFO][WARN] no se pudo cargar {puntero}: {e}")
+    return _actual
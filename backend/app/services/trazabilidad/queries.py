@@ -0,0 +1,320 @@
+# backend/app/services/trazabilidad/queries.py
+"""
+Consultas Oracle de la trazabilidad.
+
+- Cada sentencia se construye una sola vez (lru_cache) y se reutiliza en todos los pedidos.
+- Con `hasta` (trazas a una fecha, as_of) se filtra F_MOVIMIENTO < hasta, que usa el índice
+  (C_LOTE, F_MOVIMIENTO) que crea la corrida de composición sobre APX_TRAZA_DETALLE.
+- Las listas IN se rellenan hasta un tamaño de "bucket" (1, 2, 4, ... ORACLE_IN_CLAUSE_LIMIT):
+  así Oracle y el statement cache del driver ven pocas formas de SQL distintas
+  en lugar de una por cada cantidad de lotes.
+"""
+from __future__ import annotations
+from datetime import datetime
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional, Sequence
+
+from sqlalchemy import text, bindparam
+from sqlalchemy.sql.elements import TextClause
+
+from ...core.config import settings
+from ...utils.rows import normalize_list_upper, normalize_keys_upper
+from ...utils.convert import to_float, to_int, to_iso
+
+if TYPE_CHECKING:
+    from .refdata import RefData
+
+TIPO_MAP: Dict[int, str] = {
+    13: "Compra",
+    28: "Descube",
+    31: "Ajuste",
+    95: "Ajuste",
+    43: "Transformación",
+    30: "Transformación",
+    46: "Transformación",
+}
+
+
+def tq(table_name: str) -> str:
+    schema = getattr(settings, "db_schema", None) or settings.__dict__.get("db_schema")
+    return f"{schema}.{table_name}" if schema else table_name
+
+
+# Cota superior de fecha como texto: TO_DATE sobre el bind compara DATE con DATE
+# (un bind TIMESTAMP convertiría la columna y Oracle no usaría el índice).
+FORMATO_HASTA = "%Y-%m-%d %H:%M:%S"
+_HASTA_SQL = "TO_DATE(:hasta, 'YYYY-MM-DD HH24:MI:SS')"
+
+
+def tipo_legible(c_tipo: Optional[int]) -> str:
+    try:
+        return TIPO_MAP.get(int(c_tipo)) if c_tipo is not None else "Movimiento"
+    except Exception:
+        return "Movimiento"
+
+
+# ---------- forma de los binds ----------
+def _in_limit() -> int:
+    return max(1, int(settings.oracle_in_clause_limit))
+
+
+def in_chunks(values: Sequence[int]) -> Iterator[List[int]]:
+    """Parte una lista de lotes respetando ORACLE_IN_CLAUSE_LIMIT."""
+    size = _in_limit()
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def bind_bucket(n: int) -> int:
+    """Menor potencia de 2 >= n, acotada por ORACLE_IN_CLAUSE_LIMIT."""
+    limit = _in_limit()
+    size = 1
+    while size < n and size < limit:
+        size *= 2
+    return min(size, limit)
+
+
+def padded(values: List[int]) -> List[int]:
+    """Rellena repitiendo el último valor hasta el tamaño de bucket (no altera el resultado del IN)."""
+    if not values:
+        return values
+    return values + [values[-1]] * (bind_bucket(len(values)) - len(values))
+
+
+# ---------- sentencias (construidas una vez) ----------
+@lru_cache(maxsize=None)
+def _stmt(key: str) -> TextClause:
+    if key.startswith("table_exists_"):
+        return text(f"SELECT 1 FROM {tq(key[len('table_exists_'):])} WHERE 1=0")
+    if key == "lotes_stock_all":
+        return text(f"SELECT C_LOTE, D_LOTE FROM {tq('LOTES_STOCK')}")
+    if key == "generacion":
+        return text(f"SELECT MAX(GENERACION) FROM {tq('APX_TRAZA_GENERACION')}")
+    if key == "depositos_all":
+        return text(f"SELECT C_DEPOSITO, D_DEPOSITO FROM {tq('DEPOSITOS')}")
+    if key == "lote_info":
+        return text(f"""
+            SELECT C_LOTE, D_LOTE
+            FROM {tq("LOTES_STOCK")}
+            WHERE C_LOTE = :c_lote
+        """)
+    if key == "lotes_info":
+        return text(f"""
+            SELECT C_LOTE, D_LOTE
+            FROM {tq("LOTES_STOCK")}
+            WHERE C_LOTE IN :lotes
+        """).bindparams(bindparam("lotes", expanding=True))
+    if key in ("movs_for_dests", "movs_for_dests_hasta"):
+        hasta = f"AND F_MOVIMIENTO < {_HASTA_SQL}" if key.endswith("_hasta") else ""
+        return text(f"""
+            SELECT
+                C_LOTE,
+                C_TIPO_COMPRO,
+                F_MOVIMIENTO,
+                MOS_ID,
+                C_DORIGEN, D_DORIGEN,
+                C_DDESTINO, D_DDESTINO,
+                C_LOTE_ORIGEN,
+                CANTIDAD AS VOL
+            FROM {tq("APX_TRAZA_DETALLE")}
+            WHERE C_LOTE IN :lotes {hasta}
+            ORDER BY C_LOTE ASC, F_MOVIMIENTO ASC, MOS_ID ASC
+        """).bindparams(bindparam("lotes", expanding=True))
+    if key == "lotes_destino":
+        # Hacia adelante: en qué lotes terminó cada origen (índice IX_APX_TRAZA_DET_ORIGEN)
+        return text(f"""
+            SELECT DISTINCT C_LOTE_ORIGEN, C_LOTE
+            FROM {tq("APX_TRAZA_DETALLE")}
+            WHERE C_LOTE_ORIGEN IN :lotes
+            ORDER BY C_LOTE_ORIGEN ASC, C_LOTE ASC
+        """).bindparams(bindparam("lotes", expanding=True))
+    if key == "sum_destinos_finales":
+        return text(f"""
+            SELECT COALESCE(SUM(CANTIDAD_USADA), 0)
+            FROM {tq("APX_TRAZA_DESTINO_FINAL")}
+            WHERE C_LOTE = :c_lote
+        """)
+    if key == "destinos_finales":
+        return text(f"""
+            SELECT C_LOTE, TIPO_DESTINO, CANTIDAD_USADA, F_MOVIMIENTO_DESTINO, MOS_ID_DESTINO
+            FROM {tq("APX_TRAZA_DESTINO_FINAL")}
+            WHERE C_LOTE IN :lotes
+            ORDER BY C_LOTE ASC, F_MOVIMIENTO_DESTINO ASC, MOS_ID_DESTINO ASC
+        """).bindparams(bindparam("lotes", expanding=True))
+    if key == "composicion_resumen":
+        return text(f"""
+            SELECT C_VARIEDAD_INV, C_PERIODO, ID_SUBVALLE, CANTIDAD, PORCENTAJE
+            FROM {tq("APX_TRAZA_COMPOSICION_RESUMEN")}
+            WHERE C_LOTE = :c_lote
+            ORDER BY CANTIDAD DESC
+        """)
+    if key == "aportes_hasta":
+        # Lo que recibió cada lote hasta la fecha, por movimiento y componente (composición a fecha)
+        return text(f"""
+            SELECT C_LOTE, C_LOTE_ORIGEN, F_MOVIMIENTO, C_VARIEDAD_INV, C_PERIODO, ID_SUBVALLE,
+                   SUM(CANTIDAD) AS CANTIDAD
+            FROM {tq("APX_TRAZA_DETALLE")}
+            WHERE C_LOTE IN :lotes AND F_MOVIMIENTO < {_HASTA_SQL}
+            GROUP BY C_LOTE, C_LOTE_ORIGEN, F_MOVIMIENTO, C_VARIEDAD_INV, C_PERIODO, ID_SUBVALLE
+            ORDER BY C_LOTE ASC, F_MOVIMIENTO ASC
+        """).bindparams(bindparam("lotes", expanding=True))
+    raise KeyError(key)
+
+
+def stmt(key: str) -> TextClause:
+    return _stmt(key)
+
+
+# ---------- lecturas ----------
+# `ref` es la instantánea de datos de referencia (refdata); si viene, evita las sondas
+# de tablas y las lecturas de LOTES_STOCK para los lotes que ya conoce.
+def probe_table(conn, name: str) -> bool:
+    try:
+        conn.execute(_stmt(f"table_exists_{name}"))
+        return True
+    except Exception:
+        return False
+
+
+def table_exists(conn, name: str, ref: Optional["RefData"] = None) -> bool:
+    if ref is not None and name in ref.tablas:
+        return True
+    return probe_table(conn, name)
+
+
+def fetch_lote_info(conn, c_lote_num: int, ref: Optional["RefData"] = None) -> Dict[str, Any]:
+    if ref is not None and ref.tiene_lote(c_lote_num):
+        return {"C_LOTE": str(c_lote_num), "D_LOTE": ref.d_lote(c_lote_num)}
+    if not table_exists(conn, "LOTES_STOCK", ref):
+        return {"C_LOTE": str(c_lote_num), "D_LOTE": None}
+    row = conn.execute(_stmt("lote_info"), {"c_lote": c_lote_num}).mappings().fetchone()
+    if not row:
+        return {"C_LOTE": str(c_lote_num), "D_LOTE": None}
+    d = normalize_keys_upper(row)
+    d["C_LOTE"] = str(d.get("C_LOTE")) if d.get("C_LOTE") is not None else None
+    return d
+
+
+def fetch_lotes_info(conn, lotes: List[int], ref: Optional["RefData"] = None) -> Dict[int, Optional[str]]:
+    """C_LOTE -> D_LOTE para un bloque de lotes (sólo se consultan los que no están en `ref`)."""
+    out: Dict[int, Optional[str]] = {}
+    faltan = sorted(set(lotes))
+    if ref is not None:
+        faltan = [c for c in faltan if not ref.tiene_lote(c)]
+        out.update({c: ref.d_lote(c) for c in set(lotes) if ref.tiene_lote(c)})
+    if not faltan or not table_exists(conn, "LOTES_STOCK", ref):
+        return out
+    for chunk in in_chunks(faltan):
+        for r in normalize_list_upper(conn.execute(_stmt("lotes_info"), {"lotes": padded(chunk)}).mappings().all()):
+            out[to_int(r.get("C_LOTE"))] = r.get("D_LOTE")
+    return out
+
+
+def fetch_movs_for_dests(conn, lotes: List[int], hasta: Optional[datetime] = None) -> Dict[int, List[Dict[str, Any]]]:
+    """
+    Movimientos donde los lotes aparecen como DESTINO → orígenes directos, para un bloque
+    de lotes en una sola consulta. Devuelve {C_LOTE: movimientos} ordenados por (F_MOVIMIENTO, MOS_ID).
+    Con `hasta`, sólo los movimientos con F_MOVIMIENTO < hasta.
+    Volumen: CANTIDAD (NUMBER(15,5))
+    """
+    out: Dict[int, List[Dict[str, Any]]] = {}
+    if not lotes:
+        return out
+    params: Dict[str, Any] = {"lotes": padded(list(lotes))}
+    if hasta is not None:
+        params["hasta"] = hasta.strftime(FORMATO_HASTA)
+    rows = normalize_list_upper(conn.execute(_stmt("movs_for_dests_hasta" if hasta is not None else "movs_for_dests"), params).mappings().all())
+    for d in rows:
+        d["VOL"] = to_float(d.get("VOL"))
+        out.setdefault(to_int(d.get("C_LOTE")), []).append(d)
+    return out
+
+
+def fetch_lotes_destino(conn, lotes: List[int]) -> Dict[int, List[int]]:
+    """C_LOTE_ORIGEN -> lotes que recibieron de él (sin repetir, ordenados), para un bloque de lotes."""
+    out: Dict[int, List[int]] = {}
+    if not lotes:
+        return out
+    for r in normalize_list_upper(conn.execute(_stmt("lotes_destino"), {"lotes": padded(list(lotes))}).mappings().all()):
+        out.setdefault(to_int(r.get("C_LOTE_ORIGEN")), []).append(to_int(r.get("C_LOTE")))
+    return out
+
+
+def sum_destinos_finales(conn, c_lote_num: int, ref: Optional["RefData"] = None) -> float:
+    if not table_exists(conn, "APX_TRAZA_DESTINO_FINAL", ref):
+        return 0.0
+    val = conn.execute(_stmt("sum_destinos_finales"), {"c_lote": c_lote_num}).scalar()
+    return to_float(val)
+
+
+def fetch_destinos_finales(conn, lotes: List[int], ref: Optional["RefData"] = None) -> Dict[int, List[Dict[str, Any]]]:
+    """
+    Destinos finales (PRODUCCION / CONCENTRACION / DESPACHADO) de un conjunto de lotes.
+    Una consulta por bloque de ORACLE_IN_CLAUSE_LIMIT lotes; se agrupa en memoria por C_LOTE.
+    """
+    out: Dict[int, List[Dict[str, Any]]] = {}
+    if not lotes or not table_exists(conn, "APX_TRAZA_DESTINO_FINAL", ref):
+        return out
+    for chunk in in_chunks(sorted(set(lotes))):
+        rows = normalize_list_upper(conn.execute(_stmt("destinos_finales"), {"lotes": padded(chunk)}).mappings().all())
+        for r in rows:
+            lote = to_int(r.get("C_LOTE"))
+            out.setdefault(lote, []).append({
+                "c_lote": str(lote),
+                "fecha": to_iso(r.get("F_MOVIMIENTO_DESTINO")),
+                "destino": r.get("TIPO_DESTINO"),
+                "volumen_lts": to_float(r.get("CANTIDAD_USADA")),
+                "mos_id_destino": to_int(r.get("MOS_ID_DESTINO")),
+                "guia": None,
+                "fel": None,
+            })
+    return out
+
+
+def fetch_composicion_resumen(conn, c_lote_num: int) -> List[Dict[str, Any]]:
+    """
+    Una sola lectura indexada (IX_APX_TRAZA_COMP_RES_LOTE) sobre el resumen por lote.
+    """
+    rows = normalize_list_upper(conn.execute(_stmt("composicion_resumen"), {"c_lote": c_lote_num}).mappings().all())
+    return _componentes(rows)
+
+
+def fetch_aportes_hasta(conn, lotes: List[int], hasta: datetime) -> Dict[int, List[Dict[str, Any]]]:
+    """
+    Filas de APX_TRAZA_DETALLE de un bloque de lotes anteriores a `hasta` (rango sobre el índice
+    (C_LOTE, F_MOVIMIENTO)), sumadas por movimiento y componente: {C_LOTE: filas por fecha}.
+    Las de una transformación traen C_LOTE_ORIGEN.
+    """
+    out: Dict[int, List[Dict[str, Any]]] = {}
+    if not lotes:
+        return out
+    params = {"lotes": padded(list(lotes)), "hasta": hasta.strftime(FORMATO_HASTA)}
+    for r in normalize_list_upper(conn.execute(_stmt("aportes_hasta"), params).mappings().all()):
+        r["CANTIDAD"] = to_float(r.get("CANTIDAD"))
+        out.setdefault(to_int(r.get("C_LOTE")), []).append(r)
+    return out
+
+
+def componentes_de(lts: Dict[Any, float]) -> List[Dict[str, Any]]:
+    """{(C_VARIEDAD_INV, C_PERIODO, ID_SUBVALLE): lts} -> componentes con porcentaje, de mayor a menor."""
+    total = sum(lts.values())
+    rows = [
+        {"C_VARIEDAD_INV": var, "C_PERIODO": per, "ID_SUBVALLE": sub, "CANTIDAD": v,
+         "PORCENTAJE": round(v / total * 100.0, 4) if total > 0 else None}
+        for (var, per, sub), v in sorted(lts.items(), key=lambda kv: -kv[1])
+    ]
+    return _componentes(rows)
+
+
+def _componentes(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [
+        {
+            "c_variedad_inv": r.get("C_VARIEDAD_INV"),
+            "c_periodo": to_int(r.get("C_PERIODO")),
+            "id_subvalle": r.get("ID_SUBVALLE"),
+            "lts": to_float(r.get("CANTIDAD")),
+            "pct": to_float(r.get("PORCENTAJE")) if r.get("PORCENTAJE") is not None else None,
+        }
+        for r in rows
+    ]
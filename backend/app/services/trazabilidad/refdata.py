@@ -0,0 +1,185 @@
+# backend/app/services/trazabilidad/refdata.py
+"""
+Datos de referencia de la trazabilidad, cacheados en memoria del API.
+
+- Tablas existentes (APX_TRAZA_*, LOTES_STOCK, DEPOSITOS): evita las sondas por pedido.
+- C_LOTE -> D_LOTE (LOTES_STOCK) en arrays ordenados (numpy) con búsqueda binaria.
+- C_DEPOSITO -> D_DEPOSITO (DEPOSITOS) en un dict (pocas filas).
+- Generación de la composición (APX_TRAZA_GENERACION). Para el ETag de las trazas no se usa
+  la de la instantánea sino generacion(), que la relee cada TRACE_GENERACION_CHECK_SECONDS.
+
+Se carga al iniciar el API (TRACE_MODE=real), se refresca cada REFDATA_REFRESH_SECONDS
+y al terminar una corrida de composición. Cada carga arma una instantánea nueva
+que reemplaza a la anterior de una sola vez: los lectores nunca ven una a medio armar.
+"""
+from __future__ import annotations
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, FrozenSet, Optional
+
+import numpy as np
+
+from ...core.config import settings
+from ...utils.convert import to_int
+from .. import db
+from . import queries
+
+TABLAS_REFERENCIA = (
+    "APX_TRAZA_DETALLE",
+    "APX_TRAZA_DESTINO_FINAL",
+    "APX_TRAZA_COMPOSICION_RESUMEN",
+    "LOTES_STOCK",
+    "DEPOSITOS",
+    "APX_TRAZA_GENERACION",
+)
+
+
+@dataclass(frozen=True)
+class RefData:
+    tablas: FrozenSet[str] = frozenset()
+    lotes_c: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.int64))
+    lotes_d: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=object))
+    depositos: Dict[int, str] = field(default_factory=dict)
+    generacion: Optional[int] = None
+    cargado_en: float = 0.0
+
+    def d_lote(self, c_lote: int) -> Optional[str]:
+        """D_LOTE del lote, o None si no está en la instantánea."""
+        i = int(np.searchsorted(self.lotes_c, c_lote))
+        if i < len(self.lotes_c) and self.lotes_c[i] == c_lote:
+            return self.lotes_d[i]
+        return None
+
+    def tiene_lote(self, c_lote: int) -> bool:
+        i = int(np.searchsorted(self.lotes_c, c_lote))
+        return i < len(self.lotes_c) and self.lotes_c[i] == c_lote
+
+
+def cargar(engine=None) -> RefData:
+    """Lee las tablas de referencia (una consulta por fuente) y arma una instantánea."""
+    engine = engine or db.get_engine()
+    with engine.connect() as conn:
+        tablas = frozenset(t for t in TABLAS_REFERENCIA if queries.probe_table(conn, t))
+
+        lotes_c = np.empty(0, dtype=np.int64)
+        lotes_d = np.empty(0, dtype=object)
+        if "LOTES_STOCK" in tablas:
+            rows = conn.execute(queries.stmt("lotes_stock_all")).all()
+            pares = [(to_int(c), d) for c, d in rows if to_int(c) is not None]
+            if pares:
+                lotes_c = np.fromiter((c for c, _ in pares), dtype=np.int64, count=len(pares))
+                lotes_d = np.array([d for _, d in pares], dtype=object)
+                orden = np.argsort(lotes_c, kind="stable")
+                lotes_c, lotes_d = lotes_c[orden], lotes_d[orden]
+
+        depositos: Dict[int, str] = {}
+        if "DEPOSITOS" in tablas:
+            for c, d in conn.execute(queries.stmt("depositos_all")).all():
+                c_int = to_int(c)
+                if c_int is not None and d is not None:
+                    depositos[c_int] = str(d)
+
+        generacion = None
+        if "APX_TRAZA_GENERACION" in tablas:
+            generacion = to_int(conn.execute(queries.stmt("generacion")).scalar())
+
+    return RefData(tablas=tablas, lotes_c=lotes_c, lotes_d=lotes_d, depositos=depositos,
+                   generacion=generacion, cargado_en=time.time())
+
+
+# ---------- instantánea global + refresco ----------
+_actual: Optional[RefData] = None
+_lock = threading.Lock()
+_despertar = threading.Event()
+_detener = threading.Event()
+_hilo: Optional[threading.Thread] = None
+
+
+def get() -> Optional[RefData]:
+    """Instantánea vigente, o None si todavía no se cargó (se consulta Oracle como antes)."""
+    return _actual
+
+
+def refrescar() -> Optional[RefData]:
+    global _actual
+    with _lock:
+        try:
+            _actual = cargar()
+            print(f"[REFDATA] {len(_actual.lotes_c)} lotes, {len(_actual.depositos)} depósitos, tablas={sorted(_actual.tablas)}")
+        except Exception as e:
+            # Se conserva la instantánea anterior: mejor datos algo viejos que ninguno.
+            print(f"[REFDATA][WARN] no se pudo refrescar: {e}")
+    return _actual
+
+
+# ---------- generación vigente (ETag) ----------
+_generacion: Optional[int] = None
+_generacion_revisada_en = 0.0
+_generacion_lock = threading.Lock()
+
+
+def generacion() -> Optional[int]:
+    """
+    Generación de la composición en Oracle, releída como mucho cada TRACE_GENERACION_CHECK_SECONDS.
+    No depende de la instantánea: una corrida lanzada desde la CLI, otro worker u otro host cambia
+    el ETag a los pocos segundos (y pide un refresco de la instantánea). None si no se pudo leer.
+    """
+    global _generacion, _generacion_revisada_en
+    ahora = time.monotonic()
+    if ahora - _generacion_revisada_en < settings.trace_generacion_check_seconds:
+        return _generacion
+    with _generacion_lock:
+        if ahora - _generacion_revisada_en < settings.trace_generacion_check_seconds:
+            return _generacion
+        try:
+            with db.get_engine().connect() as conn:
+                gen = to_int(conn.execute(queries.stmt("generacion")).scalar())
+        except Exception:
+            # Sin APX_TRAZA_GENERACION (o sin base) no hay versión confiable: sin ETag
+            gen = None
+        _generacion, _generacion_revisada_en = gen, ahora
+    ref = _actual
+    if gen is not None and ref is not None and ref.generacion != gen:
+        pedir_refresco()
+    return gen
+
+
+def pedir_refresco() -> None:
+    """Pide un refresco (p.ej. al terminar una corrida de composición) sin bloquear al llamador."""
+    if _hilo is not None and _hilo.is_alive():
+        _despertar.set()
+
+
+def _bucle(intervalo: float) -> None:
+    refrescar()
+    while not _detener.is_set():
+        _despertar.wait(timeout=intervalo if intervalo > 0 else None)
+        if _detener.is_set():
+            break
+        _despertar.clear()
+        refrescar()
+
+
+def iniciar() -> None:
+    """
+    Arranca el hilo que hace la carga inicial y los refrescos (REFDATA_REFRESH_SECONDS; 0 = sólo bajo pedido).
+    La carga inicial no bloquea el arranque del API: hasta que termine se consulta Oracle como antes.
+    """
+    global _hilo
+    if _hilo is not None and _hilo.is_alive():
+        return
+    _detener.clear()
+    _hilo = threading.Thread(
+        target=_bucle, args=(float(settings.refdata_refresh_seconds),), name="refdata", daemon=True
+    )
+    _hilo.start()
+
+
+def detener() -> None:
+    global _hilo
+    _detener.set()
+    _despertar.set()
+    if _hilo is not None:
+        _hilo.join(timeout=5)
+    _hilo = None
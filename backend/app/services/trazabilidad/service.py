@@ -1,15 +1,25 @@
 # backend/app/services/trazabilidad/service.py
 from __future__ import annotations
 from dataclasses import dataclass
-from typing import List, Optional, Tuple, Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterator, List, Optional, Set, Tuple, Dict
 import re
-from datetime import datetime
+import threading
+from datetime import date, datetime, time, timedelta
 
 from ...core.config import settings
 from ...models.schemas import (
     TraceResponse, TraceIdentification, TraceKPIs, TraceBalance,
-    TraceOriginNode, TraceTimelineEvent, TraceDestination
+    TraceOriginNode, TraceTimelineEvent, TraceDestination,
+    TraceComposicionResponse, TraceComposicionItem,
+    TraceBatchResponse, TraceBatchLote, TraceEdge,
+    TraceChildrenResponse, TraceChildNode,
+    TraceDescendientesResponse, TraceDescendientesNivel,
 )
+from ...utils.convert import to_datetime, to_float, to_int, to_iso
+from .. import db
+from . import grafo as grafo_lotes, queries, refdata
+from .refdata import RefData
 
 
 OT_PATTERN = re.compile(r"(?:\bOT[:\s\-]*)(\d+)", re.IGNORECASE)
@@ -26,6 +36,11 @@ def _round(x: Optional[float]) -> Optional[float]:
     return None if x is None else round(float(x), 3)
 
 
+def _hasta(as_of: Optional[date]) -> Optional[datetime]:
+    """Cota exclusiva de una consulta a fecha: el día `as_of` completo."""
+    return datetime.combine(as_of, time()) + timedelta(days=1) if as_of is not None else None
+
+
 @dataclass
 class TraceQuery:
     c_lote: str
@@ -33,6 +48,68 @@ class TraceQuery:
     include_timeline: bool = False
     include_destinos: bool = False
     tolerance: float = 0.005
+    destinos_alcance: str = "raiz"
+    as_of: Optional[date] = None
+
+
+class TraceError(Exception):
+    """Error de la traza con el status HTTP que le corresponde."""
+    status_code = 500
+
+
+class TraceInputError(TraceError):
+    status_code = 422
+
+
+class TraceUnavailableError(TraceError):
+    status_code = 501
+
+
+def _iter_records(resp: TraceResponse) -> Iterator[Dict[str, Any]]:
+    """
+    Registros NDJSON a partir de una traza ya armada:
+    identificación, un registro por nivel y el resumen final.
+    """
+    ident = resp.identificacion.model_dump()
+    yield {
+        "tipo": "identificacion",
+        "identificacion": {k: v for k, v in ident.items() if k not in ("fecha_inicio", "fecha_fin")},
+    }
+    por_nivel: Dict[int, List[Dict[str, Any]]] = {}
+    for n in resp.origenes:
+        por_nivel.setdefault(n.nivel, []).append(n.model_dump())
+    for nivel in sorted(por_nivel):
+        yield {"tipo": "nivel", "nivel": nivel, "nodos": por_nivel[nivel]}
+    yield {
+        "tipo": "resumen",
+        "identificacion": {"fecha_inicio": ident.get("fecha_inicio"), "fecha_fin": ident.get("fecha_fin")},
+        "kpis": resp.kpis.model_dump(),
+        "balance": resp.balance.model_dump(),
+        "timeline": [t.model_dump() for t in (resp.timeline or [])],
+        "destinos": [d.model_dump() for d in (resp.destinos or [])],
+        "total_nodos": len(resp.origenes),
+    }
+
+
+def _resumen_subarbol(grafo: Dict[str, List[TraceEdge]], root: str, max_depth: int) -> Dict[str, int]:
+    """Recorre en memoria el subárbol de un lote dentro del grafo compartido."""
+    seen: Set[str] = {root}
+    frontier = [root]
+    nodos = 0
+    profundidad = 0
+    for nivel in range(1, max_depth + 1):
+        siguiente: List[str] = []
+        for lote in frontier:
+            for e in grafo.get(lote, []):
+                nodos += 1
+                profundidad = nivel
+                if e.c_lote_origen is not None and e.c_lote_origen not in seen:
+                    seen.add(e.c_lote_origen)
+                    siguiente.append(e.c_lote_origen)
+        frontier = siguiente
+        if not frontier:
+            break
+    return {"nodos": nodos, "profundidad": profundidad, "lotes_alcanzados": len(seen) - 1}
 
 
 class FakeTraceRepository:
@@ -50,6 +127,7 @@ class FakeTraceRepository:
             fecha_fin="2025-03-15",
             tanque_actual="LO364",
             origen_consulta="C_LOTE",
+            as_of=q.as_of.isoformat() if q.as_of else None,
         )
         kpis = TraceKPIs(
             lts_destino=261735.0,
@@ -104,6 +182,9 @@ class FakeTraceRepository:
             ),
         ]
 
+        if q.as_of is not None:
+            origenes = [n for n in origenes if not n.fecha or n.fecha <= q.as_of.isoformat()]
+
         # Balance
         lts_origenes = 270000.0
         lts_destino = 261735.0
@@ -133,9 +214,12 @@ class FakeTraceRepository:
                 TraceTimelineEvent(fecha="2025-03-10", tipo="TRANSFORMACION", ot="OT:8650", volumen_lts=175000.0),
                 TraceTimelineEvent(fecha="2025-03-15", tipo="TRANSFORMACION", ot="OT:8700", volumen_lts=261735.0),
             ]
+            if q.as_of is not None:
+                timeline = [t for t in timeline if t.fecha <= q.as_of.isoformat()]
         if q.include_destinos:
             destinos = [
-                TraceDestination(fecha="2025-03-20", destino="Envasado", volumen_lts=120000.0, guia="G-4567", fel="15852")
+                TraceDestination(fecha="2025-03-20", destino="Envasado", volumen_lts=120000.0, guia="G-4567", fel="15852",
+                                 c_lote=q.c_lote)
             ]
 
         return TraceResponse(
@@ -147,33 +231,699 @@ class FakeTraceRepository:
             destinos=destinos,
         )
 
+    def iter_trace_by_lote(self, q: TraceQuery) -> Iterator[Dict[str, Any]]:
+        return _iter_records(self.trace_by_lote(q))
+
+    def composicion_by_lote(self, c_lote: str, as_of: Optional[date] = None) -> TraceComposicionResponse:
+        componentes = [
+            TraceComposicionItem(c_variedad_inv="MALBEC", c_periodo=2024, id_subvalle="VU", lts=180000.0, pct=68.77),
+            TraceComposicionItem(c_variedad_inv="CABERNET SAUVIGNON", c_periodo=2024, id_subvalle="VU", lts=81735.0, pct=31.23),
+        ]
+        return TraceComposicionResponse(c_lote=c_lote, as_of=as_of.isoformat() if as_of else None,
+                                        lts_total=261735.0, componentes=componentes)
+
+    def children_by_lote(self, c_lote: str, node: Optional[str], nivel: int, as_of: Optional[date] = None,
+                         hasta: Optional[datetime] = None) -> TraceChildrenResponse:
+        # En el modo fake los nodos no tienen lote origen: se expande por node_id
+        nodos = self.trace_by_lote(TraceQuery(c_lote=c_lote, max_depth=20, as_of=as_of)).origenes
+        padre = node or "N0"
+        hijos = [n for n in nodos if n.parent_id == padre]
+        return TraceChildrenResponse(
+            c_lote=c_lote, node=padre, nivel=nivel, as_of=as_of.isoformat() if as_of else None,
+            children=[
+                TraceChildNode(**{**n.model_dump(), "c_lote_origen": n.node_id},
+                               n_children=sum(1 for x in nodos if x.parent_id == n.node_id))
+                for n in hijos
+            ],
+        )
+
+    def descendientes_by_lote(self, c_lote: str, max_depth: int) -> TraceDescendientesResponse:
+        niveles = [[f"{c_lote}-D1", f"{c_lote}-D2"], [f"{c_lote}-D1-1"]][:max_depth]
+        return TraceDescendientesResponse(
+            c_lote=c_lote, total_lotes=sum(len(n) for n in niveles), fuente="fake",
+            niveles=[TraceDescendientesNivel(nivel=i, lotes=n) for i, n in enumerate(niveles, start=1)],
+        )
+
+    def trace_batch(self, lotes: List[str], max_depth: int, include_destinos: bool) -> TraceBatchResponse:
+        grafo: Dict[str, List[TraceEdge]] = {}
+        destinos: Dict[str, List[TraceDestination]] = {}
+        roots = list(dict.fromkeys(lotes))
+        for c in roots:
+            resp = self.trace_by_lote(TraceQuery(c_lote=c, max_depth=max_depth, include_destinos=include_destinos))
+            grafo[c] = [
+                TraceEdge(tipo=n.tipo, fecha=n.fecha, ot=n.ot, tk_origen=n.tk_origen, tk_destino=n.tk_destino,
+                          lts=n.lts_in or 0.0, contrib_pct=n.contrib_pct)
+                for n in resp.origenes if n.nivel == 1
+            ]
+            if include_destinos:
+                destinos[c] = resp.destinos or []
+        return TraceBatchResponse(
+            lotes=[
+                TraceBatchLote(c_lote=c, lts_origenes=sum(e.lts for e in grafo[c]), subarbol=c,
+                               **_resumen_subarbol(grafo, c, max_depth))
+                for c in roots
+            ],
+            grafo=grafo,
+            destinos=destinos,
+            stats={"niveles": 1, "consultas": 0, "lotes_consultados": len(grafo)},
+        )
+
 
 class RealTraceRepository:
     """
-    Esqueleto del repositorio real.
-    Aquí conectaremos a Oracle y armaremos la traza por capas (nivel N -> N+1).
+    Repositorio real contra Oracle (APX_TRAZA_DETALLE, LOTES_STOCK, APX_TRAZA_DESTINO_FINAL,
+    APX_TRAZA_COMPOSICION_RESUMEN). Arma la traza por capas (nivel N -> N+1) con una
+    consulta IN por bloque de lotes; las sentencias viven en `queries` y se reutilizan.
     """
+    def __init__(self, engine_factory: Optional[Callable[[], Any]] = None):
+        self._engine_factory = engine_factory or (lambda: db.get_engine())
+
+    # ---------- helpers ----------
+    @staticmethod
+    def _lote_num(c_lote: str) -> int:
+        n = to_int(c_lote)
+        if n is None:
+            raise TraceInputError("c_lote debe ser numérico (NUMBER).")
+        return n
+
+    @staticmethod
+    def _require_detalle(conn, ref: Optional[RefData]) -> None:
+        if not queries.table_exists(conn, "APX_TRAZA_DETALLE", ref):
+            raise TraceUnavailableError(f"No existe la tabla {queries.tq('APX_TRAZA_DETALLE')}.")
+
+    @staticmethod
+    def _deposito(ref: Optional[RefData], c_dep: Any, d_dep: Any) -> Any:
+        """Nombre del tanque: D_* del detalle, si falta el de DEPOSITOS (refdata), y si no el código."""
+        if d_dep:
+            return d_dep
+        if ref is not None and c_dep is not None:
+            return ref.depositos.get(to_int(c_dep), c_dep)
+        return c_dep
+
+    @classmethod
+    def _node(cls, node_id: str, parent_id: Optional[str], nivel: int, c_lote: int, m: Optional[Dict[str, Any]] = None,
+              contrib: Optional[float] = None, ref: Optional[RefData] = None) -> Dict[str, Any]:
+        """Nodo con las claves de TraceOriginNode (dict plano, también usado por el stream NDJSON)."""
+        if m is None:
+            tipo, fecha, ot, tk_o, tk_d, lts, origen = "Lote", None, None, None, None, None, None
+        else:
+            tipo = queries.tipo_legible(m.get("C_TIPO_COMPRO"))
+            fecha = to_iso(m.get("F_MOVIMIENTO"))
+            ot = m.get("MOS_ID")
+            tk_o = cls._deposito(ref, m.get("C_DORIGEN"), m.get("D_DORIGEN"))
+            tk_d = cls._deposito(ref, m.get("C_DDESTINO"), m.get("D_DDESTINO"))
+            lts = to_float(m.get("VOL"))
+            origen = to_int(m.get("C_LOTE_ORIGEN"))
+        return {
+            "node_id": node_id,
+            "parent_id": parent_id,
+            "nivel": nivel,
+            "tipo": tipo,
+            "fecha": fecha,
+            "ot": str(ot) if ot is not None else None,
+            "tk_origen": str(tk_o) if tk_o is not None else None,
+            "tk_destino": str(tk_d) if tk_d is not None else None,
+            "lts_in": lts,
+            "lts_out": lts,
+            "kg_in": None,
+            "kg_out": None,
+            "merma_lts": None,
+            "borra_lts": None,
+            "otros_uso_lts": None,
+            "contrib_pct": contrib,
+            "guia": None,
+            "fel": None,
+            "observacion": None,
+            "c_lote": str(c_lote),
+            "c_lote_origen": str(origen) if origen is not None else None,
+        }
+
+    @staticmethod
+    def _evento(node: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "fecha": node["fecha"],
+            "tipo": node["tipo"],
+            "ot": node["ot"],
+            "volumen_lts": node["lts_in"],
+            "nota": None,
+            "tk_origen": node["tk_origen"],
+            "tk_destino": node["tk_destino"],
+        }
+
+    @staticmethod
+    def _movs_hasta(movs: List[Dict[str, Any]], hasta: Optional[datetime]) -> List[Dict[str, Any]]:
+        if hasta is None:
+            return movs
+        out = []
+        for m in movs:
+            f = to_datetime(m.get("F_MOVIMIENTO"))
+            if f is not None and f < hasta:
+                out.append(m)
+        return out
+
+    @staticmethod
+    def _movs_for_dests(conn, lotes: List[int], hasta: Optional[datetime] = None) -> Dict[int, List[Dict[str, Any]]]:
+        """Orígenes directos de un bloque de lotes: del grafo exportado si hay uno, si no de Oracle."""
+        g = grafo_lotes.get()
+        if g is not None:
+            return g.movs_for_dests(lotes, hasta)
+        return queries.fetch_movs_for_dests(conn, lotes, hasta)
+
+    def _iter_tree_levels(self, conn, root_lote_num: int, max_depth: int,
+                          ref: Optional[RefData] = None,
+                          hasta: Optional[datetime] = None) -> Iterator[Tuple[int, List[Dict[str, Any]]]]:
+        """
+        Recorre el árbol de orígenes nivel por nivel y emite (nivel, nodos) a medida
+        que se descubre cada nivel. Cada nivel se consulta con un IN por bloque de lotes.
+
+        Con `hasta` (as_of) el recorrido es cronológico: del lote raíz se toman los movimientos
+        anteriores a `hasta`, y de cada lote origen sólo los anteriores (o del mismo segundo)
+        al movimiento por el que aportó, es decir, lo que ese lote contenía cuando se usó.
+        Un lote que vuelve a aparecer con una cota más tardía (otro camino, otro nivel) se vuelve
+        a expandir con esa cota; con una igual o anterior no, porque no aportaría nada nuevo.
+        """
+        root = self._node(f"ROOT-{root_lote_num}", None, 0, root_lote_num)
+        yield 0, [root]
+
+        frontier: List[Tuple[int, str, Optional[datetime]]] = [(root_lote_num, root["node_id"], hasta)]
+        # Lote -> cota más tardía con la que ya se expandió (None sin as_of: cada lote una sola vez)
+        visited: Dict[int, Optional[datetime]] = {root_lote_num: hasta}
+
+        for level in range(max_depth):
+            if not frontier:
+                break
+            movs_por_lote: Dict[int, List[Dict[str, Any]]] = {}
+            for chunk in queries.in_chunks(frontier):
+                # Una consulta por bloque con la cota más alta del bloque; cada lote se recorta a la suya
+                cota = max(c for _, _, c in chunk) if hasta is not None else None
+                movs_por_lote.update(self._movs_for_dests(conn, [lote for lote, _, _ in chunk], cota))
+
+            nodes: List[Dict[str, Any]] = []
+            siguiente: Dict[int, Tuple[str, Optional[datetime]]] = {}
+            for current_lote, parent, cota in frontier:
+                movs = self._movs_hasta(movs_por_lote.get(current_lote, []), cota)
+                if not movs:
+                    continue
+                total_lvl = sum(to_float(m.get("VOL")) for m in movs) or 0.0
+                for idx, m in enumerate(movs, start=1):
+                    cantidad = to_float(m.get("VOL"))
+                    contrib = (cantidad / total_lvl * 100.0) if total_lvl > 0 else None
+                    nodo_id = f"{level+1}-{current_lote}-{m.get('MOS_ID')}-{idx}"
+                    node = self._node(nodo_id, parent, level + 1, current_lote, m, contrib, ref)
+                    nodes.append(node)
+
+                    origen_int = to_int(m.get("C_LOTE_ORIGEN"))
+                    cota_origen = to_datetime(m.get("F_MOVIMIENTO")) + timedelta(seconds=1) if cota is not None else None
+                    if origen_int is None:
+                        continue
+                    if origen_int not in visited or (cota_origen is not None and cota_origen > visited[origen_int]):
+                        visited[origen_int] = cota_origen
+                        # Mismo origen usado varias veces en el nivel: un solo nodo padre, con la cota más tardía
+                        padre = siguiente[origen_int][0] if origen_int in siguiente else nodo_id
+                        siguiente[origen_int] = (padre, cota_origen)
+
+            yield level + 1, nodes
+            frontier = [(lote, parent, cota) for lote, (parent, cota) in siguiente.items()]
+
+    @staticmethod
+    def _collect_destinos(conn, c_lote_num: int, lotes_arbol: List[int], destinos_alcance: str,
+                          ref: Optional[RefData] = None) -> Tuple[List[Dict[str, Any]], float]:
+        lotes_dest: List[int] = [c_lote_num]
+        if destinos_alcance == "arbol":
+            lotes_dest += lotes_arbol
+        destinos_por_lote = queries.fetch_destinos_finales(conn, lotes_dest, ref)
+        total_dest_final = sum(d["volumen_lts"] for d in destinos_por_lote.get(c_lote_num, []))
+        destinos: List[Dict[str, Any]] = []
+        for lote in dict.fromkeys(lotes_dest):
+            destinos.extend(destinos_por_lote.get(lote, []))
+        return destinos, total_dest_final
+
+    @staticmethod
+    def _kpis_balance(total_in_lvl1: float, total_dest_final: float, tolerance: float) -> Tuple[TraceKPIs, TraceBalance]:
+        lts_origenes = total_in_lvl1
+        lts_destino = total_in_lvl1
+        diff = abs(lts_origenes - lts_destino)
+        ok_balance = (lts_origenes == 0.0) or (diff <= (tolerance * max(lts_origenes, 1.0)))
+        kpis = TraceKPIs(lts_destino=lts_destino)
+        balance = TraceBalance(
+            ok=ok_balance,
+            tolerance=tolerance,
+            lts_origenes=lts_origenes,
+            lts_destino=lts_destino,
+            lts_destinos_finales=total_dest_final,
+        )
+        return kpis, balance
+
+    # ---------- contrato ----------
     def trace_by_lote(self, q: TraceQuery) -> TraceResponse:
-        raise NotImplementedError(
-            "Repositorio real no implementado aún. Configura TRACE_MODE=fake (por defecto) "
-            "o proporciona las consultas/orígenes de datos para habilitar el modo real."
+        c_lote_num = self._lote_num(q.c_lote)
+        ref = refdata.get()
+        with self._engine_factory().connect() as conn:
+            self._require_detalle(conn, ref)
+            info = queries.fetch_lote_info(conn, c_lote_num, ref)
+
+            nodes: List[Dict[str, Any]] = []
+            for _, lvl_nodes in self._iter_tree_levels(conn, c_lote_num, q.max_depth, ref, _hasta(q.as_of)):
+                nodes.extend(lvl_nodes)
+            total_in_lvl1 = sum(to_float(n.get("lts_in")) for n in nodes if n.get("nivel") == 1)
+
+            destinos: Optional[List[Dict[str, Any]]] = None
+            if q.include_destinos:
+                lotes_arbol = [to_int(n["c_lote_origen"]) for n in nodes if n.get("c_lote_origen")]
+                destinos, total_dest_final = self._collect_destinos(conn, c_lote_num, lotes_arbol, q.destinos_alcance, ref)
+            else:
+                total_dest_final = queries.sum_destinos_finales(conn, c_lote_num, ref)
+
+        fechas = [n["fecha"] for n in nodes if n.get("fecha")]
+        timeline = None
+        if q.include_timeline:
+            eventos = [self._evento(n) for n in nodes if n.get("fecha")]
+            timeline = [TraceTimelineEvent.model_construct(**e) for e in sorted(eventos, key=lambda x: x["fecha"])]
+
+        kpis, balance = self._kpis_balance(total_in_lvl1, total_dest_final, q.tolerance)
+        return TraceResponse(
+            identificacion=TraceIdentification(
+                c_lote=str(c_lote_num),
+                tanque_actual=info.get("D_LOTE"),
+                fecha_inicio=min(fechas) if fechas else None,
+                fecha_fin=max(fechas) if fechas else None,
+                origen_consulta="C_LOTE",
+                as_of=q.as_of.isoformat() if q.as_of else None,
+            ),
+            kpis=kpis,
+            balance=balance,
+            origenes=[TraceOriginNode.model_construct(**n) for n in nodes],
+            timeline=timeline,
+            destinos=[TraceDestination.model_construct(**d) for d in destinos] if destinos is not None else None,
+        )
+
+    def iter_trace_by_lote(self, q: TraceQuery) -> Iterator[Dict[str, Any]]:
+        """
+        Valida el pedido (422/501 antes de empezar a responder) y devuelve el generador
+        de registros NDJSON: sólo se retiene en memoria el nivel en curso.
+        """
+        c_lote_num = self._lote_num(q.c_lote)
+        ref = refdata.get()
+        with self._engine_factory().connect() as conn:
+            self._require_detalle(conn, ref)
+        return self._stream(c_lote_num, q, ref)
+
+    def _stream(self, c_lote_num: int, q: TraceQuery, ref: Optional[RefData]) -> Iterator[Dict[str, Any]]:
+        with self._engine_factory().connect() as conn:
+            info = queries.fetch_lote_info(conn, c_lote_num, ref)
+            yield {
+                "tipo": "identificacion",
+                "identificacion": {
+                    "c_lote": str(c_lote_num),
+                    "producto": None,
+                    "tanque_actual": info.get("D_LOTE"),
+                    "origen_consulta": "C_LOTE",
+                    "as_of": q.as_of.isoformat() if q.as_of else None,
+                },
+            }
+
+            f_ini: Optional[str] = None
+            f_fin: Optional[str] = None
+            total_in_lvl1 = 0.0
+            total_nodos = 0
+            lotes_arbol: List[int] = []
+            for nivel, nodes in self._iter_tree_levels(conn, c_lote_num, q.max_depth, ref, _hasta(q.as_of)):
+                total_nodos += len(nodes)
+                for n in nodes:
+                    fecha = n.get("fecha")
+                    if fecha:
+                        f_ini = fecha if f_ini is None or fecha < f_ini else f_ini
+                        f_fin = fecha if f_fin is None or fecha > f_fin else f_fin
+                    if nivel == 1:
+                        total_in_lvl1 += to_float(n.get("lts_in"))
+                    if q.destinos_alcance == "arbol" and n.get("c_lote_origen"):
+                        lotes_arbol.append(to_int(n["c_lote_origen"]))
+                rec: Dict[str, Any] = {"tipo": "nivel", "nivel": nivel, "nodos": nodes}
+                if q.include_timeline:
+                    rec["timeline"] = [self._evento(n) for n in nodes if n.get("fecha")]
+                yield rec
+
+            destinos: List[Dict[str, Any]] = []
+            if q.include_destinos:
+                destinos, total_dest_final = self._collect_destinos(conn, c_lote_num, lotes_arbol, q.destinos_alcance, ref)
+            else:
+                total_dest_final = queries.sum_destinos_finales(conn, c_lote_num, ref)
+
+        kpis, balance = self._kpis_balance(total_in_lvl1, total_dest_final, q.tolerance)
+        yield {
+            "tipo": "resumen",
+            "identificacion": {"fecha_inicio": f_ini, "fecha_fin": f_fin},
+            "kpis": kpis.model_dump(),
+            "balance": balance.model_dump(),
+            "destinos": destinos,
+            "total_nodos": total_nodos,
+        }
+
+    def children_by_lote(self, c_lote: str, node: Optional[str], nivel: int, as_of: Optional[date] = None,
+                         hasta: Optional[datetime] = None) -> TraceChildrenResponse:
+        """
+        Un nivel del árbol bajo demanda: los orígenes directos de `node` (o del lote raíz),
+        cada uno con la cantidad de orígenes que tiene a su vez para saber si se puede expandir.
+        Con as_of la cota de cada hijo (`hasta`) es la misma que usa el recorrido completo.
+        """
+        c_lote_num = self._lote_num(c_lote)
+        lote = self._lote_num(node) if node else c_lote_num
+        cota = hasta if hasta is not None else _hasta(as_of)
+        ref = refdata.get()
+        with self._engine_factory().connect() as conn:
+            self._require_detalle(conn, ref)
+            movs = self._movs_hasta(self._movs_for_dests(conn, [lote], cota).get(lote, []), cota)
+
+            cotas: Dict[int, Optional[datetime]] = {}
+            for m in movs:
+                origen = to_int(m.get("C_LOTE_ORIGEN"))
+                if origen is None:
+                    continue
+                cota_origen = to_datetime(m.get("F_MOVIMIENTO")) + timedelta(seconds=1) if cota is not None else None
+                if origen not in cotas or (cota_origen is not None and cota_origen > cotas[origen]):
+                    cotas[origen] = cota_origen
+            sub: Dict[int, List[Dict[str, Any]]] = {}
+            for chunk in queries.in_chunks(list(cotas)):
+                cota_chunk = max(cotas[o] for o in chunk) if cota is not None else None
+                sub.update(self._movs_for_dests(conn, chunk, cota_chunk))
+
+        total = sum(to_float(m.get("VOL")) for m in movs) or 0.0
+        children: List[TraceChildNode] = []
+        for idx, m in enumerate(movs, start=1):
+            cantidad = to_float(m.get("VOL"))
+            node_dict = self._node(f"{nivel+1}-{lote}-{m.get('MOS_ID')}-{idx}", None, nivel + 1, lote, m,
+                                   (cantidad / total * 100.0) if total > 0 else None, ref)
+            origen = to_int(m.get("C_LOTE_ORIGEN"))
+            cota_origen = to_datetime(m.get("F_MOVIMIENTO")) + timedelta(seconds=1) if cota is not None and origen is not None else None
+            node_dict["n_children"] = len(self._movs_hasta(sub.get(origen, []), cota_origen)) if origen is not None else 0
+            node_dict["hasta"] = cota_origen.isoformat() if cota_origen is not None else None
+            children.append(TraceChildNode.model_construct(**node_dict))
+        return TraceChildrenResponse(
+            c_lote=str(c_lote_num), node=str(lote), nivel=nivel,
+            as_of=as_of.isoformat() if as_of else None, children=children,
+        )
+
+    # Niveles de orígenes que se recalculan a fecha; más allá se usa lo que guardó la corrida
+    NIVELES_COMPOSICION_HASTA = 50
+
+    @staticmethod
+    def _componente(r: Dict[str, Any]) -> Tuple[Any, Optional[int], Any]:
+        return r.get("C_VARIEDAD_INV"), to_int(r.get("C_PERIODO")), r.get("ID_SUBVALLE")
+
+    def _composicion_hasta(self, conn, c_lote_num: int, hasta: datetime) -> List[Dict[str, Any]]:
+        """
+        Composición del lote antes de `hasta` por propagación cronológica.
+
+        Las filas de APX_TRAZA_DETALLE de una transformación traen la composición del origen de
+        toda la corrida (también lo que recibió después de aportar), así que no alcanza con sumarlas:
+        cada aporte se reparte según la composición del origen hasta ese movimiento (mismo corte
+        por lote que la traza a fecha), y así hacia atrás. Compras y ajustes (sin lote origen) se
+        toman tal cual. Se consulta por niveles con un IN por bloque de lotes; en un ciclo, más allá
+        de NIVELES_COMPOSICION_HASTA o si el origen no tenía nada a esa fecha, se usa lo guardado.
+        """
+        # 1) Filas de cada lote alcanzado, hasta la cota más tardía con la que se lo necesita
+        filas: Dict[int, Tuple[datetime, List[Dict[str, Any]]]] = {}
+        frontier: Dict[int, datetime] = {c_lote_num: hasta}
+        for _ in range(self.NIVELES_COMPOSICION_HASTA + 1):
+            if not frontier:
+                break
+            for chunk in queries.in_chunks(sorted(frontier)):
+                aportes = queries.fetch_aportes_hasta(conn, chunk, max(frontier[l] for l in chunk))
+                for lote in chunk:
+                    cota = frontier[lote]
+                    filas[lote] = (cota, [r for r in aportes.get(lote, []) if to_datetime(r.get("F_MOVIMIENTO")) < cota])
+            siguiente: Dict[int, datetime] = {}
+            for lote in frontier:
+                for r in filas[lote][1]:
+                    origen = to_int(r.get("C_LOTE_ORIGEN"))
+                    if origen is None:
+                        continue
+                    cota_origen = to_datetime(r.get("F_MOVIMIENTO")) + timedelta(seconds=1)
+                    if (origen not in filas or cota_origen > filas[origen][0]) and cota_origen > siguiente.get(origen, datetime.min):
+                        siguiente[origen] = cota_origen
+            frontier = siguiente
+
+        # 2) Composición de (lote, cota), de las hojas hacia arriba
+        memo: Dict[Tuple[int, datetime], Dict[Any, float]] = {}
+        en_curso: Set[Tuple[int, datetime]] = set()
+
+        def composicion(lote: int, cota: datetime, nivel: int) -> Optional[Dict[Any, float]]:
+            clave = (lote, cota)
+            if clave in memo:
+                return memo[clave]
+            if lote not in filas or filas[lote][0] < cota or clave in en_curso or nivel > self.NIVELES_COMPOSICION_HASTA:
+                return None
+            en_curso.add(clave)
+            lts: Dict[Any, float] = {}
+            por_aporte: Dict[Tuple[int, datetime], List[Dict[str, Any]]] = {}
+            for r in filas[lote][1]:
+                f = to_datetime(r.get("F_MOVIMIENTO"))
+                origen = to_int(r.get("C_LOTE_ORIGEN"))
+                if f >= cota:
+                    continue
+                if origen is None:
+                    k = self._componente(r)
+                    lts[k] = lts.get(k, 0.0) + r["CANTIDAD"]
+                else:
+                    por_aporte.setdefault((origen, f), []).append(r)
+            for (origen, f), rs in por_aporte.items():
+                cantidad = sum(r["CANTIDAD"] for r in rs)
+                del_origen = composicion(origen, f + timedelta(seconds=1), nivel + 1)
+                total = sum(del_origen.values()) if del_origen else 0.0
+                if total > 0:
+                    for k, v in del_origen.items():
+                        lts[k] = lts.get(k, 0.0) + cantidad * v / total
+                else:
+                    for r in rs:
+                        k = self._componente(r)
+                        lts[k] = lts.get(k, 0.0) + r["CANTIDAD"]
+            en_curso.discard(clave)
+            memo[clave] = lts
+            return lts
+
+        return queries.componentes_de(composicion(c_lote_num, hasta, 0) or {})
+
+    def composicion_by_lote(self, c_lote: str, as_of: Optional[date] = None) -> TraceComposicionResponse:
+        """Composición vigente (APX_TRAZA_COMPOSICION_RESUMEN) o, con `as_of`, la del lote a esa fecha (APX_TRAZA_DETALLE)."""
+        c_lote_num = self._lote_num(c_lote)
+        tabla = "APX_TRAZA_DETALLE" if as_of is not None else "APX_TRAZA_COMPOSICION_RESUMEN"
+        with self._engine_factory().connect() as conn:
+            try:
+                if as_of is not None:
+                    componentes = self._composicion_hasta(conn, c_lote_num, _hasta(as_of))
+                else:
+                    componentes = queries.fetch_composicion_resumen(conn, c_lote_num)
+            except Exception as e:
+                if "ORA-00942" in str(e):
+                    raise TraceUnavailableError(f"No existe la tabla {queries.tq(tabla)}.")
+                raise
+        return TraceComposicionResponse(
+            c_lote=str(c_lote_num),
+            as_of=as_of.isoformat() if as_of else None,
+            lts_total=sum(c["lts"] for c in componentes),
+            componentes=[TraceComposicionItem(**c) for c in componentes],
+        )
+
+    def descendientes_by_lote(self, c_lote: str, max_depth: int) -> TraceDescendientesResponse:
+        """
+        Hacia adelante: en qué lotes terminó el lote, por nivel, cada uno una sola vez.
+        Del grafo exportado (CSR hacia adelante) si hay uno; si no, un IN por bloque y nivel
+        sobre C_LOTE_ORIGEN de APX_TRAZA_DETALLE.
+        """
+        c_lote_num = self._lote_num(c_lote)
+        g = grafo_lotes.get()
+        if g is not None:
+            niveles, fuente = g.descendientes(c_lote_num, max_depth), "grafo"
+        else:
+            niveles, fuente = [], "oracle"
+            ref = refdata.get()
+            with self._engine_factory().connect() as conn:
+                self._require_detalle(conn, ref)
+                visited: Set[int] = {c_lote_num}
+                frontier: List[int] = [c_lote_num]
+                while frontier and len(niveles) < max_depth:
+                    destinos: Dict[int, List[int]] = {}
+                    for chunk in queries.in_chunks(frontier):
+                        destinos.update(queries.fetch_lotes_destino(conn, chunk))
+                    siguiente: List[int] = []
+                    for lote in frontier:
+                        for d in destinos.get(lote, []):
+                            if d not in visited:
+                                visited.add(d)
+                                siguiente.append(d)
+                    if siguiente:
+                        niveles.append(siguiente)
+                    frontier = siguiente
+        return TraceDescendientesResponse(
+            c_lote=str(c_lote_num), total_lotes=sum(len(n) for n in niveles), fuente=fuente,
+            niveles=[TraceDescendientesNivel(nivel=i, lotes=[str(l) for l in n]) for i, n in enumerate(niveles, start=1)],
         )
 
+    # ---------- trazas en bloque ----------
+    def _fetch_level_batch(self, lotes: List[int]) -> Dict[int, List[Dict[str, Any]]]:
+        """Consulta un nivel completo del frontier: un bloque IN por worker (o el grafo en memoria si hay)."""
+        g = grafo_lotes.get()
+        if g is not None:
+            return g.movs_for_dests(lotes)
+        engine = self._engine_factory()
+
+        def _one(chunk: List[int]) -> Dict[int, List[Dict[str, Any]]]:
+            with engine.connect() as conn:
+                return queries.fetch_movs_for_dests(conn, chunk)
+
+        chunks = list(queries.in_chunks(lotes))
+        out: Dict[int, List[Dict[str, Any]]] = {}
+        if len(chunks) == 1:
+            out.update(_one(chunks[0]))
+            return out
+        for part in _get_batch_pool().map(_one, chunks):
+            out.update(part)
+        return out
+
+    def trace_batch(self, lotes: List[str], max_depth: int, include_destinos: bool) -> TraceBatchResponse:
+        """
+        Recorre hacia atrás las ancestrías de todos los lotes a la vez, nivel por nivel,
+        con un único conjunto de visitados: cada lote compartido (vinos base, compras comunes)
+        se consulta una sola vez y aparece una sola vez en `grafo`.
+        """
+        roots: List[int] = []
+        invalidos: List[str] = []
+        for c in lotes:
+            n = to_int(c)
+            if n is None:
+                invalidos.append(c)
+            else:
+                roots.append(n)
+        roots = list(dict.fromkeys(roots))
+        if not roots:
+            raise TraceInputError("Ningún c_lote numérico (NUMBER) en la lista.")
+
+        ref = refdata.get()
+        with self._engine_factory().connect() as conn:
+            self._require_detalle(conn, ref)
+            info = queries.fetch_lotes_info(conn, roots, ref)
+
+        grafo: Dict[str, List[TraceEdge]] = {}
+        visited: Set[int] = set(roots)
+        frontier: List[int] = list(roots)
+        niveles = 0
+        consultas = 0
+        while frontier and niveles < max_depth:
+            movs_por_lote = self._fetch_level_batch(frontier)
+            if grafo_lotes.get() is None:
+                consultas += len(list(queries.in_chunks(frontier)))
+            niveles += 1
+            siguiente: List[int] = []
+            for lote in frontier:
+                movs = movs_por_lote.get(lote, [])
+                total_lvl = sum(to_float(m.get("VOL")) for m in movs) or 0.0
+                edges: List[TraceEdge] = []
+                for m in movs:
+                    n = self._node("", None, 0, lote, m, None, ref)
+                    edges.append(TraceEdge.model_construct(
+                        tipo=n["tipo"], fecha=n["fecha"], ot=n["ot"],
+                        tk_origen=n["tk_origen"], tk_destino=n["tk_destino"],
+                        lts=n["lts_in"], contrib_pct=(n["lts_in"] / total_lvl * 100.0) if total_lvl > 0 else None,
+                        c_lote_origen=n["c_lote_origen"],
+                    ))
+                    origen_int = to_int(m.get("C_LOTE_ORIGEN"))
+                    if origen_int is not None and origen_int not in visited:
+                        visited.add(origen_int)
+                        siguiente.append(origen_int)
+                grafo[str(lote)] = edges
+            frontier = siguiente
+
+        destinos: Dict[str, List[TraceDestination]] = {}
+        if include_destinos:
+            with self._engine_factory().connect() as conn:
+                for k, v in queries.fetch_destinos_finales(conn, [int(x) for x in grafo.keys()], ref).items():
+                    destinos[str(k)] = [TraceDestination.model_construct(**d) for d in v]
+
+        lotes_resp = [
+            TraceBatchLote(
+                c_lote=str(root),
+                d_lote=info.get(root),
+                lts_origenes=sum(e.lts for e in grafo.get(str(root), [])),
+                subarbol=str(root),
+                **_resumen_subarbol(grafo, str(root), max_depth),
+            )
+            for root in roots
+        ]
+        return TraceBatchResponse(
+            lotes=lotes_resp,
+            grafo=grafo,
+            destinos=destinos,
+            invalidos=invalidos,
+            stats={"niveles": niveles, "consultas": consultas, "lotes_consultados": len(grafo)},
+        )
+
+
+# Pool compartido por todas las trazas en bloque: acota la cantidad de conexiones
+# concurrentes a TRACE_BATCH_WORKERS sin importar cuántos pedidos lleguen.
+_batch_pool: Optional[ThreadPoolExecutor] = None
+_batch_pool_lock = threading.Lock()
+
+
+def _get_batch_pool() -> ThreadPoolExecutor:
+    global _batch_pool
+    with _batch_pool_lock:
+        if _batch_pool is None:
+            _batch_pool = ThreadPoolExecutor(
+                max_workers=max(1, settings.trace_batch_workers),
+                thread_name_prefix="traza-lotes",
+            )
+        return _batch_pool
+
 
 class TraceService:
-    def __init__(self):
-        mode = settings.trace_mode
-        if mode == "real":
+    def __init__(self, repo: Optional[Any] = None):
+        if repo is not None:
+            self.repo = repo
+        elif settings.trace_mode == "real":
             self.repo = RealTraceRepository()
         else:
             self.repo = FakeTraceRepository()
 
-    def trace_by_lote(self, c_lote: str, max_depth: int, include: List[str], tolerance: float) -> TraceResponse:
-        q = TraceQuery(
+    @staticmethod
+    def _query(c_lote: str, max_depth: int, include: List[str], tolerance: float, destinos_alcance: str,
+               as_of: Optional[date] = None) -> TraceQuery:
+        return TraceQuery(
             c_lote=c_lote,
             max_depth=max_depth if max_depth and max_depth > 0 else 10,
             include_timeline=("timeline" in include),
             include_destinos=("destinos" in include),
             tolerance=tolerance if tolerance is not None else 0.005,
+            destinos_alcance=destinos_alcance or "raiz",
+            as_of=as_of,
         )
-        return self.repo.trace_by_lote(q)
+
+    def trace_by_lote(self, c_lote: str, max_depth: int, include: List[str], tolerance: float,
+                      destinos_alcance: str = "raiz", as_of: Optional[date] = None) -> TraceResponse:
+        return self.repo.trace_by_lote(self._query(c_lote, max_depth, include, tolerance, destinos_alcance, as_of))
+
+    def iter_trace_by_lote(self, c_lote: str, max_depth: int, include: List[str], tolerance: float,
+                           destinos_alcance: str = "raiz", as_of: Optional[date] = None) -> Iterator[Dict[str, Any]]:
+        return self.repo.iter_trace_by_lote(self._query(c_lote, max_depth, include, tolerance, destinos_alcance, as_of))
+
+    def composicion_by_lote(self, c_lote: str, as_of: Optional[date] = None) -> TraceComposicionResponse:
+        return self.repo.composicion_by_lote(c_lote, as_of)
+
+    def children_by_lote(self, c_lote: str, node: Optional[str] = None, nivel: int = 0, as_of: Optional[date] = None,
+                         hasta: Optional[datetime] = None) -> TraceChildrenResponse:
+        return self.repo.children_by_lote(c_lote, node, nivel, as_of, hasta)
+
+    def descendientes_by_lote(self, c_lote: str, max_depth: int) -> TraceDescendientesResponse:
+        return self.repo.descendientes_by_lote(c_lote, max_depth if max_depth and max_depth > 0 else 10)
+
+    def trace_batch(self, lotes: List[str], max_depth: int, include_destinos: bool = False) -> TraceBatchResponse:
+        return self.repo.trace_batch(lotes, max_depth if max_depth and max_depth > 0 else 10, include_destinos)
+
+
+_service: Optional[TraceService] = None
+
+
+def get_trace_service() -> TraceService:
+    global _service
+    if _service is None:
+        _service = TraceService()
+    return _service
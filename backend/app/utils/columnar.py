@@ -0,0 +1,63 @@
+# backend/app/utils/columnar.py
+from __future__ import annotations
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Sequence
+
+def encode_columnar(
+    rows: Sequence[Mapping[str, Any]],
+    schema: Optional[Sequence[str]] = None,
+    dict_cols: Iterable[str] = (),
+) -> Dict[str, Any]:
+    """
+    Codifica una lista de dicts homogéneos como columnas:
+      {"formato": "columnar", "n": N, "schema": [...], "dicts": {col: [valores]}, "columns": {col: [...] | None}}
+    - Las claves se envían una sola vez (schema) en lugar de repetirse por fila.
+    - Columnas totalmente nulas se envían como None.
+    - Columnas en `dict_cols` se envían como índices sobre dicts[col] (None se mantiene).
+    """
+    if schema is None:
+        schema = list(rows[0].keys()) if rows else []
+    dict_set = set(dict_cols)
+    columns: Dict[str, Optional[List[Any]]] = {}
+    dicts: Dict[str, List[Any]] = {}
+
+    for col in schema:
+        values = [r.get(col) for r in rows]
+        if all(v is None for v in values):
+            columns[col] = None
+            continue
+        if col in dict_set:
+            index: Dict[Any, int] = {}
+            codes: List[Optional[int]] = []
+            for v in values:
+                if v is None:
+                    codes.append(None)
+                    continue
+                code = index.get(v)
+                if code is None:
+                    code = index[v] = len(index)
+                codes.append(code)
+            dicts[col] = list(index.keys())
+            columns[col] = codes
+        else:
+            columns[col] = values
+
+    return {"formato": "columnar", "n": len(rows), "schema": list(schema), "dicts": dicts, "columns": columns}
+
+def decode_columnar(payload: Mapping[str, Any]) -> List[Dict[str, Any]]:
+    """Inversa de encode_columnar: devuelve la lista de dicts original."""
+    n = int(payload.get("n") or 0)
+    schema = payload.get("schema") or []
+    dicts = payload.get("dicts") or {}
+    columns = payload.get("columns") or {}
+
+    cols: Dict[str, List[Any]] = {}
+    for col in schema:
+        values = columns.get(col)
+        if values is None:
+            cols[col] = [None] * n
+        elif col in dicts:
+            d = dicts[col]
+            cols[col] = [None if c is None else d[c] for c in values]
+        else:
+            cols[col] = list(values)
+    return [{col: cols[col][i] for col in schema} for i in range(n)]
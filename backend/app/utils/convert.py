@@ -46,6 +46,21 @@ def to_int(x: Any) -> Optional[int]:
     except Exception:
         return None
 
+def to_datetime(x: Any) -> Optional[datetime]:
+    """
+    datetime desde datetime/date/str ISO. Devuelve None si no puede.
+    """
+    try:
+        if x is None:
+            return None
+        if isinstance(x, datetime):
+            return x.replace(tzinfo=None)
+        if isinstance(x, date):
+            return datetime(x.year, x.month, x.day)
+        return datetime.fromisoformat(str(x).strip().replace("Z", "")).replace(tzinfo=None)
+    except Exception:
+        return None
+
 def to_iso(dt: Any) -> Optional[str]:
     """
     Devuelve ISO-8601. Acepta datetime/date/str (devuelve el str tal cual).
@@ -0,0 +1,66 @@
+# backend/app/utils/jsonfast.py
+from __future__ import annotations
+from datetime import datetime, date
+from decimal import Decimal
+from typing import Any
+import json
+import math
+
+from fastapi.responses import JSONResponse
+
+from .convert import to_iso
+
+# orjson es opcional: si no está instalado se usa json de la stdlib con las mismas reglas.
+try:
+    import orjson
+except Exception:  # pragma: no cover - depende del entorno
+    orjson = None
+
+
+def _default(obj: Any) -> Any:
+    """
+    Tipos no nativos, con las mismas reglas que utils.convert:
+      - datetime/date -> to_iso (ISO-8601, UTC como 'Z', date como medianoche 'Z')
+      - Decimal -> float (NaN/Inf -> null)
+    """
+    if isinstance(obj, (datetime, date)):
+        return to_iso(obj)
+    if isinstance(obj, Decimal):
+        f = float(obj)
+        return f if math.isfinite(f) else None
+    if hasattr(obj, "item"):  # escalares numpy / pandas
+        return _sanitize(obj.item())
+    raise TypeError(f"Tipo no serializable: {type(obj).__name__}")
+
+
+def _sanitize(obj: Any) -> Any:
+    """Sólo para el fallback stdlib: NaN/Inf -> None (orjson ya lo hace)."""
+    if isinstance(obj, float):
+        return obj if math.isfinite(obj) else None
+    if isinstance(obj, dict):
+        return {k: _sanitize(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_sanitize(v) for v in obj]
+    return obj
+
+
+if orjson is not None:
+    _ORJSON_OPTS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+    def dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj, default=_default, option=_ORJSON_OPTS)
+else:
+    def dumps(obj: Any) -> bytes:
+        return json.dumps(
+            _sanitize(obj), ensure_ascii=False, allow_nan=False, separators=(",", ":"), default=_default,
+        ).encode("utf-8")
+
+
+def dumps_str(obj: Any) -> str:
+    return dumps(obj).decode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse que serializa con orjson (o el fallback stdlib) vía `dumps`."""
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
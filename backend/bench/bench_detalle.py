@@ -0,0 +1,85 @@
+# backend/bench/bench_detalle.py
+"""
+Benchmark de la normalización de filas de APX_TRAZA_DETALLE sobre un frame sintético
+como el que sale de los cruces de una etapa (columnas object, sin tipar).
+Compara los bucles de conversión que tenía cada etapa contra composicion_enologica.normalizar_detalle.
+
+Uso (desde la raíz del repo):
+    python -m backend.bench.bench_detalle [n_filas] [repeticiones]
+"""
+from __future__ import annotations
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import composicion_enologica as ce
+
+
+def _synthetic_stage(n: int) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    depositos = np.array([f"TANQUE ACERO INOX {i:03d} SECTOR NORTE" for i in range(150)], dtype=object)
+    df = pd.DataFrame({
+        "C_LOTE": (43123040000000 + rng.integers(0, n // 3 + 1, n)).astype(object),
+        "C_VARIEDAD_INV": rng.choice(["MALBEC", "SYRAH", "BONARDA", "CABERNET"], n).astype(object),
+        "C_PERIODO": rng.integers(2018, 2025, n).astype(object),
+        "ID_SUBVALLE": rng.choice(["S1", "S2", "S3"], n).astype(object),
+        "CANTIDAD": (rng.random(n) * 10000).astype(object),
+        "CLAVE_EXT_LOTE": np.array([f"EXT{i % 5000}" for i in range(n)], dtype=object),
+        "MOS_ID": rng.integers(1_000_000, 2_000_000, n).astype(object),
+        "ID": np.arange(n).astype(object),
+        "C_TIPO_COMPRO": rng.choice([13, 31, 95], n).astype(object),
+        "F_MOVIMIENTO": pd.Series(pd.date_range("2024-01-01", periods=n, freq="min")).astype(object),
+        "D_LOTE": np.array([f"LOTE {i % 9000}" for i in range(n)], dtype=object),
+        "C_DORIGEN": rng.integers(0, 150, n).astype(object),
+        "D_DORIGEN": depositos[rng.integers(0, 150, n)],
+        "ORIGEN": "Compra",
+    })
+    for col in ["C_LOTE_ORIGEN", "PORCENTAJE_SI", "CIU_NUMERO", "NRO_INSCRIPCION", "COD_CUARTEL", "CUARTEL_LOG", "C_DDESTINO", "D_DDESTINO"]:
+        df[col] = None
+    for col in ce.COLUMNAS_OT:
+        df[col] = None
+    return df
+
+
+def _legacy(df: pd.DataFrame) -> pd.DataFrame:
+    # Bucles que repetían compras / ajustes / transformaciones antes del esquema único
+    df = df.copy()
+    for col in ["C_LOTE", "MOS_ID", "ID", "C_PERIODO", "C_TIPO_COMPRO", "CIU_NUMERO", "COD_CUARTEL", "C_LOTE_ORIGEN", "PORCENTAJE_SI", "C_DORIGEN", "C_DDESTINO"]:
+        try: df[col] = pd.to_numeric(df[col], errors="coerce").astype("Int64")
+        except Exception: df[col] = pd.to_numeric(df[col], errors="coerce").astype("Float64")
+    df["F_MOVIMIENTO"] = pd.to_datetime(df["F_MOVIMIENTO"], errors="coerce")
+    for col in ["C_VARIEDAD_INV", "ID_SUBVALLE", "CLAVE_EXT_LOTE", "NRO_INSCRIPCION", "CUARTEL_LOG", "D_LOTE", "ORIGEN", "D_DORIGEN", "D_DDESTINO"] + ce.COLUMNAS_OT:
+        df[col] = df[col].astype(pd.StringDtype())
+    df["D_DORIGEN"] = df["D_DORIGEN"].fillna("").str.slice(0, ce.MAX_LEN_D_DEPOSITO)
+    df["D_DDESTINO"] = df["D_DDESTINO"].fillna("").str.slice(0, ce.MAX_LEN_D_DEPOSITO)
+    df["CANTIDAD"] = df["CANTIDAD"].astype(float)
+    for col in ce.COLUMNAS_DETALLE:
+        if col not in df.columns: df[col] = None
+    return df.reindex(columns=ce.COLUMNAS_DETALLE)
+
+
+def _bench(fn, df: pd.DataFrame, reps: int):
+    best = float("inf")
+    out = None
+    for _ in range(reps):
+        t0 = time.perf_counter()
+        out = fn(df)
+        best = min(best, time.perf_counter() - t0)
+    return best * 1000.0, out.memory_usage(deep=True).sum() / 2**20
+
+
+def main() -> None:
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    reps = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    df = _synthetic_stage(n)
+    t_old, mb_old = _bench(_legacy, df, reps)
+    t_new, mb_new = _bench(ce.normalizar_detalle, df, reps)
+    print(f"Etapa sintética: {n} filas x {len(ce.COLUMNAS_DETALLE)} columnas")
+    print(f"bucles por etapa:   {t_old:8.1f} ms  {mb_old:7.1f} MiB")
+    print(f"normalizar_detalle: {t_new:8.1f} ms  {mb_new:7.1f} MiB  (x{t_old / t_new:.1f} tiempo, x{mb_old / mb_new:.1f} memoria)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# backend/bench/bench_json.py
+"""
+Benchmark de serialización de una traza sintética de 5.000 nodos.
+Compara el render de JSONResponse (json stdlib) contra utils.jsonfast.dumps.
+
+Uso (desde la raíz del repo):
+    python -m backend.bench.bench_json [n_nodos] [repeticiones]
+"""
+from __future__ import annotations
+import json
+import sys
+import time
+from datetime import datetime, timedelta
+
+from backend.app.utils import jsonfast
+
+
+def _synthetic_trace(n: int) -> dict:
+    base = datetime(2024, 1, 1)
+    tipos = ["Compra", "Descube", "Ajuste", "Transformación"]
+    nodes = []
+    timeline = []
+    for i in range(n):
+        fecha = (base + timedelta(hours=i)).isoformat()
+        nodes.append({
+            "node_id": f"{i % 20}-{43123040000000 + i}-{1400000 + i}-{i % 7}",
+            "parent_id": f"{max(i % 20 - 1, 0)}-{43123040000000 + i // 3}",
+            "nivel": i % 20,
+            "tipo": tipos[i % 4],
+            "fecha": fecha,
+            "ot": 1400000 + i,
+            "tk_origen": f"TK{i % 150:03d}",
+            "tk_destino": f"TK{(i + 1) % 150:03d}",
+            "lts_in": 1000.0 + i * 0.125,
+            "lts_out": 1000.0 + i * 0.125,
+            "merma_lts": None,
+            "borra_lts": None,
+            "otros_uso_lts": None,
+            "contrib_pct": (i % 100) / 3.0,
+            "guia": None,
+            "fel": None,
+            "observacion": None,
+            "c_lote": str(43123040000000 + i // 3),
+            "c_lote_origen": str(43123040000000 + i),
+        })
+        timeline.append({
+            "fecha": fecha, "evento": tipos[i % 4], "detalle": f"OT {1400000 + i}",
+            "tk_origen": f"TK{i % 150:03d}", "tk_destino": f"TK{(i + 1) % 150:03d}", "cantidad": 1000.0 + i * 0.125,
+        })
+    return {"identificacion": {"c_lote": "43123040000000"}, "origenes": nodes, "timeline": timeline, "destinos": []}
+
+
+def _stdlib(obj) -> bytes:
+    # Mismo render que starlette.responses.JSONResponse
+    return json.dumps(obj, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def _bench(fn, obj, reps: int) -> float:
+    best = float("inf")
+    for _ in range(reps):
+        t0 = time.perf_counter()
+        fn(obj)
+        best = min(best, time.perf_counter() - t0)
+    return best * 1000.0
+
+
+def main() -> None:
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    reps = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    trace = _synthetic_trace(n)
+    t_std = _bench(_stdlib, trace, reps)
+    t_fast = _bench(jsonfast.dumps, trace, reps)
+    backend = "orjson" if jsonfast.orjson is not None else "stdlib (fallback)"
+    print(f"Traza sintética: {n} nodos, {len(_stdlib(trace)) / 1024:.0f} KiB")
+    print(f"JSONResponse (json stdlib): {t_std:8.2f} ms")
+    print(f"jsonfast.dumps [{backend}]: {t_fast:8.2f} ms  (x{t_std / t_fast:.1f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+from contextlib import nullcontext
+from datetime import date, datetime
+from types import SimpleNamespace
+
+from fastapi.testclient import TestClient
+
+from backend.app.main import app
+from backend.app.services.trazabilidad import queries
+from backend.app.services.trazabilidad.service import RealTraceRepository, _hasta
+
+client = TestClient(app)
+
+# Lote 1 recibe de 2 (10/01) y de 3 (01/03); el lote 2 recibió de 4 (05/01) y de 5 (20/01),
+# o sea que cuando 2 aportó a 1 todavía no tenía lo de 5.
+MOVS = {
+    1: [(datetime(2024, 1, 10), 2, 100.0), (datetime(2024, 3, 1), 3, 50.0)],
+    2: [(datetime(2024, 1, 5), 4, 60.0), (datetime(2024, 1, 20), 5, 40.0)],
+}
+
+
+def _fake_movs_de(movs_por_lote):
+    def fake(conn, lotes, hasta=None):
+        out = {}
+        for lote in lotes:
+            for i, (f, origen, vol) in enumerate(movs_por_lote.get(lote, [])):
+                if hasta is None or f < hasta:
+                    out.setdefault(lote, []).append({
+                        "C_LOTE": lote, "C_TIPO_COMPRO": 43, "F_MOVIMIENTO": f, "MOS_ID": lote * 10 + i,
+                        "C_LOTE_ORIGEN": origen, "VOL": vol,
+                    })
+        return out
+    return fake
+
+
+_fake_movs = _fake_movs_de(MOVS)
+
+
+def test_as_of_recorte_cronologico(monkeypatch):
+    monkeypatch.setattr(queries, "fetch_movs_for_dests", _fake_movs)
+    repo = RealTraceRepository(engine_factory=lambda: None)
+
+    niveles = dict(repo._iter_tree_levels(None, 1, 5, hasta=_hasta(date(2024, 2, 1))))
+    assert [n["c_lote_origen"] for n in niveles[1]] == ["2"]
+    assert [n["c_lote_origen"] for n in niveles[2]] == ["4"]
+
+    completo = dict(repo._iter_tree_levels(None, 1, 5))
+    assert [n["c_lote_origen"] for n in completo[1]] == ["2", "3"]
+    assert [n["c_lote_origen"] for n in completo[2]] == ["4", "5"]
+
+
+def test_as_of_lote_repetido_toma_la_cota_mas_tardia(monkeypatch):
+    # Diamante: 2 aporta a 1 el 10/01 y a 3 el 15/02, y 3 aporta a 1 el 01/03. Por el camino 1 <- 3 <- 2
+    # el lote 2 ya tenía también lo de 5 (20/01) y 6 (10/02), así que se vuelve a expandir.
+    movs = {
+        1: [(datetime(2024, 1, 10), 2, 100.0), (datetime(2024, 3, 1), 3, 50.0)],
+        3: [(datetime(2024, 2, 15), 2, 50.0)],
+        2: [(datetime(2024, 1, 5), 4, 60.0), (datetime(2024, 1, 20), 5, 40.0), (datetime(2024, 2, 10), 6, 30.0)],
+    }
+    monkeypatch.setattr(queries, "fetch_movs_for_dests", _fake_movs_de(movs))
+    repo = RealTraceRepository(engine_factory=lambda: None)
+
+    niveles = dict(repo._iter_tree_levels(None, 1, 5, hasta=_hasta(date(2024, 4, 1))))
+    assert [n["c_lote_origen"] for n in niveles[1]] == ["2", "3"]
+    assert [n["c_lote_origen"] for n in niveles[2]] == ["4", "2"]
+    assert [n["c_lote_origen"] for n in niveles[3]] == ["4", "5", "6"]
+    assert {n["parent_id"] for n in niveles[3]} == {niveles[2][1]["node_id"]}
+
+    # Sin as_of cada lote se expande una sola vez
+    completo = dict(repo._iter_tree_levels(None, 1, 5))
+    assert [n["c_lote_origen"] for n in completo[2]] == ["4", "5", "6", "2"]
+    assert [n["c_lote_origen"] for n in completo.get(3, [])] == []
+
+
+def test_as_of_endpoint_fake():
+    r = client.get("/api/trazabilidad/lote/TEST123?as_of=2025-02-10&include=timeline")
+    assert r.status_code == 200
+    data = r.json()
+    assert data["identificacion"]["as_of"] == "2025-02-10"
+    assert all(n["fecha"] <= "2025-02-10" for n in data["origenes"] if n["fecha"])
+    assert client.get("/api/trazabilidad/lote/TEST123/composicion?as_of=2025-02-10").json()["as_of"] == "2025-02-10"
+    assert client.get("/api/trazabilidad/lote/TEST123?as_of=10-02-2025").status_code == 422
+
+
+def test_children_bajo_demanda(monkeypatch):
+    monkeypatch.setattr(queries, "fetch_movs_for_dests", _fake_movs)
+    monkeypatch.setattr(RealTraceRepository, "_require_detalle", staticmethod(lambda conn, ref: None))
+    repo = RealTraceRepository(engine_factory=lambda: SimpleNamespace(connect=nullcontext))
+
+    raiz = repo.children_by_lote("1", None, 0)
+    assert [(n.c_lote_origen, n.n_children, n.nivel) for n in raiz.children] == [("2", 2, 1), ("3", 0, 1)]
+
+    # Con as_of el hijo trae su cota y al expandirlo sólo aparece lo que tenía cuando aportó
+    raiz = repo.children_by_lote("1", None, 0, as_of=date(2024, 3, 5))
+    hijo = raiz.children[0]
+    assert hijo.n_children == 1 and hijo.hasta == "2024-01-10T00:00:01"
+    nietos = repo.children_by_lote("1", hijo.c_lote_origen, 1, hasta=datetime.fromisoformat(hijo.hasta))
+    assert [n.c_lote_origen for n in nietos.children] == ["4"] and nietos.children[0].nivel == 2
+
+
+# Composición a fecha. El lote 2 tenía sólo MALBEC cuando aportó 50 al lote 1 (10/01) y recién el 20/01
+# recibió SYRAH, así que la corrida guardó ese aporte como 60/40 (composición de 2 en toda la corrida).
+APORTES = {
+    1: [(datetime(2024, 1, 1), None, "CABERNET", 50.0),
+        (datetime(2024, 1, 10), 2, "MALBEC", 30.0), (datetime(2024, 1, 10), 2, "SYRAH", 20.0)],
+    2: [(datetime(2024, 1, 5), None, "MALBEC", 60.0), (datetime(2024, 1, 20), None, "SYRAH", 40.0)],
+}
+
+
+def _composicion_a_fecha(monkeypatch, aportes, as_of):
+    consultas = []
+
+    def fake(conn, lotes, hasta):
+        consultas.append(sorted(lotes))
+        return {
+            lote: [{"C_LOTE": lote, "C_LOTE_ORIGEN": o, "F_MOVIMIENTO": f, "C_VARIEDAD_INV": v, "C_PERIODO": 2024,
+                    "ID_SUBVALLE": "VU", "CANTIDAD": c} for f, o, v, c in aportes[lote] if f < hasta]
+            for lote in lotes if lote in aportes
+        }
+
+    monkeypatch.setattr(queries, "fetch_aportes_hasta", fake)
+    repo = RealTraceRepository(engine_factory=lambda: SimpleNamespace(connect=nullcontext))
+    comp = repo.composicion_by_lote("1", as_of)
+    return {c.c_variedad_inv: (c.lts, c.pct) for c in comp.componentes}, consultas
+
+
+def test_composicion_a_fecha_usa_el_origen_cuando_aporto(monkeypatch):
+    comp, consultas = _composicion_a_fecha(monkeypatch, APORTES, date(2024, 2, 1))
+    assert comp == {"CABERNET": (50.0, 50.0), "MALBEC": (50.0, 50.0)}
+    assert consultas == [[1], [2]]  # un IN por nivel
+
+    # Antes del aporte de 2 sólo está la compra propia
+    comp, _ = _composicion_a_fecha(monkeypatch, APORTES, date(2024, 1, 9))
+    assert comp == {"CABERNET": (50.0, 100.0)}
+
+
+def test_composicion_a_fecha_ciclo_y_limite(monkeypatch):
+    # 2 recibe de 1 antes de aportarle: se recorre 1 <- 2 <- 1 con cotas cada vez más tempranas
+    aportes = {**APORTES, 2: APORTES[2] + [(datetime(2024, 1, 2), 1, "CABERNET", 10.0)]}
+    comp, _ = _composicion_a_fecha(monkeypatch, aportes, date(2024, 2, 1))
+    assert comp["CABERNET"][0] == 50.0 + 50.0 * 10 / 70
+    assert abs(comp["MALBEC"][0] - 50.0 * 60 / 70) < 1e-9 and "SYRAH" not in comp
+
+    # Sin niveles para recalcular se usa lo que guardó la corrida
+    monkeypatch.setattr(RealTraceRepository, "NIVELES_COMPOSICION_HASTA", 0)
+    comp, _ = _composicion_a_fecha(monkeypatch, APORTES, date(2024, 2, 1))
+    assert comp == {"CABERNET": (50.0, 50.0), "MALBEC": (30.0, 30.0), "SYRAH": (20.0, 20.0)}
@@ -0,0 +1,19 @@
+from backend.app.utils.columnar import encode_columnar, decode_columnar
+
+ROWS = [
+    {"node_id": "ROOT-1", "tipo": "Lote", "tk_origen": None, "lts_in": None, "merma_lts": None},
+    {"node_id": "1-1-10-1", "tipo": "Compra", "tk_origen": "TK1", "lts_in": 10.0, "merma_lts": None},
+    {"node_id": "1-1-10-2", "tipo": "Compra", "tk_origen": "TK1", "lts_in": 5.5, "merma_lts": None},
+]
+
+def test_columnar_roundtrip():
+    enc = encode_columnar(ROWS, dict_cols=("tipo", "tk_origen"))
+    assert enc["n"] == 3
+    assert enc["columns"]["merma_lts"] is None  # columna siempre nula
+    assert enc["dicts"]["tipo"] == ["Lote", "Compra"]
+    assert enc["columns"]["tipo"] == [0, 1, 1]
+    assert decode_columnar(enc) == ROWS
+
+def test_columnar_empty():
+    enc = encode_columnar([], schema=["a", "b"])
+    assert decode_columnar(enc) == []
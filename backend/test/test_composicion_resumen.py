@@ -0,0 +1,27 @@
+import pandas as pd
+
+import composicion_enologica as ce
+
+
+def test_calcular_composicion_resumen():
+    compras = pd.DataFrame({
+        "C_LOTE": [1, 1, 2, None], "C_VARIEDAD_INV": ["MALBEC", "MALBEC", "SYRAH", "MALBEC"],
+        "C_PERIODO": [2024, 2024, 2023, 2024], "ID_SUBVALLE": ["VU", "VU", None, "VU"],
+        "CANTIDAD": [30.0, 45.0, 10.0, 99.0],
+    })
+    transformaciones = pd.DataFrame({
+        "C_LOTE": ["1"], "C_VARIEDAD_INV": ["SYRAH"], "C_PERIODO": ["2023"], "ID_SUBVALLE": [None],
+        "CANTIDAD": [25.0], "MOS_ID": [7],
+    })
+    df = ce.calcular_composicion_resumen([compras, pd.DataFrame(), None, transformaciones])
+
+    assert list(df.columns) == ce.COLUMNAS_RESUMEN_CLAVE + ["CANTIDAD", "PORCENTAJE"]
+    # Filas sin C_LOTE se descartan; las de la misma clave se suman aunque vengan de etapas distintas
+    filas = {(r.C_LOTE, r.C_VARIEDAD_INV): (r.CANTIDAD, r.PORCENTAJE) for r in df.itertuples()}
+    assert filas == {(1, "MALBEC"): (75.0, 75.0), (1, "SYRAH"): (25.0, 25.0), (2, "SYRAH"): (10.0, 100.0)}
+    assert df.groupby("C_LOTE")["PORCENTAJE"].sum().tolist() == [100.0, 100.0]
+
+
+def test_calcular_composicion_resumen_vacio():
+    df = ce.calcular_composicion_resumen([pd.DataFrame(), None])
+    assert df.empty and list(df.columns) == ce.COLUMNAS_RESUMEN_CLAVE + ["CANTIDAD", "PORCENTAJE"]
@@ -0,0 +1,94 @@
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+import composicion_enologica as ce
+from backend.app.core.config import settings
+from backend.app.services.trazabilidad import grafo
+from backend.app.services.trazabilidad.service import RealTraceRepository
+
+# 1 <- 2 (10/01) y 1 <- 3 (01/03); 2 <- 4 (05/01). El 5 es una compra (sin origen).
+DETALLE = pd.DataFrame({
+    "c_lote": [1, 1, 2, 5],
+    "c_lote_origen": [2, 3, 4, None],
+    "cantidad": [100.0, 50.0, 60.0, 10.0],
+    "mos_id": [11, 12, 21, 51],
+    "f_movimiento": [datetime(2024, 1, 10), datetime(2024, 3, 1), datetime(2024, 1, 5), datetime(2024, 1, 1)],
+    "c_tipo_compro": [43, 43, 43, 13],
+    "c_dorigen": [7, 8, 9, None],
+    "c_ddestino": [1, 1, 2, 3],
+})
+
+
+def test_grafo_exporta_y_recorre(tmp_path, monkeypatch):
+    ruta = ce.escribir_grafo(str(tmp_path), ce.armar_grafo(DETALLE), {"filas": len(DETALLE)})
+    assert (tmp_path / "CURRENT").read_text(encoding="utf-8").strip() == ruta.name
+
+    monkeypatch.setattr(settings, "grafo_lotes_dir", str(tmp_path))
+    monkeypatch.setattr(grafo, "_revisado_en", 0.0)
+    g = grafo.get()
+    assert g is not None and g.version == ruta.name
+
+    assert g.descendientes(4, 5) == [[2], [1]]
+    assert g.descendientes(4, 1) == [[2]] and g.descendientes(1, 5) == []
+    assert g.indice(999) == -1
+
+    movs = g.movs_for_dests([1, 5], hasta=datetime(2024, 2, 1))
+    assert [m["C_LOTE_ORIGEN"] for m in movs[1]] == [2]
+    assert movs[1][0]["F_MOVIMIENTO"] == datetime(2024, 1, 10) and movs[1][0]["C_DORIGEN"] == 7
+    assert movs[5][0]["C_LOTE_ORIGEN"] is None and movs[5][0]["C_DORIGEN"] is None
+
+    # El árbol sale del grafo sin tocar Oracle (conn=None)
+    niveles = dict(RealTraceRepository(engine_factory=lambda: None)._iter_tree_levels(None, 1, 5))
+    assert [n["c_lote_origen"] for n in niveles[1]] == ["2", "3"]
+    assert [n["c_lote_origen"] for n in niveles[2]] == ["4"]
+
+
+def test_grafo_cambio_en_caliente(tmp_path, monkeypatch):
+    viejo = ce.escribir_grafo(str(tmp_path), ce.armar_grafo(DETALLE), {"filas": len(DETALLE)})
+    monkeypatch.setattr(settings, "grafo_lotes_dir", str(tmp_path))
+    monkeypatch.setattr(settings, "grafo_check_seconds", 3600)
+    monkeypatch.setattr(grafo, "_revisado_en", 0.0)
+    monkeypatch.setattr(grafo, "_puntero", None)
+    monkeypatch.setattr(grafo, "_actual", None)
+    g1 = grafo.get()
+    assert g1.version == viejo.name
+
+    # Nueva corrida: el 5 pasa a terminar en el 6. Hasta la próxima revisión se sigue sirviendo la anterior
+    nuevo_detalle = pd.concat([DETALLE, pd.DataFrame({
+        "c_lote": [6], "c_lote_origen": [5], "cantidad": [5.0], "mos_id": [61], "f_movimiento": [datetime(2024, 4, 1)],
+        "c_tipo_compro": [43], "c_dorigen": [3], "c_ddestino": [4],
+    })], ignore_index=True)
+    nuevo = ce.escribir_grafo(str(tmp_path), ce.armar_grafo(nuevo_detalle), {"filas": len(nuevo_detalle)})
+    assert (tmp_path / "CURRENT").read_text(encoding="utf-8").strip() == nuevo.name
+    assert grafo.get() is g1
+
+    monkeypatch.setattr(settings, "grafo_check_seconds", 0)
+    g2 = grafo.get()
+    assert g2.version == nuevo.name and g2 is not g1
+    assert g2.descendientes(5, 5) == [[6]] and g1.descendientes(5, 5) == []
+
+    # Un CURRENT que apunta a una carpeta rota no reemplaza la versión vigente
+    (tmp_path / "CURRENT").write_text("grafo_inexistente", encoding="utf-8")
+    assert grafo.get() is g2
+
+
+def test_descendientes_desde_grafo(tmp_path, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    from backend.app.main import app
+    from backend.app.services.trazabilidad import queries, service
+
+    ce.escribir_grafo(str(tmp_path), ce.armar_grafo(DETALLE), {"filas": len(DETALLE)})
+    monkeypatch.setattr(settings, "grafo_lotes_dir", str(tmp_path))
+    monkeypatch.setattr(grafo, "_revisado_en", 0.0)
+    monkeypatch.setattr(grafo, "_puntero", None)
+    monkeypatch.setattr(grafo, "_actual", None)
+    monkeypatch.setattr(service, "_service", service.TraceService(RealTraceRepository(engine_factory=lambda: None)))
+    monkeypatch.setattr(queries, "fetch_lotes_destino", lambda conn, lotes: pytest.fail("no debe ir a Oracle"))
+
+    r = TestClient(app).get("/api/trazabilidad/lote/4/descendientes?max_depth=5")
+    assert r.status_code == 200
+    assert r.json() == {"c_lote": "4", "total_lotes": 2, "fuente": "grafo",
+                        "niveles": [{"nivel": 1, "lotes": ["2"]}, {"nivel": 2, "lotes": ["1"]}]}
@@ -19,3 +19,103 @@ def test_health_readiness():
     assert "time" in data
     assert "version" in data
     assert "dependencies" in data
+
+
+# ---------- readiness contra un Oracle falso ----------
+import threading
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import pytest
+
+from backend.app.core.config import settings
+from backend.app.services import db
+
+
+class _Motor:
+    """Engine falso: cuenta conexiones abiertas/cerradas; `connect` puede esperar a `liberar`."""
+    def __init__(self, lento=False, falla_en=None):
+        self.lento = lento
+        self.falla_en = falla_en
+        self.abiertas = 0
+        self.cerradas = 0
+        self.liberar = threading.Event()
+        self.pool = SimpleNamespace(size=lambda: 5, checkedin=lambda: 4, checkedout=lambda: 1, overflow=lambda: 0)
+
+    def connect(self):
+        if self.lento:
+            self.liberar.wait(timeout=10)
+        if self.falla_en is not None and self.abiertas + 1 == self.falla_en:
+            raise RuntimeError("ORA-12541: TNS:no listener")
+        self.abiertas += 1
+        motor = self
+
+        @contextmanager
+        def conexion():
+            try:
+                yield SimpleNamespace(execute=lambda stmt: None)
+            finally:
+                motor.cerradas += 1
+
+        c = conexion()
+        c.close = lambda: setattr(motor, "cerradas", motor.cerradas + 1)
+        return c
+
+
+@pytest.fixture
+def motor(monkeypatch):
+    creados = []
+
+    def usar(**kwargs):
+        m = _Motor(**kwargs)
+        creados.append(m)
+        monkeypatch.setattr(db, "get_engine", lambda: m)
+        monkeypatch.setattr(db, "_engine", m)
+        return m
+
+    yield usar
+    # Los chequeos que quedaron esperando en segundo plano terminan
+    for m in creados:
+        m.liberar.set()
+
+
+def test_readiness_oracle_lento_responde_a_tiempo(motor, monkeypatch):
+    motor(lento=True)
+    monkeypatch.setattr(settings, "health_oracle_timeout", 0.2)
+    t0 = time.perf_counter()
+    r = client.get("/api/health?deep=true")
+    assert time.perf_counter() - t0 < 2
+    assert r.status_code == 503
+    data = r.json()
+    assert data["status"] == "down" and data["dependencies"] == {"oracle": "down"}
+    assert data["errors"][0]["code"] == "ORACLE_DOWN" and "no respondió en 0.2s" in data["errors"][0]["message"]
+
+
+def test_readiness_ok_con_estado_del_pool(motor):
+    motor()
+    r = client.get("/api/health?deep=true")
+    assert r.status_code == 200 and r.json()["status"] == "ok"
+    pool = r.json()["pool"]
+    assert (pool["size"], pool["checked_in"], pool["checked_out"], pool["overflow"]) == (5, 4, 1, 0)
+    assert pool["espera_ms"] is not None and pool["espera_ms"] >= 0
+
+
+def test_readiness_error_de_conexion(motor):
+    motor(falla_en=1)
+    assert db.check_oracle_ready(timeout_seconds=1) == (False, "ORA-12541: TNS:no listener")
+
+
+def test_warmup_pool(motor):
+    m = motor()
+    assert db.warmup_pool(3) == 3 and (m.abiertas, m.cerradas) == (3, 3)
+    # Si una conexión falla, las ya abiertas vuelven al pool igual
+    m = motor(falla_en=3)
+    with pytest.raises(RuntimeError):
+        db.warmup_pool(5)
+    assert (m.abiertas, m.cerradas) == (2, 2)
+
+
+def test_pool_stats_sin_engine(monkeypatch):
+    monkeypatch.setattr(db, "_engine", None)
+    assert db.pool_stats() == {}
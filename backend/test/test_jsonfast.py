@@ -0,0 +1,21 @@
+import json
+from datetime import datetime, date, timezone
+from decimal import Decimal
+
+from backend.app.utils.jsonfast import dumps
+from backend.app.utils.convert import to_iso
+
+def test_jsonfast_tipos_como_convert():
+    dt = datetime(2024, 3, 1, 12, 30, tzinfo=timezone.utc)
+    data = json.loads(dumps({
+        "dt": dt,
+        "d": date(2024, 3, 1),
+        "dec": Decimal("12.50000"),
+        "nan": float("nan"),
+        "txt": "Transformación",
+    }))
+    assert data["dt"] == to_iso(dt) == "2024-03-01T12:30:00Z"
+    assert data["d"] == to_iso(date(2024, 3, 1))
+    assert data["dec"] == 12.5
+    assert data["nan"] is None
+    assert data["txt"] == "Transformación"
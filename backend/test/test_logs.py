@@ -0,0 +1,160 @@
+import gzip
+
+from fastapi.testclient import TestClient
+
+from backend.app.core.config import settings
+from backend.app.main import app
+from backend.app.services.composicion import runner
+
+client = TestClient(app)
+
+RUN = "composicion_20250101_120000_20250101_20250131"
+
+
+def test_logs_tail_incremental(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "logs_out_dir", str(tmp_path))
+    log = tmp_path / f"{RUN}.log"
+    log.write_text("linea 1\nlinea 2\nlinea 3 a medi", encoding="utf-8")
+    monkeypatch.setattr(runner, "_logs_activos", {log})
+
+    r = client.get(f"/api/composicion/logs/{RUN}")
+    assert r.status_code == 200
+    data = r.json()
+    # Corrida en curso: la línea incompleta queda para la próxima lectura
+    assert data["text"] == "linea 1\nlinea 2\n" and data["activo"] and not data["eof"]
+
+    with log.open("a", encoding="utf-8") as fh:
+        fh.write("d\nlinea 4\n")
+    data = client.get(f"/api/composicion/logs/{RUN}?offset={data['next_offset']}").json()
+    assert data["text"] == "linea 3 a medid\nlinea 4\n" and data["eof"]
+
+    # Rango: de a 10 bytes siempre corta en línea completa; offset negativo = últimas líneas
+    assert client.get(f"/api/composicion/logs/{RUN}?limit=10").json()["text"] == "linea 1\n"
+    assert client.get(f"/api/composicion/logs/{RUN}?offset=-12").json()["text"] == "linea 4\n"
+
+    runs = client.get("/api/composicion/logs").json()["items"]
+    assert runs[0]["run"] == RUN and runs[0]["activo"]
+
+
+def test_logs_rotado_y_404(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "logs_out_dir", str(tmp_path))
+    with gzip.open(tmp_path / f"{RUN}.log.gz", "wt", encoding="utf-8") as fh:
+        fh.write("uno\ndos\n")
+    data = client.get(f"/api/composicion/logs/{RUN}?offset=4").json()
+    assert data["text"] == "dos\n" and data["comprimido"] and data["eof"] and not data["activo"]
+    assert client.get("/api/composicion/logs/composicion_no_existe").status_code == 404
+    assert client.get("/api/composicion/logs/..%2Fsecreto").status_code == 404
+
+
+# ---------- escritura en bloque (LogSink) ----------
+def test_logsink_flush_por_tamano(tmp_path):
+    from backend.app.services.composicion.logsink import LogSink
+
+    path = tmp_path / "composicion_x.log"
+    sink = LogSink(path, flush_bytes=60, flush_seconds=3600)
+    sink.write("t1", "INFO", "primera")
+    assert path.read_text(encoding="utf-8") == ""
+    sink.write("t2", "INFO", "segunda")
+    sink.write("t3", "INFO", "tercera que pasa el tope")
+    assert path.read_text(encoding="utf-8").splitlines() == ["t1 [INFO] primera", "t2 [INFO] segunda",
+                                                             "t3 [INFO] tercera que pasa el tope"]
+    sink.write("t4", "ERROR", "al cerrar")
+    sink.close()
+    sink.close()
+    assert path.read_text(encoding="utf-8").splitlines()[-1] == "t4 [ERROR] al cerrar"
+
+
+def test_logsink_flush_por_intervalo(tmp_path, monkeypatch):
+    from backend.app.services.composicion import logsink
+
+    reloj = [100.0]
+    monkeypatch.setattr(logsink.time, "monotonic", lambda: reloj[0])
+    path = tmp_path / "composicion_x.log"
+    sink = logsink.LogSink(path, flush_bytes=1 << 20, flush_seconds=1.0)
+    sink.write("t1", "INFO", "uno")
+    reloj[0] += 0.5
+    sink.maybe_flush()
+    assert path.read_text(encoding="utf-8") == ""
+    reloj[0] += 0.5
+    sink.maybe_flush()  # lo que llama el runner en cada tick, aunque no haya líneas nuevas
+    assert path.read_text(encoding="utf-8") == "t1 [INFO] uno\n"
+    sink.close()
+
+
+def test_comprimir_logs_rotados(tmp_path):
+    import threading
+
+    from backend.app.services.composicion.logsink import comprimir_logs_rotados
+
+    viejo = tmp_path / "composicion_20240101_000000_a.log"
+    activo = tmp_path / "composicion_20240102_000000_b.log"
+    viejo.write_text("viejo\n", encoding="utf-8")
+    activo.write_text("en curso\n", encoding="utf-8")
+    comprimir_logs_rotados(tmp_path, {activo})
+    for t in threading.enumerate():
+        if t.name == "logs-gzip":
+            t.join(timeout=5)
+    assert not viejo.exists() and activo.exists()
+    with gzip.open(tmp_path / f"{viejo.name}.gz", "rt", encoding="utf-8") as fh:
+        assert fh.read() == "viejo\n"
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+# ---------- SSE: lotes de líneas y heartbeat ----------
+def _eventos_sse(chunks):
+    import json
+
+    eventos = []
+    for bloque in "".join(chunks).split("\n\n"):
+        if bloque.startswith(": "):
+            eventos.append((bloque[2:], None))
+        elif bloque.startswith("event: "):
+            cabecera, data = bloque.split("\n", 1)
+            eventos.append((cabecera[len("event: "):], json.loads(data[len("data: "):])))
+    return eventos
+
+
+def _corrida_en_hilo(monkeypatch, tmp_path, proceso, **config):
+    from types import SimpleNamespace
+
+    monkeypatch.setattr(settings, "logs_out_dir", str(tmp_path))
+    monkeypatch.setattr(settings, "composicion_worker", False)
+    for clave, valor in config.items():
+        monkeypatch.setattr(settings, clave, valor)
+    monkeypatch.setattr(runner, "cargar_modulo", lambda: SimpleNamespace(ejecutar_proceso_completo=proceso))
+    monkeypatch.setattr(runner.refdata, "pedir_refresco", lambda: None)
+    return _eventos_sse(runner.stream_sse_logs("2024-01-01", "2024-01-31"))
+
+
+def test_sse_agrupa_lineas(tmp_path, monkeypatch):
+    def proceso(desde, hasta):
+        for i in range(5):
+            yield f"linea {i}"
+
+    eventos = _corrida_en_hilo(monkeypatch, tmp_path, proceso,
+                               sse_batch_max=2, sse_batch_seconds=3600, sse_heartbeat_seconds=3600)
+    lotes = [data["items"] for ev, data in eventos if ev == "logs"]
+    assert [len(l) for l in lotes] == [2, 2, 1]
+    assert [i["msg"] for l in lotes for i in l] == [f"linea {i}" for i in range(5)]
+    assert eventos[-2:] == [("done", {"ok": True}), ("stream-close", None)]
+    # El log guarda todas las líneas aunque el SSE las mande agrupadas
+    run = next(data["run"] for ev, data in eventos if ev == "run")
+    texto = (tmp_path / f"{run}.log").read_text(encoding="utf-8")
+    assert all(f"[INFO] linea {i}" in texto for i in range(5)) and texto.rstrip().endswith("Proceso finalizado.")
+
+
+def test_sse_heartbeat_en_silencio(tmp_path, monkeypatch):
+    import time
+
+    def proceso(desde, hasta):
+        yield "antes de la consulta larga"
+        time.sleep(0.5)
+        yield "después"
+
+    eventos = _corrida_en_hilo(monkeypatch, tmp_path, proceso,
+                               sse_batch_max=500, sse_batch_seconds=0.05, sse_heartbeat_seconds=0.1)
+    tipos = [ev for ev, _ in eventos]
+    primero = next(i for i, (ev, data) in enumerate(eventos) if ev == "logs" and data["items"][0]["msg"].startswith("antes"))
+    ultimo = next(i for i, (ev, data) in enumerate(eventos) if ev == "logs" and data["items"][0]["msg"] == "después")
+    assert "heartbeat" in tipos[primero:ultimo]
+    assert tipos[-2:] == ["done", "stream-close"]
@@ -0,0 +1,313 @@
+import pandas as pd
+import pytest
+
+import composicion_enologica as ce
+
+
+# ---------- DatosCorrida / entradas declaradas por etapa ----------
+@pytest.fixture
+def extracciones(monkeypatch):
+    monkeypatch.delenv("COMPOSICION_MODO_SQL", raising=False)
+    llamadas = []
+
+    def extractor(nombre, filas):
+        def extraer(datos):
+            llamadas.append(nombre)
+            return pd.DataFrame({"x": range(filas)})
+        return extraer
+
+    for nombre, filas in (("lotes", 3), ("depositos", 2), ("movim_descubes", 1), ("det_mov_descubes", 0)):
+        monkeypatch.setitem(ce.DATASETS, nombre, (f"{nombre} de prueba", extractor(nombre, filas)))
+    return llamadas
+
+
+def test_entradas_no_declaradas(extracciones):
+    datos = ce.DatosCorrida(None, "2024-01-01", "2024-01-31")
+    with pytest.raises(KeyError, match="no declara la entrada 'lotes'"):
+        datos.entradas("descubes")["lotes"]
+    assert extracciones == []
+
+
+def test_extraccion_perezosa_y_compartida(extracciones):
+    datos = ce.DatosCorrida(None, "2024-01-01", "2024-01-31")
+    assert extracciones == []
+    lotes = datos.entradas("compras")["lotes"]
+    # La segunda etapa recibe el mismo frame, sin volver a extraerlo
+    assert datos.entradas("transformaciones")["lotes"] is lotes
+    assert extracciones == ["lotes"]
+
+
+def test_reporte(extracciones):
+    datos = ce.DatosCorrida(None, "2024-01-01", "2024-01-31")
+    datos.entradas("compras")["lotes"]
+    datos.entradas("ajustes")["lotes"]
+    datos.entradas("compras")["depositos"]
+    lineas = datos.reporte()
+    assert lineas[1].startswith("lotes: lotes de prueba; 3 filas en ") and lineas[1].endswith("pedido por: compras, ajustes")
+    assert lineas[2].endswith("pedido por: compras")
+    assert lineas[-1] == "No extraídos (ninguna etapa los leyó): movim_descubes, det_mov_descubes"
+
+
+def test_pushdown_no_extrae_maestros(extracciones, monkeypatch):
+    monkeypatch.setenv("COMPOSICION_MODO_SQL", " PushDown ")
+    assert ce._modo_sql() == "pushdown"
+    datos = ce.DatosCorrida(None, "2024-01-01", "2024-01-31")
+    # Compras y ajustes cruzan los maestros en Oracle; transformaciones los sigue leyendo
+    assert datos.entradas("compras").opcional("lotes") is None
+    assert datos.entradas("ajustes").opcional("depositos") is None
+    assert extracciones == []
+    assert datos.entradas("transformaciones").opcional("lotes") is not None
+    assert extracciones == ["lotes"]
+
+    monkeypatch.setenv("COMPOSICION_MODO_SQL", "otro")
+    assert ce._modo_sql() == "pandas" and ce.entradas_etapa("compras") == ["lotes", "depositos"]
+
+
+# ---------- destinos finales en el servidor (INSERT ... SELECT) ----------
+def _correr(gen):
+    """Lista de mensajes y valor de retorno de una etapa generadora."""
+    lineas = []
+    while True:
+        try:
+            lineas.append(next(gen))
+        except StopIteration as fin:
+            return lineas, fin.value
+
+
+class _Conexion:
+    def __init__(self, error=None, filas=(3, 5, 2)):
+        self.error = error
+        self.filas = list(filas)
+        self.sentencias = []
+        self.commits = 0
+
+    def execute(self, stmt):
+        if self.error:
+            raise RuntimeError(self.error)
+        self.sentencias.append(" ".join(str(stmt).split()))
+        return type("R", (), {"rowcount": self.filas.pop(0)})()
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def _motor(conexion):
+    return type("Motor", (), {"connect": lambda self: conexion})()
+
+
+def test_destinos_en_servidor():
+    conn = _Conexion()
+    lineas, hecho = _correr(ce._destinos_finales_en_servidor(_motor(conn), "U", "U.DF_B", "U.DET_B"))
+    assert hecho is True and conn.commits == 1
+    assert conn.sentencias[0] == "DELETE FROM U.DF_B"
+    assert all(s.startswith("INSERT INTO U.DF_B") and "FROM U.DET_B d" in s for s in conn.sentencias[1:])
+    assert "Se insertaron 5 destinos en Producción/Concentración y 2 en Despachos." in lineas
+
+
+def test_destinos_en_servidor_sin_tabla_y_error():
+    conn = _Conexion(error="ORA-00942: table or view does not exist")
+    _, hecho = _correr(ce._destinos_finales_en_servidor(_motor(conn), "U", "U.DF_B", "U.DET_B"))
+    assert hecho is False  # se crea por el camino en memoria
+
+    conn = _Conexion(error="ORA-01536: space quota exceeded")
+    with pytest.raises(ce.EtapaFallida):
+        _correr(ce._destinos_finales_en_servidor(_motor(conn), "U", "U.DF_B", "U.DET_B"))
+
+
+# ---------- Maestro ----------
+def test_maestro_busquedas():
+    df = pd.DataFrame({
+        "c_lote": [30, "10", None, 20, 10, "x"],
+        "d_lote": ["L30", "L10", "SIN CLAVE", "L20", "L10 DUPLICADO", "INVALIDO"],
+    })
+    m = ce.Maestro(df, "c_lote", ["d_lote", "no_existe"])
+    # Claves nulas o no numéricas se descartan; las duplicadas conservan la primera fila
+    assert len(m) == 3 and m.claves.tolist() == [10, 20, 30]
+
+    claves = pd.Series([20, None, 10.0, 99, "30"], index=list("abcde"))
+    assert m.posiciones(claves).tolist() == [1, -1, 0, -1, 2]
+    d = m.buscar(claves, "d_lote")
+    assert d.index.tolist() == list("abcde") and d.dtype == "category"
+    assert d.astype(object).where(d.notna(), None).tolist() == ["L20", None, "L10", None, "L30"]
+    assert m.buscar(claves, "no_existe").isna().all()
+
+
+def test_maestro_vacio():
+    m = ce.Maestro(pd.DataFrame({"c_deposito": [], "d_deposito": []}), "c_deposito", ["d_deposito"])
+    assert len(m) == 0
+    assert m.buscar(pd.Series([1, None]), "d_deposito").isna().all()
+
+
+# ---------- esquema de APX_TRAZA_DETALLE ----------
+def test_normalizar_detalle():
+    df = pd.DataFrame({
+        "D_DORIGEN": ["TANQUE DE ACERO INOXIDABLE 01", None],
+        "C_LOTE": ["100", 200],
+        "CANTIDAD": ["1.5", None],
+        "C_PERIODO": [2024.0, None],
+        "COD_CUARTEL": [1.5, 2.0],
+        "F_MOVIMIENTO": ["2024-01-10 08:00:00", "no es fecha"],
+        "EXTRA": [1, 2],
+    }, index=[5, 7])
+    out = ce.normalizar_detalle(df)
+
+    # Columnas del esquema, en su orden; las que sobran se descartan y las que faltan quedan nulas
+    assert list(out.columns) == ce.COLUMNAS_DETALLE and out.index.tolist() == [5, 7]
+    assert {col: str(out[col].dtype) for col, dtype, _, _ in ce.ESQUEMA_DETALLE if dtype != "category"} == {
+        col: dtype for col, dtype, _, _ in ce.ESQUEMA_DETALLE if dtype != "category"
+    } | {"COD_CUARTEL": "Float64"}  # decimales en una columna entera: no se truncan
+    assert out["C_LOTE"].tolist() == [100, 200]
+    assert out["CANTIDAD"].iloc[0] == 1.5 and pd.isna(out["CANTIDAD"].iloc[1])
+    assert out["F_MOVIMIENTO"].iloc[0] == pd.Timestamp("2024-01-10 08:00") and pd.isna(out["F_MOVIMIENTO"].iloc[1])
+    assert out["MOS_ID"].isna().all() and out["D_LOTE"].isna().all()
+
+    # Descripciones de tanque: categóricas, recortadas al largo de la columna SQL y '' si faltan
+    d = out["D_DORIGEN"]
+    assert d.dtype == "category" and d.tolist() == ["TANQUE DE ACERO INOXIDABLE 01"[:ce.MAX_LEN_D_DEPOSITO], ""]
+    assert out["D_DDESTINO"].dtype == "category" and out["D_DDESTINO"].tolist() == ["", ""]
+    assert out["ORIGEN"].dtype == "category" and out["ORIGEN"].isna().all()
+
+
+def test_esquema_detalle_tipos_sql():
+    assert list(ce.DTYPE_SQL_DETALLE) == ce.COLUMNAS_DETALLE
+    assert ce.COLUMNAS_DETALLE[-len(ce.COLUMNAS_OT):] == ce.COLUMNAS_OT
+    assert ce.COLUMNAS_DETALLE_BASE + ce.COLUMNAS_OT == ce.COLUMNAS_DETALLE
+    assert ce.DTYPE_SQL_DETALLE["D_DORIGEN"].length == ce.MAX_LEN_D_DEPOSITO
+
+
+# ---------- backlog de transformaciones (APX_TRAZA_PENDIENTES) ----------
+COLUMNAS_PENDIENTES_SQL = (
+    "MOS_ID INT, DMS_ID INT, DPC_ID INT, C_LOTE_DESTINO INT, C_LOTE_ORIGEN INT, Q_ORIGEN_USADA REAL, "
+    "Q_ARTICULO_DESTINO REAL, C_DEPOSITO_ORIGEN INT, C_DEPOSITO_DESTINO INT, C_TIPO_COMPRO INT, "
+    "F_MOVIMIENTO TIMESTAMP, MOTIVO TEXT, F_ALTA TIMESTAMP, INTENTOS INT"
+)
+
+
+def _pendiente(mos_id, origen, destino, fecha="2024-01-01"):
+    return dict(mos_id=mos_id, dms_id=mos_id, dpc_id=mos_id, c_lote_destino=destino, c_lote_origen=origen,
+                q_origen_usada=100.0, q_articulo_destino=100.0, c_deposito_origen=1, c_deposito_destino=1,
+                c_tipo_compro=43, f_movimiento=pd.Timestamp(fecha))
+
+
+@pytest.fixture
+def base():
+    """SQLite en memoria con las tablas que usan el backlog y el reproceso (db_user 'main')."""
+    from sqlalchemy import create_engine, text
+    from sqlalchemy.pool import StaticPool
+
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    with engine.begin() as c:
+        c.execute(text(f"CREATE TABLE APX_TRAZA_PENDIENTES ({COLUMNAS_PENDIENTES_SQL})"))
+        c.execute(text(f"CREATE TABLE APX_TRAZA_DETALLE ({', '.join(ce.COLUMNAS_DETALLE)})"))
+        c.execute(text("CREATE TABLE APX_TRAZA_COMPOSICION_RESUMEN (C_LOTE INT, C_VARIEDAD_INV TEXT, C_PERIODO INT, "
+                       "ID_SUBVALLE TEXT, CANTIDAD REAL, PORCENTAJE REAL)"))
+        c.execute(text("CREATE TABLE LOTES_STOCK (C_LOTE INT, D_LOTE TEXT)"))
+        c.execute(text("CREATE TABLE DEPOSITOS (C_DEPOSITO INT, D_DEPOSITO TEXT)"))
+        c.execute(text("INSERT INTO LOTES_STOCK VALUES (2, 'L2'), (3, 'L3'), (8, 'L8')"))
+        c.execute(text("INSERT INTO DEPOSITOS VALUES (1, 'D1')"))
+    return engine
+
+
+def _guardar(engine, restantes, previos=None, lotes_origen=None):
+    previos = pd.DataFrame(columns=ce.COLUMNAS_PENDIENTE) if previos is None else previos
+    return _correr(ce.guardar_pendientes(engine, "main", pd.DataFrame(restantes, columns=ce.COLUMNAS_PENDIENTE),
+                                         previos, "SIN_COMPOSICION_ORIGEN", lotes_origen=lotes_origen))
+
+
+def _backlog(engine):
+    with engine.connect() as c:
+        return ce.cargar_pendientes(c, "main").sort_values("mos_id").reset_index(drop=True)
+
+
+def test_cierre_dependientes_en_cadena():
+    df = pd.DataFrame([_pendiente(1, 1, 2), _pendiente(2, 2, 3), _pendiente(3, 3, 4), _pendiente(4, 7, 8)])
+    assert ce._cierre_dependientes(df, [1]) == [1, 2, 3, 4]
+    assert ce._cierre_dependientes(df, [3, "7"]) == [3, 4, 7, 8]
+    assert ce._cierre_dependientes(df, [9]) == [9]
+
+
+def test_guardar_pendientes_conserva_alta_y_suma_intentos(base):
+    _, ok = _guardar(base, [_pendiente(10, 1, 2), _pendiente(11, 5, 6)])
+    assert ok
+    primero = _backlog(base)
+    assert primero["intentos"].tolist() == [1, 1] and set(primero["motivo"]) == {"SIN_COMPOSICION_ORIGEN"}
+
+    # Reintento: 10 sigue pendiente, 11 se resolvió y 12 es nueva
+    _guardar(base, [_pendiente(10, 1, 2), _pendiente(12, 1, 3)], previos=primero)
+    segundo = _backlog(base)
+    assert segundo["mos_id"].tolist() == [10, 12] and segundo["intentos"].tolist() == [2, 1]
+    assert pd.Timestamp(segundo["f_alta"][0]) == pd.Timestamp(primero["f_alta"][0])
+
+
+def test_guardar_pendientes_por_lotes_origen(base):
+    _guardar(base, [_pendiente(10, 1, 2), _pendiente(11, 5, 6), _pendiente(12, 1, 3)])
+    # Reproceso de los lotes origen 1: sólo se reemplazan sus entradas
+    lineas, ok = _guardar(base, [], previos=_backlog(base), lotes_origen=[1])
+    assert ok and "Backlog de transformaciones vacío: no quedan pendientes." in lineas
+    restantes = _backlog(base)
+    assert restantes["mos_id"].tolist() == [11] and restantes["intentos"].tolist() == [1]
+
+
+def test_guardar_pendientes_falla_sin_perder_el_backlog(base, monkeypatch):
+    _guardar(base, [_pendiente(10, 1, 2), _pendiente(11, 5, 6)])
+
+    def falla(*args, **kwargs):
+        raise RuntimeError("ORA-01653: unable to extend table")
+
+    monkeypatch.setattr(pd.DataFrame, "to_sql", falla)
+    lineas, ok = _guardar(base, [_pendiente(12, 1, 2)])
+    # El DELETE se deshace junto con el append fallido
+    assert not ok and any("queda como estaba" in l for l in lineas)
+    assert _backlog(base)["mos_id"].tolist() == [10, 11]
+
+
+def test_cargar_pendientes_sin_tabla(monkeypatch):
+    def lectura(error):
+        def read_sql(*args, **kwargs):
+            raise RuntimeError(error)
+        return read_sql
+
+    monkeypatch.setattr(pd, "read_sql", lectura("ORA-00942: table or view does not exist"))
+    df = ce.cargar_pendientes(None, "U")
+    assert df.empty and list(df.columns) == ce.COLUMNAS_PENDIENTE + ["motivo", "f_alta", "intentos"]
+    # Cualquier otro error no se disimula como backlog vacío
+    monkeypatch.setattr(pd, "read_sql", lectura("ORA-01017: invalid username/password"))
+    with pytest.raises(RuntimeError):
+        ce.cargar_pendientes(None, "U")
+
+
+def test_reprocesar_pendientes_lote_y_dependientes(base, monkeypatch):
+    from sqlalchemy import text
+
+    # 1 -> 2 -> 3 esperan composición del lote 1; 7 -> 8 no tiene que ver
+    _guardar(base, [_pendiente(10, 1, 2), _pendiente(11, 2, 3, "2024-01-02"), _pendiente(12, 7, 8)])
+    with base.begin() as c:
+        c.execute(text("INSERT INTO APX_TRAZA_DETALLE (C_LOTE, C_VARIEDAD_INV, C_PERIODO, ID_SUBVALLE, CANTIDAD) "
+                       "VALUES (1, 'MALBEC', 2024, 'VU', 500)"))
+
+    def conectar():
+        yield "conectado"
+        return base, "main"
+
+    monkeypatch.setattr(ce, "_conectar", conectar)
+    monkeypatch.setattr(ce, "_enriquecer_con_ordenes_trabajo", lambda df, engine: df)
+    monkeypatch.setattr(base, "dispose", lambda: None)
+    lineas = list(ce.reprocesar_pendientes([1]))
+
+    assert "Lotes origen pedidos: 1; con dependientes en el backlog: 3." in lineas
+    assert "Resueltas: 2; siguen pendientes: 0." in lineas
+    assert _backlog(base)["mos_id"].tolist() == [12]
+    detalle = pd.read_sql("SELECT C_LOTE, C_LOTE_ORIGEN, C_VARIEDAD_INV, CANTIDAD FROM APX_TRAZA_DETALLE "
+                          "WHERE C_LOTE_ORIGEN IS NOT NULL ORDER BY C_LOTE", base)
+    assert detalle.values.tolist() == [[2, 1, "MALBEC", 100.0], [3, 2, "MALBEC", 100.0]]
+    resumen = pd.read_sql("SELECT C_LOTE, PORCENTAJE FROM APX_TRAZA_COMPOSICION_RESUMEN ORDER BY C_LOTE", base)
+    assert resumen.values.tolist() == [[2, 100.0], [3, 100.0]]
@@ -0,0 +1,122 @@
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+
+import composicion_enologica as ce
+
+TABLAS = {
+    "APX_TRAZA_DETALLE": "APX_TRAZA_DETALLE_B",
+    "APX_TRAZA_DESTINO_FINAL": "APX_TRAZA_DESTINO_FINAL_B",
+    "APX_TRAZA_COMPOSICION_RESUMEN": "APX_TRAZA_COMPOSICION_RESUMEN_B",
+}
+
+
+class _ConexionFalsa:
+    def __init__(self, motor):
+        self._motor = motor
+
+    def execute(self, stmt, *args, **kwargs):
+        sql = str(stmt)
+        if self._motor.falla_insert and sql.lstrip().startswith("INSERT"):
+            raise RuntimeError("ORA-01536: space quota exceeded")
+        self._motor.sentencias.append(sql)
+        return SimpleNamespace(rowcount=0)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class _MotorFalso:
+    def __init__(self, falla_insert):
+        self.falla_insert = falla_insert
+        self.sentencias = []
+
+    @contextmanager
+    def connect(self):
+        yield _ConexionFalsa(self)
+
+    def dispose(self):
+        pass
+
+
+def _vacio(*args, **kwargs):
+    yield "etapa"
+    return pd.DataFrame()
+
+
+@pytest.fixture
+def corrida(monkeypatch):
+    llamadas = []
+
+    def conectar(motor):
+        def _conectar():
+            yield "conectado"
+            return motor, "U"
+        return _conectar
+
+    def preparar_staging(engine, db_user):
+        yield "staging"
+        return dict(TABLAS)
+
+    def registrar(nombre):
+        def etapa(*args, **kwargs):
+            llamadas.append(nombre)
+            yield nombre
+        return etapa
+
+    def transformaciones(*args, **kwargs):
+        yield "transformaciones"
+        backlog = {"df_restantes": pd.DataFrame(), "df_previos": pd.DataFrame(), "motivo": "SIN_COMPOSICION_ORIGEN"}
+        return pd.DataFrame(), None, backlog
+
+    def guardar_pendientes(engine, db_user, **backlog):
+        # Registra cuántos sinónimos ya se habían publicado cuando se escribe el backlog
+        llamadas.append(("backlog", sum("SYNONYM" in s for s in engine.sentencias)))
+        yield "backlog"
+
+    monkeypatch.setenv("COMPOSICION_MODO_SQL", "pushdown")
+    monkeypatch.setenv("COMPOSICION_PUBLICACION", "swap")
+    monkeypatch.setattr(ce, "preparar_staging", preparar_staging)
+    monkeypatch.setattr(ce, "procesar_compras", _vacio)
+    monkeypatch.setattr(ce, "procesar_ajustes_inventario", _vacio)
+    monkeypatch.setattr(ce, "procesar_transformaciones", transformaciones)
+    monkeypatch.setattr(ce, "_asegurar_indice", lambda *args: "índice")
+    monkeypatch.setattr(ce, "_tipo_objeto", lambda *args: "TABLE")
+    monkeypatch.setattr(ce, "exportar_grafo", registrar("grafo"))
+    monkeypatch.setattr(ce, "marcar_generacion", registrar("generacion"))
+    monkeypatch.setattr(ce, "guardar_pendientes", guardar_pendientes)
+    for nombre in ("lotes", "depositos", "movim_descubes"):
+        monkeypatch.setitem(ce.DATASETS, nombre, ("vacío", lambda datos: pd.DataFrame()))
+
+    def correr(falla_insert):
+        motor = _MotorFalso(falla_insert)
+        monkeypatch.setattr(ce, "_conectar", conectar(motor))
+        lineas = list(ce.ejecutar_proceso_completo("2024-01-01", "2024-01-31"))
+        sinonimos = [s for s in motor.sentencias if "SYNONYM" in s]
+        return lineas, sinonimos
+
+    return correr, llamadas
+
+
+def test_corrida_completa_publica(corrida):
+    correr, llamadas = corrida
+    lineas, sinonimos = correr(falla_insert=False)
+    assert len(sinonimos) == len(TABLAS)
+    # El backlog se reemplaza recién con las tablas ya publicadas
+    assert llamadas == [("backlog", len(TABLAS)), "grafo", "generacion"]
+    assert not any("CORRIDA INCOMPLETA" in l for l in lineas)
+
+
+def test_etapa_fallida_no_publica(corrida):
+    correr, llamadas = corrida
+    lineas, sinonimos = correr(falla_insert=True)
+    # Los destinos finales no se pudieron guardar: los sinónimos siguen apuntando a la corrida anterior
+    assert sinonimos == []
+    # ... y el backlog tampoco se toca
+    assert llamadas == []
+    assert any("CORRIDA INCOMPLETA" in l and "destinos finales" in l for l in lineas)
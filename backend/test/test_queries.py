@@ -0,0 +1,69 @@
+from types import SimpleNamespace
+
+import pytest
+
+from backend.app.core.config import settings
+from backend.app.services.trazabilidad import queries
+
+
+@pytest.fixture
+def limite(monkeypatch):
+    def fijar(n):
+        monkeypatch.setattr(settings, "oracle_in_clause_limit", n)
+    fijar(999)
+    return fijar
+
+
+def test_in_chunks(limite):
+    bloques = list(queries.in_chunks(range(2500)))
+    assert [len(b) for b in bloques] == [999, 999, 502]
+    assert [x for b in bloques for x in b] == list(range(2500))
+    assert list(queries.in_chunks([])) == []
+    limite(0)  # un límite inválido se toma como 1
+    assert list(queries.in_chunks([1, 2])) == [[1], [2]]
+
+
+def test_bind_bucket(limite):
+    assert [queries.bind_bucket(n) for n in (0, 1, 2, 3, 5, 64, 65, 500, 513)] == [1, 1, 2, 4, 8, 64, 128, 512, 999]
+    assert queries.bind_bucket(999) == 999 and queries.bind_bucket(5000) == 999
+    limite(100)
+    assert queries.bind_bucket(70) == 100
+
+
+def test_padded_entre_bloques(limite):
+    assert queries.padded([]) == []
+    assert queries.padded([7]) == [7]
+    assert queries.padded([1, 2, 3]) == [1, 2, 3, 3]
+    # Cada bloque se rellena con su propio último valor hasta su bucket
+    tamanos, ultimos = [], []
+    for bloque in queries.in_chunks(list(range(1, 1502))):
+        p = queries.padded(bloque)
+        tamanos.append(len(p))
+        assert p[:len(bloque)] == bloque and set(p[len(bloque):]) <= {bloque[-1]}
+        ultimos.append(p[-1])
+    assert tamanos == [999, 512] and ultimos == [999, 1501]
+
+
+def test_consulta_por_bloques_con_pocas_formas(limite):
+    ejecutados = []
+
+    def execute(stmt, params):
+        ejecutados.append((stmt, len(params["lotes"])))
+        return SimpleNamespace(mappings=lambda: SimpleNamespace(all=lambda: []))
+
+    conn = SimpleNamespace(execute=execute)
+    queries.fetch_destinos_finales(conn, list(range(2100)) + [5, 5], ref=SimpleNamespace(tablas={"APX_TRAZA_DESTINO_FINAL"}))
+    # Lotes repetidos una sola vez; 999 + 999 + 102 (bucket 128), siempre la misma sentencia
+    assert [n for _, n in ejecutados] == [999, 999, 128]
+    assert len({id(s) for s, _ in ejecutados}) == 1
+
+
+def test_stmt_se_construye_una_vez():
+    queries._stmt.cache_clear()
+    a = queries.stmt("movs_for_dests")
+    assert queries.stmt("movs_for_dests") is a
+    assert queries.stmt("movs_for_dests_hasta") is not a and "F_MOVIMIENTO <" in str(queries.stmt("movs_for_dests_hasta"))
+    assert queries._stmt.cache_info().hits == 2 and queries._stmt.cache_info().misses == 2
+    assert "WHERE 1=0" in str(queries.stmt("table_exists_LOTES_STOCK"))
+    with pytest.raises(KeyError):
+        queries.stmt("no_existe")
@@ -0,0 +1,26 @@
+import numpy as np
+
+from backend.app.services.trazabilidad import queries
+from backend.app.services.trazabilidad.refdata import RefData
+
+REF = RefData(
+    tablas=frozenset({"APX_TRAZA_DETALLE", "LOTES_STOCK"}),
+    lotes_c=np.array([10, 20, 30], dtype=np.int64),
+    lotes_d=np.array(["A", None, "C"], dtype=object),
+    depositos={5: "PILETA 5"},
+)
+
+class _SinConsultas:
+    def execute(self, *a, **k):
+        raise AssertionError("no debería consultar Oracle")
+
+def test_refdata_lookup():
+    assert REF.d_lote(30) == "C"
+    assert REF.tiene_lote(20) and REF.d_lote(20) is None
+    assert not REF.tiene_lote(25) and not REF.tiene_lote(99)
+
+def test_queries_usan_refdata():
+    conn = _SinConsultas()
+    assert queries.table_exists(conn, "APX_TRAZA_DETALLE", REF)
+    assert queries.fetch_lote_info(conn, 10, REF) == {"C_LOTE": "10", "D_LOTE": "A"}
+    assert queries.fetch_lotes_info(conn, [10, 30], REF) == {10: "A", 30: "C"}
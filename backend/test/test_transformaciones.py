@@ -0,0 +1,23 @@
+import pandas as pd
+
+import composicion_enologica as ce
+
+
+def _fila(mos_id, origen, destino, fecha):
+    return {"mos_id": mos_id, "c_lote_origen": origen, "c_lote_destino": destino, "f_movimiento": pd.Timestamp(fecha)}
+
+
+def test_componentes_fuertes_orden_topologico_inverso():
+    comps = ce.componentes_fuertes({1: [2], 2: [3], 3: [1, 4], 4: [5], 5: [4], 6: [1]})
+    assert [sorted(c) for c in comps] == [[4, 5], [1, 2, 3], [6]]
+
+
+def test_planificar_transformaciones_con_ciclo():
+    # 1 -> 2 <-> 3 (reclasificaciones de ida y vuelta), 2 -> 4; 1 -> 5 en el mismo paso que 1 -> 2
+    df = pd.DataFrame([
+        _fila(10, 1, 2, "2024-01-01"), _fila(11, 2, 3, "2024-01-02"), _fila(12, 3, 2, "2024-01-03"),
+        _fila(13, 2, 4, "2024-01-04"), _fila(14, 1, 5, "2024-01-01"),
+    ])
+    pasos, ciclos = ce.planificar_transformaciones(df)
+    assert pasos.tolist() == [0, 1, 2, 3, 0]
+    assert ciclos == [{"lotes": [2, 3], "transformaciones": 2}]
@@ -0,0 +1,310 @@
+from contextlib import nullcontext
+from types import SimpleNamespace
+
+import pytest
+from fastapi.testclient import TestClient
+
+from backend.app.main import app
+from backend.app.services.trazabilidad import queries, service
+
+client = TestClient(app)
+
+COMPONENTES = [
+    {"c_variedad_inv": "MALBEC", "c_periodo": 2024, "id_subvalle": "VU", "lts": 75.0, "pct": 75.0},
+    {"c_variedad_inv": "SYRAH", "c_periodo": 2023, "id_subvalle": None, "lts": 25.0, "pct": 25.0},
+]
+
+
+@pytest.fixture
+def real(monkeypatch):
+    """Servicio con el repositorio real sobre una conexión falsa; cada test parchea las consultas que usa."""
+    tablas = {"APX_TRAZA_DETALLE"}
+    monkeypatch.setattr(queries, "table_exists", lambda conn, nombre, ref=None: nombre in tablas)
+    monkeypatch.setattr(service, "_service", service.TraceService(
+        service.RealTraceRepository(engine_factory=lambda: SimpleNamespace(connect=nullcontext))))
+    return tablas
+
+
+# ---------- composición (APX_TRAZA_COMPOSICION_RESUMEN) ----------
+def test_composicion_fake():
+    r = client.get("/api/trazabilidad/lote/TEST123/composicion")
+    assert r.status_code == 200
+    data = r.json()
+    assert data["c_lote"] == "TEST123" and data["as_of"] is None
+    assert abs(sum(c["lts"] for c in data["componentes"]) - data["lts_total"]) < 1e-6
+    assert set(data["componentes"][0]) == {"c_variedad_inv", "c_periodo", "id_subvalle", "lts", "pct"}
+
+
+def test_composicion_real(real, monkeypatch):
+    monkeypatch.setattr(queries, "fetch_composicion_resumen", lambda conn, c_lote: COMPONENTES)
+    r = client.get("/api/trazabilidad/lote/100/composicion")
+    assert r.status_code == 200
+    assert r.json() == {"c_lote": "100", "as_of": None, "lts_total": 100.0, "componentes": COMPONENTES}
+
+
+def test_composicion_errores(real, monkeypatch):
+    assert client.get("/api/trazabilidad/lote/ABC/composicion").status_code == 422
+
+    def sin_tabla(conn, c_lote):
+        raise RuntimeError("ORA-00942: table or view does not exist")
+
+    monkeypatch.setattr(queries, "fetch_composicion_resumen", sin_tabla)
+    r = client.get("/api/trazabilidad/lote/100/composicion")
+    assert r.status_code == 501 and "APX_TRAZA_COMPOSICION_RESUMEN" in r.json()["detail"]
+
+
+# ---------- include=destinos (raíz / árbol) ----------
+# 1 <- 2 <- 3: cada lote tiene un destino final propio
+def _movs(conn, lotes, hasta=None):
+    origenes = {1: 2, 2: 3}
+    return {
+        lote: [{"C_LOTE": lote, "C_TIPO_COMPRO": 43, "F_MOVIMIENTO": None, "MOS_ID": lote * 10,
+                "C_LOTE_ORIGEN": origenes[lote], "VOL": 100.0}]
+        for lote in lotes if lote in origenes
+    }
+
+
+@pytest.fixture
+def arbol(real, monkeypatch):
+    consultas = []
+
+    def destinos(conn, lotes, ref=None):
+        consultas.append(sorted(lotes))
+        return {l: [{"c_lote": str(l), "fecha": None, "destino": "DESPACHADO", "volumen_lts": float(l),
+                     "mos_id_destino": None, "guia": None, "fel": None}] for l in lotes}
+
+    monkeypatch.setattr(queries, "fetch_movs_for_dests", _movs)
+    monkeypatch.setattr(queries, "fetch_lote_info", lambda conn, c_lote, ref=None: {"D_LOTE": f"L{c_lote}"})
+    monkeypatch.setattr(queries, "fetch_destinos_finales", destinos)
+    monkeypatch.setattr(queries, "sum_destinos_finales", lambda conn, c_lote, ref=None: 1.0)
+    return consultas
+
+
+def test_destinos_fake():
+    data = client.get("/api/trazabilidad/lote/TEST123?include=destinos").json()
+    assert data["timeline"] is None
+    assert [d["c_lote"] for d in data["destinos"]] == ["TEST123"]
+    assert client.get("/api/trazabilidad/lote/TEST123").json()["destinos"] is None
+
+
+@pytest.mark.parametrize("alcance, lotes", [("raiz", ["1"]), ("arbol", ["1", "2", "3"])])
+def test_destinos_alcance(arbol, alcance, lotes):
+    r = client.get(f"/api/trazabilidad/lote/1?include=destinos&destinos_alcance={alcance}")
+    assert r.status_code == 200
+    assert [d["c_lote"] for d in r.json()["destinos"]] == lotes
+    # Una sola búsqueda hacia adelante para todos los lotes del árbol
+    assert arbol == [[int(l) for l in lotes]]
+
+
+def test_destinos_errores(real):
+    assert client.get("/api/trazabilidad/lote/1?include=destinos&destinos_alcance=todo").status_code == 422
+    assert client.get("/api/trazabilidad/lote/ABC?include=destinos").status_code == 422
+    real.clear()  # sin APX_TRAZA_DETALLE
+    r = client.get("/api/trazabilidad/lote/1?include=destinos")
+    assert r.status_code == 501 and "APX_TRAZA_DETALLE" in r.json()["detail"]
+
+
+# ---------- POST /lotes (traza en bloque) ----------
+def test_lotes_fake():
+    r = client.post("/api/trazabilidad/lotes", json={"lotes": ["A", "B", "A"], "include_destinos": True})
+    assert r.status_code == 200
+    data = r.json()
+    assert [l["c_lote"] for l in data["lotes"]] == ["A", "B"]
+    assert set(data["grafo"]) == {"A", "B"} and set(data["destinos"]) == {"A", "B"}
+    assert all(l["subarbol"] == l["c_lote"] for l in data["lotes"])
+
+
+def test_lotes_real_comparte_subarboles(arbol, monkeypatch):
+    monkeypatch.setattr(queries, "fetch_lotes_info", lambda conn, lotes, ref=None: {l: f"L{l}" for l in lotes})
+    r = client.post("/api/trazabilidad/lotes", json={"lotes": ["1", "2", "X"], "max_depth": 5})
+    assert r.status_code == 200
+    data = r.json()
+    # El lote 2 es raíz y origen de 1: su subárbol se consulta y aparece una sola vez
+    assert sorted(data["grafo"]) == ["1", "2", "3"] and data["grafo"]["3"] == []
+    assert [e["c_lote_origen"] for e in data["grafo"]["1"]] == ["2"]
+    assert [(l["c_lote"], l["d_lote"], l["lotes_alcanzados"]) for l in data["lotes"]] == [("1", "L1", 2), ("2", "L2", 1)]
+    assert data["invalidos"] == ["X"] and data["destinos"] == {}
+    assert data["stats"] == {"niveles": 2, "consultas": 2, "lotes_consultados": 3}
+
+
+def test_lotes_errores(real, monkeypatch):
+    from backend.app.core.config import settings
+
+    monkeypatch.setattr(settings, "trace_batch_max_lotes", 2)
+    r = client.post("/api/trazabilidad/lotes", json={"lotes": ["1", "2", "3"]})
+    assert r.status_code == 422 and "Máximo 2" in r.json()["detail"]
+    assert client.post("/api/trazabilidad/lotes", json={"lotes": []}).status_code == 422
+    assert client.post("/api/trazabilidad/lotes", json={"lotes": ["X", "Y"]}).status_code == 422
+    real.clear()
+    assert client.post("/api/trazabilidad/lotes", json={"lotes": ["1"]}).status_code == 501
+
+
+# ---------- NDJSON (stream=1 / Accept) ----------
+def _registros(r):
+    import json
+    return [json.loads(l) for l in r.text.splitlines() if l]
+
+
+def test_ndjson_fake():
+    r = client.get("/api/trazabilidad/lote/TEST123?stream=1&include=timeline,destinos")
+    assert r.status_code == 200 and r.headers["content-type"].startswith("application/x-ndjson")
+    recs = _registros(r)
+    assert recs[0]["tipo"] == "identificacion" and recs[-1]["tipo"] == "resumen"
+    assert {rec["tipo"] for rec in recs[1:-1]} == {"nivel"}
+    assert recs[-1]["destinos"]
+
+
+def test_ndjson_real_por_niveles(arbol):
+    r = client.get("/api/trazabilidad/lote/1?include=timeline,destinos&destinos_alcance=arbol",
+                   headers={"Accept": "application/x-ndjson"})
+    assert r.status_code == 200
+    recs = _registros(r)
+    assert [(rec["tipo"], rec.get("nivel")) for rec in recs] == [
+        ("identificacion", None), ("nivel", 0), ("nivel", 1), ("nivel", 2), ("nivel", 3), ("resumen", None)]
+    assert recs[4]["nodos"] == []  # el lote 3 no tiene orígenes
+    assert recs[0]["identificacion"]["tanque_actual"] == "L1"
+    assert [n["c_lote_origen"] for n in recs[2]["nodos"]] == ["2"]
+    assert [d["c_lote"] for d in recs[-1]["destinos"]] == ["1", "2", "3"]
+    assert recs[-1]["total_nodos"] == 3 and recs[-1]["kpis"]["lts_destino"] == 100.0
+
+
+def test_ndjson_errores(real, arbol, monkeypatch):
+    # Validación antes de empezar a responder: status HTTP normal
+    assert client.get("/api/trazabilidad/lote/ABC?stream=1").status_code == 422
+    assert client.get("/api/trazabilidad/lote/1?stream=1&format=xml").status_code == 422
+
+    # Falla a mitad del recorrido: lo ya enviado queda y el último registro informa el error
+    def falla(conn, lotes, hasta=None):
+        raise RuntimeError("ORA-03113: end-of-file on communication channel")
+
+    monkeypatch.setattr(queries, "fetch_movs_for_dests", falla)
+    r = client.get("/api/trazabilidad/lote/1?stream=1")
+    recs = _registros(r)
+    assert r.status_code == 200 and recs[0]["tipo"] == "identificacion"
+    assert recs[-1]["tipo"] == "error" and "ORA-03113" in recs[-1]["detail"]
+
+    real.clear()
+    assert client.get("/api/trazabilidad/lote/1?stream=1").status_code == 501
+
+
+# ---------- format=columnar ----------
+def test_columnar_endpoint():
+    from backend.app.utils.columnar import decode_columnar
+
+    url = "/api/trazabilidad/lote/TEST123?include=timeline"
+    plano = client.get(url).json()
+    col = client.get(url + "&format=columnar").json()
+    assert col["origenes"]["n"] == len(plano["origenes"]) and "tipo" in col["origenes"]["dicts"]
+    assert decode_columnar(col["origenes"]) == plano["origenes"]
+    assert decode_columnar(col["timeline"]) == plano["timeline"]
+    assert col["kpis"] == plano["kpis"]
+
+
+# ---------- backlog de transformaciones (APX_TRAZA_PENDIENTES) ----------
+class _ConexionPendientes:
+    def __init__(self, filas):
+        self.filas = filas
+        self.consultas = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, stmt, params=None):
+        self.consultas.append((str(stmt), dict(params or {})))
+        if "COUNT(*)" in str(stmt):
+            return SimpleNamespace(scalar=lambda: len(self.filas))
+        p = params or {}
+        pagina = self.filas[p["offset"]:p["offset"] + p["limit"]]
+        return SimpleNamespace(mappings=lambda: SimpleNamespace(all=lambda: pagina))
+
+
+@pytest.fixture
+def backlog(monkeypatch):
+    from backend.app.services import db
+    from backend.app.services.composicion import pendientes
+
+    filas = [{"MOS_ID": i, "DMS_ID": i, "DPC_ID": i, "C_LOTE_ORIGEN": 1, "C_LOTE_DESTINO": 2,
+              "Q_ORIGEN_USADA": 10.0, "C_TIPO_COMPRO": 43, "F_MOVIMIENTO": None,
+              "MOTIVO": "SIN_COMPOSICION_ORIGEN", "F_ALTA": None, "INTENTOS": 2} for i in range(5)]
+    conn = _ConexionPendientes(filas)
+    existe = {"tabla": True}
+    monkeypatch.setattr(db, "get_engine", lambda: SimpleNamespace(connect=lambda: conn))
+    monkeypatch.setattr(pendientes, "probe_table", lambda c, nombre: existe["tabla"])
+    return conn, existe
+
+
+def test_pendientes_listar_pagina(backlog):
+    from backend.app.services.composicion import pendientes
+
+    conn, _ = backlog
+    data = pendientes.listar(page=2, page_size=2, c_lote_origen=1)
+    assert data["total"] == 5 and (data["page"], data["page_size"]) == (2, 2)
+    assert [i["mos_id"] for i in data["items"]] == [2, 3]
+    assert data["items"][0]["intentos"] == 2 and data["items"][0]["lts"] == 10.0
+    sql, params = conn.consultas[-1]
+    assert "C_LOTE_ORIGEN = :c_lote_origen" in sql and "OFFSET :offset ROWS" in sql
+    assert params == {"c_lote_origen": 1, "offset": 2, "limit": 2}
+
+
+def test_pendientes_endpoint(backlog):
+    _, existe = backlog
+    r = client.get("/api/composicion/pendientes?page=3&page_size=2")
+    assert r.status_code == 200
+    assert r.json()["total"] == 5 and [i["mos_id"] for i in r.json()["items"]] == [4]
+    assert client.get("/api/composicion/pendientes?page_size=0").status_code == 422
+    existe["tabla"] = False
+    r = client.get("/api/composicion/pendientes")
+    assert r.status_code == 501 and "APX_TRAZA_PENDIENTES" in r.json()["detail"]
+
+
+def test_pendientes_reprocesar(monkeypatch):
+    from backend.app.api.v1 import composicion
+
+    pedidos = []
+
+    def reproceso(lotes_origen):
+        pedidos.append(lotes_origen)
+        yield "data: listo\n\n"
+
+    monkeypatch.setattr(composicion, "stream_sse_reproceso", reproceso)
+    r = client.post("/api/composicion/pendientes/reprocesar", json={"lotes_origen": [1, 2]})
+    assert r.status_code == 200 and r.headers["content-type"].startswith("text/event-stream")
+    assert "data: listo" in r.text
+    # Sin lotes: todo el backlog
+    client.post("/api/composicion/pendientes/reprocesar", json={"lotes_origen": []})
+    assert pedidos == [[1, 2], None]
+
+
+# ---------- descendientes (hacia adelante) ----------
+def test_descendientes_fake():
+    r = client.get("/api/trazabilidad/lote/TEST123/descendientes?max_depth=1")
+    assert r.status_code == 200
+    assert r.json()["fuente"] == "fake" and [n["nivel"] for n in r.json()["niveles"]] == [1]
+
+
+def test_descendientes_oracle(real, monkeypatch):
+    from backend.app.services.trazabilidad import grafo
+
+    # 1 -> 2, 3; 2 -> 4; 3 -> 4 (4 aparece una sola vez); 4 -> 1 (ciclo)
+    hacia = {1: [2, 3], 2: [4], 3: [4], 4: [1]}
+    consultas = []
+
+    def lotes_destino(conn, lotes):
+        consultas.append(sorted(lotes))
+        return {l: hacia[l] for l in lotes if l in hacia}
+
+    monkeypatch.setattr(grafo, "get", lambda: None)
+    monkeypatch.setattr(queries, "fetch_lotes_destino", lotes_destino)
+    data = client.get("/api/trazabilidad/lote/1/descendientes?max_depth=5").json()
+    assert data["fuente"] == "oracle" and data["total_lotes"] == 3
+    assert data["niveles"] == [{"nivel": 1, "lotes": ["2", "3"]}, {"nivel": 2, "lotes": ["4"]}]
+    # Un IN por nivel; el nivel 3 (desde 4) no descubre nada nuevo
+    assert consultas == [[1], [2, 3], [4]]
+
+    assert client.get("/api/trazabilidad/lote/1/descendientes?max_depth=1").json()["total_lotes"] == 2
+    assert client.get("/api/trazabilidad/lote/ABC/descendientes").status_code == 422
+    real.clear()
+    assert client.get("/api/trazabilidad/lote/1/descendientes").status_code == 501
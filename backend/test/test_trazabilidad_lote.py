@@ -14,3 +14,56 @@ def test_trazabilidad_lote_ok():
 def test_trazabilidad_lote_bad_depth():
     r = client.get("/api/trazabilidad/lote/TEST123?max_depth=0")
     assert r.status_code == 422  # valida parámetro
+
+def test_trazabilidad_children_fake():
+    r = client.get("/api/trazabilidad/lote/TEST123/children")
+    assert r.status_code == 200
+    hijos = r.json()["children"]
+    assert len(hijos) == 2 and hijos[0]["n_children"] == 2
+    nietos = client.get(f"/api/trazabilidad/lote/TEST123/children?node={hijos[0]['c_lote_origen']}&nivel=1").json()["children"]
+    assert len(nietos) == 2
+
+def test_trazabilidad_etag_304():
+    url = "/api/trazabilidad/lote/TEST123?include=timeline"
+    r = client.get(url)
+    etag = r.headers["etag"]
+    assert r.status_code == 200 and r.headers["cache-control"] == "no-cache"
+    r = client.get(url, headers={"If-None-Match": etag})
+    assert r.status_code == 304 and r.headers["etag"] == etag and not r.content
+    # Otros parámetros u otra representación (NDJSON) -> otro ETag
+    assert client.get(url + ",destinos").headers["etag"] != etag
+    assert client.get(url + "&stream=1").headers["etag"] != etag
+
+
+def test_trazabilidad_etag_sigue_la_generacion(monkeypatch):
+    from contextlib import contextmanager
+    from types import SimpleNamespace
+    from backend.app.core.config import settings
+    from backend.app.services.trazabilidad import refdata
+    from backend.app.services.trazabilidad import service
+    from backend.app.services.trazabilidad.refdata import RefData
+
+    en_base = {"generacion": 7}
+
+    @contextmanager
+    def connect():
+        yield SimpleNamespace(execute=lambda stmt: SimpleNamespace(scalar=lambda: en_base["generacion"]))
+
+    monkeypatch.setattr(service, "_service", service.TraceService(service.FakeTraceRepository()))
+    monkeypatch.setattr(settings, "trace_mode", "real")
+    monkeypatch.setattr(settings, "trace_generacion_check_seconds", 0.0)
+    monkeypatch.setattr(refdata.db, "get_engine", lambda: SimpleNamespace(connect=connect))
+    # La instantánea queda en la generación 7 aunque la base avance
+    monkeypatch.setattr(refdata, "_actual", RefData(generacion=7))
+    url = "/api/trazabilidad/lote/TEST123/composicion"
+    etag = client.get(url).headers["etag"]
+    # Misma generación: 304 sin consultar la traza
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+    # Una corrida nueva (CLI, otro worker) cambia la generación en la base y con ella el ETag
+    en_base["generacion"] = 8
+    r = client.get(url, headers={"If-None-Match": etag})
+    assert r.status_code == 200 and r.headers["etag"] != etag
+    # Sin generación legible no hay ETag (nada de 304 con datos dudosos)
+    en_base["generacion"] = None
+    r = client.get(url, headers={"If-None-Match": etag})
+    assert r.status_code == 200 and "etag" not in r.headers
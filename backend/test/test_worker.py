@@ -0,0 +1,30 @@
+from backend.app.services.composicion.worker import ComposicionWorker
+
+MODULO = '''
+def ejecutar_proceso_completo(desde, hasta):
+    yield f"corrida {desde}"
+
+def reprocesar_pendientes(lotes):
+    yield "reproceso"
+    raise RuntimeError("falla")
+'''
+
+
+def test_worker_dos_corridas_sin_mensajes_cruzados(tmp_path, monkeypatch):
+    modulo = tmp_path / "composicion_prueba.py"
+    modulo.write_text(MODULO, encoding="utf-8")
+    # El worker (spawn) vuelve a leer la configuración del entorno
+    monkeypatch.setenv("COMPOSICION_MODULE_PATH", str(modulo))
+    monkeypatch.setenv("COMPOSICION_METRIC_SECONDS", "3600")
+    monkeypatch.setenv("COMPOSICION_WORKER_NICE", "0")
+    worker = ComposicionWorker()
+    try:
+        primera = list(worker.run("2024-01-01", "2024-01-31"))
+        segunda = list(worker.run(None, funcion="reprocesar_pendientes"))
+    finally:
+        worker.stop()
+    # La métrica final llega antes del cierre de su corrida, no al principio de la siguiente
+    assert [k for k, _ in primera] == ["log", "metric", "done"]
+    assert primera[0] == ("log", "corrida 2024-01-01")
+    assert [k for k, _ in segunda] == ["log", "metric", "error"]
+    assert segunda[0] == ("log", "reproceso") and segunda[-1][1]["code"] == "RUNTIME_ERROR"
@@ -10,12 +10,94 @@ import os
 import getpass
 from pathlib import Path
 import math
+import json
+import shutil
 import traceback
 
 # --- Constantes ---
 MAX_LEN_D_DEPOSITO = 20
 COLUMNAS_OT = ['C_TAREA', 'D_TAREA', 'OBS_DESTINO', 'OBS_GENERALES', 'OBS_ORIGEN', 'CANT_ART_DESTINO', 'CANT_ART_ORIGEN']
 
+
+class EtapaFallida(Exception):
+    """Una etapa no pudo guardar sus resultados: la corrida se corta y no se publica."""
+
+# --- Esquema de APX_TRAZA_DETALLE ---
+# Única definición de las columnas de salida: orden, dtype en memoria y tipo SQL de to_sql.
+# (columna, dtype pandas, tipo SQL, largo máximo a recortar o None)
+ESQUEMA_DETALLE = [
+    ('C_LOTE', 'Int64', BigInteger, None),
+    ('C_VARIEDAD_INV', 'string', String(50), None),
+    ('C_PERIODO', 'Int32', Integer, None),
+    ('ID_SUBVALLE', 'string', String(8), None),
+    ('CANTIDAD', 'float64', Numeric(precision=20, scale=5), None),
+    ('CLAVE_EXT_LOTE', 'string', String(100), None),
+    ('MOS_ID', 'Int64', Integer, None),
+    ('ID', 'Int64', Integer, None),
+    ('C_TIPO_COMPRO', 'Int32', Integer, None),
+    ('F_MOVIMIENTO', 'datetime64[ns]', DateTime, None),
+    ('C_LOTE_ORIGEN', 'Int64', BigInteger, None),
+    ('PORCENTAJE_SI', 'Float64', Numeric(precision=5, scale=2), None),
+    ('CIU_NUMERO', 'Int64', BigInteger, None),
+    ('NRO_INSCRIPCION', 'string', String(7), None),
+    ('COD_CUARTEL', 'Int32', Integer, None),
+    ('CUARTEL_LOG', 'string', String(6), None),
+    ('D_LOTE', 'string', String(54), None),
+    ('C_DORIGEN', 'Int32', Integer, None),
+    ('D_DORIGEN', 'category', String(MAX_LEN_D_DEPOSITO), MAX_LEN_D_DEPOSITO),
+    ('C_DDESTINO', 'Int32', Integer, None),
+    ('D_DDESTINO', 'category', String(MAX_LEN_D_DEPOSITO), MAX_LEN_D_DEPOSITO),
+    ('ORIGEN', 'category', String(20), None),
+    ('C_TAREA', 'string', String(255), None),
+    ('D_TAREA', 'string', String(255), None),
+    ('OBS_DESTINO', 'string', String(255), None),
+    ('OBS_GENERALES', 'string', String(255), None),
+    ('OBS_ORIGEN', 'string', String(255), None),
+    ('CANT_ART_DESTINO', 'float64', Numeric(precision=20, scale=5), None),
+    ('CANT_ART_ORIGEN', 'float64', Numeric(precision=20, scale=5), None),
+]
+COLUMNAS_DETALLE = [col for col, _, _, _ in ESQUEMA_DETALLE]
+# Columnas que arma cada etapa antes de sumar las de órdenes de trabajo
+COLUMNAS_DETALLE_BASE = [col for col in COLUMNAS_DETALLE if col not in COLUMNAS_OT]
+DTYPE_SQL_DETALLE = {col: tipo_sql for col, _, tipo_sql, _ in ESQUEMA_DETALLE}
+
+def _columna_detalle(serie, dtype: str, largo, index) -> pd.Series:
+    if dtype == 'category':
+        # Se trabaja sobre los valores distintos (pocos tanques / orígenes), no fila por fila
+        codigos, unicos = pd.factorize(serie if serie is not None else pd.Series([None] * len(index), dtype=object))
+        textos = pd.Series(unicos, dtype=object).astype('string')
+        if largo is not None:
+            textos = pd.concat([textos.str.slice(0, largo), pd.Series([''], dtype='string')], ignore_index=True)
+            codigos = np.where(codigos < 0, len(textos) - 1, codigos)
+        recodigos, categorias = pd.factorize(textos)
+        if len(recodigos):
+            codigos = np.where(codigos < 0, -1, recodigos.take(np.clip(codigos, 0, None)))
+        return pd.Series(pd.Categorical.from_codes(codigos, categories=categorias.astype('string')), index=index)
+    if serie is None or (serie.dtype == object and serie.isna().all()):
+        vacio = {'float64': np.nan, 'datetime64[ns]': pd.NaT}.get(dtype, pd.NA)
+        return pd.Series(vacio, index=index, dtype=dtype)
+    if dtype in ('Int64', 'Int32'):
+        numerica = pd.to_numeric(serie, errors='coerce')
+        try: return numerica.astype(dtype)
+        except (TypeError, ValueError): return numerica.astype('Float64')  # decimales: no se truncan
+    if dtype in ('float64', 'Float64'):
+        return pd.to_numeric(serie, errors='coerce').astype(dtype)
+    if dtype == 'datetime64[ns]':
+        # pandas >= 3 infiere la resolución (us, s) al parsear: se fija la del esquema
+        return pd.to_datetime(serie, errors='coerce').astype(dtype)
+    return serie.astype('string')
+
+def normalizar_detalle(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Frame con las columnas de APX_TRAZA_DETALLE, en orden y con los dtypes de ESQUEMA_DETALLE.
+    Cada columna se convierte una sola vez; las que faltan se crean nulas con su dtype final.
+    """
+    columnas = {
+        col: _columna_detalle(df[col] if col in df.columns else None, dtype, largo, df.index)
+        for col, dtype, _, largo in ESQUEMA_DETALLE
+    }
+    return pd.DataFrame(columnas, index=df.index)
+
 # --- Helper Function para Chunking ---
 def ejecutar_consulta_con_chunks(
     sql_select_part: str, id_column_name_in_sql: str, id_list: list,
@@ -104,13 +186,66 @@ def _enriquecer_con_ordenes_trabajo(df_principal: pd.DataFrame, engine: sqlalche
     
     return df_enriquecido
 
+# --- Maestros compartidos (LOTES_STOCK / DEPOSITOS) ---
+class Maestro:
+    """
+    Maestro de sólo lectura, cargado una vez por corrida y compartido por todas las etapas.
+    Las claves quedan en un array int64 ordenado (búsqueda binaria con searchsorted) y cada
+    descripción como códigos int32 + categorías (pd.factorize): sin copias por etapa ni merges por texto.
+    """
+
+    def __init__(self, df: pd.DataFrame, clave: str, columnas: list):
+        claves = pd.to_numeric(df[clave], errors='coerce') if clave in df.columns else pd.Series(dtype='float64')
+        validas = claves.notna().to_numpy()
+        claves = claves[validas].astype('int64').to_numpy()
+        # Claves duplicadas: queda la primera, como la primera fila que devolvía el merge
+        claves, primeras = np.unique(claves, return_index=True)
+        claves.flags.writeable = False
+        self.clave = clave
+        self.claves = claves
+        self._codigos = {}
+        self._categorias = {}
+        for col in columnas:
+            valores = df[col][validas].iloc[primeras] if col in df.columns else pd.Series([None] * len(claves))
+            codigos, categorias = pd.factorize(valores)
+            codigos = codigos.astype('int32')
+            codigos.flags.writeable = False
+            self._codigos[col] = codigos
+            self._categorias[col] = categorias
+
+    def __len__(self) -> int:
+        return len(self.claves)
+
+    def posiciones(self, claves) -> np.ndarray:
+        """Posición de cada clave en el maestro (-1 si no está o es nula)."""
+        claves = pd.to_numeric(pd.Series(claves), errors='coerce')
+        validas = claves.notna().to_numpy()
+        buscadas = claves[validas].astype('int64').to_numpy()
+        pos = np.searchsorted(self.claves, buscadas)
+        encontradas = pos < len(self.claves)
+        encontradas[encontradas] = self.claves[pos[encontradas]] == buscadas[encontradas]
+        salida = np.full(len(claves), -1, dtype=np.int64)
+        salida[np.flatnonzero(validas)[encontradas]] = pos[encontradas]
+        return salida
+
+    def buscar(self, claves: pd.Series, columna: str, posiciones: np.ndarray = None) -> pd.Series:
+        """Columna del maestro alineada a `claves` (categórica; nulo si la clave no está)."""
+        if posiciones is None:
+            posiciones = self.posiciones(claves)
+        codigos = self._codigos[columna]
+        tomados = np.where(posiciones >= 0, codigos.take(np.clip(posiciones, 0, None)) if len(codigos) else -1, -1)
+        return pd.Series(pd.Categorical.from_codes(tomados, categories=self._categorias[columna]), index=claves.index)
+
+# --- Modo de ejecución SQL de compras / ajustes ---
+# 'pandas' (por defecto): extracciones por tabla y cruces en memoria.
+# 'pushdown': un único JOIN en Oracle por etapa que devuelve ya las columnas de APX_TRAZA_DETALLE,
+#             y los destinos finales con INSERT ... SELECT sin pasar por el cliente.
+def _modo_sql() -> str:
+    modo = (os.getenv('COMPOSICION_MODO_SQL') or 'pandas').strip().lower()
+    return modo if modo in ('pandas', 'pushdown') else 'pandas'
+
 # --- Lógica de Procesamiento ---
-def procesar_descubes(
-    datos_movim: dict,
-    df_lotes: pd.DataFrame,
-    df_cl: pd.DataFrame,
-    df_depositos: pd.DataFrame
-) -> pd.DataFrame:
+def procesar_descubes(datos_movim: dict) -> pd.DataFrame:
     """
     Descubes (C_TIPO_COMPRO = 28) SIN cruce con COSECHA_*, COSECHA_DEPOSITO,
     COSECHA_CUARTEL ni depósitos. Solo LOTES origen/destino y cantidades.
@@ -185,314 +320,400 @@ def procesar_descubes(
         "ORIGEN"       : "Descube"
     })
 
-    # Orden estándar esperado por APX_TRAZA_DETALLE
-    cols_finales = [
-        "C_LOTE","C_VARIEDAD_INV","C_PERIODO","ID_SUBVALLE","CANTIDAD","CLAVE_EXT_LOTE",
-        "MOS_ID","ID","C_TIPO_COMPRO","F_MOVIMIENTO","C_LOTE_ORIGEN","PORCENTAJE_SI",
-        "CIU_NUMERO","NRO_INSCRIPCION","COD_CUARTEL","CUARTEL_LOG","D_LOTE",
-        "C_DORIGEN","D_DORIGEN","C_DDESTINO","D_DDESTINO","ORIGEN"
-    ]
-    out = out.reindex(columns=cols_finales)
+    # Orden estándar esperado por APX_TRAZA_DETALLE (los dtypes finales los pone normalizar_detalle)
+    out = out.reindex(columns=COLUMNAS_DETALLE_BASE)
     return out
 
-def procesar_compras(engine: sqlalchemy.engine.Engine, fecha_desde_str: str, fecha_fin_str: str, db_user: str, df_lotes: pd.DataFrame, df_depositos: pd.DataFrame):
+def _compras_pandas(connection: Connection, fecha_desde_str: str, fecha_fin_str: str, lotes: Maestro, depositos: Maestro):
+    sql_factura_compra = f"""SELECT ID, F_FACTURA, C_TIPO_COMPRO FROM FACTURA_COMPRAS WHERE C_TIPO_COMPRO = 13 AND F_FACTURA >= TO_DATE(:f_ini, 'YYYY-MM-DD') AND F_FACTURA < TO_DATE(:f_fin, 'YYYY-MM-DD') + 1"""
+    df_fc = pd.read_sql(text(sql_factura_compra), connection, params={'f_ini': fecha_desde_str, 'f_fin': fecha_fin_str})
+    if df_fc.empty:
+        yield "No se encontraron compras en el período."
+        return pd.DataFrame()
+    original_fc_cols = df_fc.columns.tolist()
+    rename_map_fc = {}
+    id_col_original = next((col for col in original_fc_cols if col.lower() == 'id'), None)
+    if id_col_original: rename_map_fc[id_col_original] = 'fac_id_header'
+    else:
+        yield f"Error Crítico Compras: No se encontró la columna 'ID'. Columnas: {original_fc_cols}"
+        return pd.DataFrame()
+    for col in original_fc_cols:
+        if col != id_col_original: rename_map_fc[col] = col.lower()
+    df_fc = df_fc.rename(columns=rename_map_fc)
+    if 'fac_id_header' not in df_fc.columns:
+        yield f"Error Inesperado Compras: Falló renombrado. Columnas: {df_fc.columns.tolist()}"
+        return pd.DataFrame()
+    lista_fac_id = df_fc['fac_id_header'].dropna().unique().tolist()
+    sql_det_fc_base = "SELECT FAC_ID, ID, C_LOTE_STOCK, Q_ARTICULO, C_ARTICULO, COSECHA, C_DEPOSITO FROM DET_FAC_COM"
+    df_det_fc = ejecutar_consulta_con_chunks(sql_det_fc_base, "FAC_ID", lista_fac_id, 999, connection)
+    if df_det_fc.empty: return pd.DataFrame()
+    df_det_fc = df_det_fc.rename(columns={'id': 'det_fac_id'}, errors='ignore')
+    if 'c_deposito' not in df_det_fc.columns:
+        yield "Advertencia Compras: No se encontró 'c_deposito' en DET_FAC_COM."
+        df_det_fc['c_deposito'] = None
+    lista_articulos = df_det_fc['c_articulo'].dropna().unique().tolist()
+    sql_items_base = "SELECT C_ARTICULO, C_TEMPORADA, TIPO_CLASIF FROM ITEMS"
+    df_items = ejecutar_consulta_con_chunks(sql_items_base, "C_ARTICULO", lista_articulos, 999, connection, where_clause_base="AND TIPO_CLASIF IN (4, 14)")
+    if df_items.empty: return pd.DataFrame()
+    df_det_fc['fac_id'] = pd.to_numeric(df_det_fc['fac_id'], errors='coerce')
+    df_fc['fac_id_header'] = pd.to_numeric(df_fc['fac_id_header'], errors='coerce')
+    df_merged = pd.merge(df_det_fc, df_fc, left_on='fac_id', right_on='fac_id_header', suffixes=('_det', '_fac'))
+    df_merged = pd.merge(df_merged, df_items[['c_articulo', 'c_temporada']], on='c_articulo', how='inner')
+    df_merged['c_lote_stock'] = pd.to_numeric(df_merged['c_lote_stock'], errors='coerce')
+    pos_lotes = lotes.posiciones(df_merged['c_lote_stock'])
+    for col in ['clave_externa', 'id_subvalle', 'd_lote']:
+        df_merged[col] = lotes.buscar(df_merged['c_lote_stock'], col, pos_lotes)
+    if 'c_deposito' in df_merged.columns:
+        df_merged['c_deposito'] = pd.to_numeric(df_merged['c_deposito'], errors='coerce')
+        df_merged['d_dorigen'] = depositos.buscar(df_merged['c_deposito'], 'd_deposito')
+    else: df_merged['d_dorigen'] = None
+    df_composicion = pd.DataFrame()
+    df_composicion['C_LOTE'] = df_merged['c_lote_stock']
+    df_composicion['C_VARIEDAD_INV'] = df_merged['c_temporada']
+    df_composicion['C_PERIODO'] = df_merged['cosecha']
+    df_composicion['ID_SUBVALLE'] = df_merged['id_subvalle']
+    df_composicion['CANTIDAD'] = df_merged['q_articulo']
+    df_composicion['CLAVE_EXT_LOTE'] = df_merged['clave_externa']
+    df_composicion['MOS_ID'] = df_merged['fac_id']
+    df_composicion['ID'] = df_merged['det_fac_id']
+    df_composicion['C_TIPO_COMPRO'] = df_merged['c_tipo_compro']
+    df_composicion['F_MOVIMIENTO'] = df_merged['f_factura']
+    df_composicion['C_LOTE_ORIGEN'] = None
+    df_composicion['PORCENTAJE_SI'] = None
+    df_composicion['CIU_NUMERO'] = None
+    df_composicion['NRO_INSCRIPCION'] = None
+    df_composicion['COD_CUARTEL'] = None
+    df_composicion['CUARTEL_LOG'] = None
+    df_composicion['D_LOTE'] = df_merged.get('d_lote')
+    df_composicion['C_DORIGEN'] = df_merged.get('c_deposito')
+    df_composicion['D_DORIGEN'] = df_merged.get('d_dorigen')
+    df_composicion['C_DDESTINO'] = None
+    df_composicion['D_DDESTINO'] = None
+    df_composicion['ORIGEN'] = 'Compra'
+    return df_composicion
+
+def _compras_pushdown(connection: Connection, fecha_desde_str: str, fecha_fin_str: str):
+    # Un solo JOIN en Oracle: viajan sólo las filas y columnas finales de APX_TRAZA_DETALLE
+    sql_compras = f"""
+        SELECT dfc.C_LOTE_STOCK AS C_LOTE, it.C_TEMPORADA AS C_VARIEDAD_INV, dfc.COSECHA AS C_PERIODO,
+               ls.ID_SUBVALLE, dfc.Q_ARTICULO AS CANTIDAD, ls.CLAVE_EXTERNA AS CLAVE_EXT_LOTE,
+               fc.ID AS MOS_ID, dfc.ID AS ID, fc.C_TIPO_COMPRO, fc.F_FACTURA AS F_MOVIMIENTO,
+               ls.D_LOTE, dfc.C_DEPOSITO AS C_DORIGEN, SUBSTR(dep.D_DEPOSITO, 1, {MAX_LEN_D_DEPOSITO}) AS D_DORIGEN
+        FROM FACTURA_COMPRAS fc
+        JOIN DET_FAC_COM dfc ON dfc.FAC_ID = fc.ID
+        JOIN ITEMS it ON it.C_ARTICULO = dfc.C_ARTICULO AND it.TIPO_CLASIF IN (4, 14)
+        LEFT JOIN LOTES_STOCK ls ON ls.C_LOTE = dfc.C_LOTE_STOCK
+        LEFT JOIN DEPOSITOS dep ON dep.C_DEPOSITO = dfc.C_DEPOSITO
+        WHERE fc.C_TIPO_COMPRO = 13 AND fc.F_FACTURA >= TO_DATE(:f_ini, 'YYYY-MM-DD') AND fc.F_FACTURA < TO_DATE(:f_fin, 'YYYY-MM-DD') + 1"""
+    df_composicion = pd.read_sql(text(sql_compras), connection, params={'f_ini': fecha_desde_str, 'f_fin': fecha_fin_str})
+    df_composicion.columns = df_composicion.columns.str.upper()
+    if df_composicion.empty:
+        yield "No se encontraron compras en el período."
+        return pd.DataFrame()
+    yield f"Compras (pushdown): {len(df_composicion)} filas devueltas por Oracle."
+    df_composicion['ORIGEN'] = 'Compra'
+    for col in ['C_LOTE_ORIGEN', 'PORCENTAJE_SI', 'CIU_NUMERO', 'NRO_INSCRIPCION', 'COD_CUARTEL', 'CUARTEL_LOG', 'C_DDESTINO', 'D_DDESTINO']:
+        df_composicion[col] = None
+    return df_composicion
+
+def procesar_compras(engine: sqlalchemy.engine.Engine, fecha_desde_str: str, fecha_fin_str: str, db_user: str, lotes: Maestro = None, depositos: Maestro = None):
     yield "\n--- Iniciando Procesamiento de Compras (Tipo 13) ---"
     with engine.connect() as connection:
-        sql_factura_compra = f"""SELECT ID, F_FACTURA, C_TIPO_COMPRO FROM FACTURA_COMPRAS WHERE C_TIPO_COMPRO = 13 AND F_FACTURA >= TO_DATE(:f_ini, 'YYYY-MM-DD') AND F_FACTURA < TO_DATE(:f_fin, 'YYYY-MM-DD') + 1"""
-        df_fc = pd.read_sql(text(sql_factura_compra), connection, params={'f_ini': fecha_desde_str, 'f_fin': fecha_fin_str})
-        if df_fc.empty:
-            yield "No se encontraron compras en el período."
-            return pd.DataFrame()
-        original_fc_cols = df_fc.columns.tolist()
-        rename_map_fc = {}
-        id_col_original = next((col for col in original_fc_cols if col.lower() == 'id'), None)
-        if id_col_original: rename_map_fc[id_col_original] = 'fac_id_header'
+        if _modo_sql() == 'pushdown':
+            df_composicion = yield from _compras_pushdown(connection, fecha_desde_str, fecha_fin_str)
         else:
-            yield f"Error Crítico Compras: No se encontró la columna 'ID'. Columnas: {original_fc_cols}"
-            return pd.DataFrame()
-        for col in original_fc_cols:
-            if col != id_col_original: rename_map_fc[col] = col.lower()
-        df_fc = df_fc.rename(columns=rename_map_fc)
-        if 'fac_id_header' not in df_fc.columns:
-            yield f"Error Inesperado Compras: Falló renombrado. Columnas: {df_fc.columns.tolist()}"
-            return pd.DataFrame()
-        lista_fac_id = df_fc['fac_id_header'].dropna().unique().tolist()
-        sql_det_fc_base = "SELECT FAC_ID, ID, C_LOTE_STOCK, Q_ARTICULO, C_ARTICULO, COSECHA, C_DEPOSITO FROM DET_FAC_COM"
-        df_det_fc = ejecutar_consulta_con_chunks(sql_det_fc_base, "FAC_ID", lista_fac_id, 999, connection)
-        if df_det_fc.empty: return pd.DataFrame()
-        df_det_fc = df_det_fc.rename(columns={'id': 'det_fac_id'}, errors='ignore')
-        if 'c_deposito' not in df_det_fc.columns:
-            yield "Advertencia Compras: No se encontró 'c_deposito' en DET_FAC_COM."
-            df_det_fc['c_deposito'] = None
-        lista_articulos = df_det_fc['c_articulo'].dropna().unique().tolist()
-        sql_items_base = "SELECT C_ARTICULO, C_TEMPORADA, TIPO_CLASIF FROM ITEMS"
-        df_items = ejecutar_consulta_con_chunks(sql_items_base, "C_ARTICULO", lista_articulos, 999, connection, where_clause_base="AND TIPO_CLASIF IN (4, 14)")
-        if df_items.empty: return pd.DataFrame()
-        df_det_fc['fac_id'] = pd.to_numeric(df_det_fc['fac_id'], errors='coerce')
-        df_fc['fac_id_header'] = pd.to_numeric(df_fc['fac_id_header'], errors='coerce')
-        df_merged = pd.merge(df_det_fc, df_fc, left_on='fac_id', right_on='fac_id_header', suffixes=('_det', '_fac'))
-        df_merged = pd.merge(df_merged, df_items[['c_articulo', 'c_temporada']], on='c_articulo', how='inner')
-        df_merged['c_lote_stock'] = pd.to_numeric(df_merged['c_lote_stock'], errors='coerce')
-        df_lotes['c_lote'] = pd.to_numeric(df_lotes['c_lote'], errors='coerce')
-        lotes_cols_sel = ['c_lote', 'clave_externa', 'id_subvalle']
-        if 'd_lote' in df_lotes.columns: lotes_cols_sel.append('d_lote')
-        df_merged = pd.merge(df_merged, df_lotes[lotes_cols_sel], left_on='c_lote_stock', right_on='c_lote', how='left', suffixes=('', '_lote'))
-        if 'c_deposito' in df_merged.columns:
-            df_depositos_sel = df_depositos[['c_deposito', 'd_deposito']].rename(columns={'d_deposito': 'd_dorigen'})
-            df_merged['c_deposito'] = pd.to_numeric(df_merged['c_deposito'], errors='coerce')
-            df_depositos_sel['c_deposito'] = pd.to_numeric(df_depositos_sel['c_deposito'], errors='coerce')
-            df_merged = pd.merge(df_merged, df_depositos_sel, on='c_deposito', how='left')
-        else: df_merged['d_dorigen'] = None
-        df_composicion = pd.DataFrame()
-        df_composicion['C_LOTE'] = df_merged['c_lote_stock']
-        df_composicion['C_VARIEDAD_INV'] = df_merged['c_temporada']
-        df_composicion['C_PERIODO'] = df_merged['cosecha']
-        df_composicion['ID_SUBVALLE'] = df_merged['id_subvalle']
-        df_composicion['CANTIDAD'] = df_merged['q_articulo']
-        df_composicion['CLAVE_EXT_LOTE'] = df_merged['clave_externa']
-        df_composicion['MOS_ID'] = df_merged['fac_id']
-        df_composicion['ID'] = df_merged['det_fac_id']
-        df_composicion['C_TIPO_COMPRO'] = df_merged['c_tipo_compro']
-        df_composicion['F_MOVIMIENTO'] = df_merged['f_factura']
-        df_composicion['C_LOTE_ORIGEN'] = None
-        df_composicion['PORCENTAJE_SI'] = None
-        df_composicion['CIU_NUMERO'] = None
-        df_composicion['NRO_INSCRIPCION'] = None
-        df_composicion['COD_CUARTEL'] = None
-        df_composicion['CUARTEL_LOG'] = None
-        df_composicion['D_LOTE'] = df_merged.get('d_lote')
-        df_composicion['C_DORIGEN'] = df_merged.get('c_deposito')
-        df_composicion['D_DORIGEN'] = df_merged.get('d_dorigen')
-        df_composicion['C_DDESTINO'] = None
-        df_composicion['D_DDESTINO'] = None
-        df_composicion['ORIGEN'] = 'Compra'
+            df_composicion = yield from _compras_pandas(connection, fecha_desde_str, fecha_fin_str, lotes, depositos)
+        if df_composicion.empty: return pd.DataFrame()
     
         yield "Enriqueciendo compras con datos de órdenes de trabajo..."
         df_composicion = _enriquecer_con_ordenes_trabajo(df_composicion, engine)
-        
-        for col_lower in ['c_lote', 'mos_id', 'id', 'c_periodo', 'c_tipo_compro', 'ciu_numero', 'cod_cuartel', 'c_lote_origen', 'porcentaje_si', 'c_dorigen', 'c_ddestino']:
-            col_upper = col_lower.upper()
-            if col_upper in df_composicion.columns:
-                try: df_composicion[col_upper] = pd.to_numeric(df_composicion[col_upper], errors='coerce').astype('Int64')
-                except Exception:
-                    try: df_composicion[col_upper] = pd.to_numeric(df_composicion[col_upper], errors='coerce').astype('Float64')
-                    except Exception as e: yield f"Advertencia Compra: No se pudo convertir {col_lower}: {e}"
-        
-        if 'F_MOVIMIENTO' in df_composicion.columns: df_composicion['F_MOVIMIENTO'] = pd.to_datetime(df_composicion['F_MOVIMIENTO'], errors='coerce')
-        
-        string_cols_lower = ['c_variedad_inv', 'id_subvalle', 'clave_ext_lote', 'nro_inscripcion', 'cuartel_log', 'd_lote', 'origen', 'd_dorigen', 'd_ddestino'] + [c.lower() for c in COLUMNAS_OT]
-        for col_lower in string_cols_lower:
-            col_upper = col_lower.upper()
-            if col_upper in df_composicion.columns: df_composicion[col_upper] = df_composicion[col_upper].astype(pd.StringDtype())
-        
-        if 'D_DORIGEN' in df_composicion.columns: df_composicion['D_DORIGEN'] = df_composicion['D_DORIGEN'].fillna('').str.slice(0, MAX_LEN_D_DEPOSITO)
-        if 'D_DDESTINO' in df_composicion.columns: df_composicion['D_DDESTINO'] = df_composicion['D_DDESTINO'].fillna('').str.slice(0, MAX_LEN_D_DEPOSITO)
+        return normalizar_detalle(df_composicion)
 
-        if 'CANTIDAD' in df_composicion.columns: df_composicion['CANTIDAD'] = df_composicion['CANTIDAD'].astype(float)
-        
-        final_order = ['C_LOTE', 'C_VARIEDAD_INV', 'C_PERIODO', 'ID_SUBVALLE', 'CANTIDAD', 'CLAVE_EXT_LOTE', 'MOS_ID', 'ID', 'C_TIPO_COMPRO', 'F_MOVIMIENTO', 'C_LOTE_ORIGEN', 'PORCENTAJE_SI', 'CIU_NUMERO', 'NRO_INSCRIPCION', 'COD_CUARTEL', 'CUARTEL_LOG', 'D_LOTE', 'C_DORIGEN', 'D_DORIGEN', 'C_DDESTINO', 'D_DDESTINO', 'ORIGEN'] + COLUMNAS_OT
-        for col in final_order:
-            if col not in df_composicion.columns: df_composicion[col] = None
-        df_composicion = df_composicion.reindex(columns=final_order)
-        return df_composicion
+TIPOS_AJUSTE = [31, 95]
 
-def procesar_ajustes_inventario(engine: sqlalchemy.engine.Engine, fecha_desde_str: str, fecha_fin_str: str, db_user: str, df_lotes: pd.DataFrame, df_depositos: pd.DataFrame):
-    yield "\n--- Iniciando Procesamiento de Ajustes de Inventario (Tipos 31, 95) ---"
-    tipos_ajuste = [31, 95]
+def _ajustes_pandas(connection: Connection, fecha_desde_str: str, fecha_fin_str: str, lotes: Maestro, depositos: Maestro):
+    sql_movim_ajuste = f"SELECT ID, F_MOVIMIENTO, C_TIPO_COMPRO FROM MOVIM_STOCK WHERE C_TIPO_COMPRO IN ({','.join(map(str, TIPOS_AJUSTE))}) AND F_MOVIMIENTO >= TO_DATE(:f_ini, 'YYYY-MM-DD') AND F_MOVIMIENTO < TO_DATE(:f_fin, 'YYYY-MM-DD') + 1"
+    df_ms = pd.read_sql(text(sql_movim_ajuste), connection, params={'f_ini': fecha_desde_str, 'f_fin': fecha_fin_str})
+    if df_ms.empty:
+        yield "No se encontraron ajustes de inventario en el período."
+        return pd.DataFrame()
+    
+    df_ms.columns = df_ms.columns.str.lower()
+    df_ms = df_ms.rename(columns={'id': 'mos_id'}, errors='ignore')
+
+    lista_mos_id = df_ms['mos_id'].dropna().unique().tolist()
+    sql_dms_base = "SELECT ID, MOS_ID, C_LOTE, C_ARTICULO, Q_ARTICULO, COSECHA, C_DEPOSITO FROM DET_MOV_STOCK"
+    df_dms = ejecutar_consulta_con_chunks(sql_dms_base, "MOS_ID", lista_mos_id, 999, connection)
+    if df_dms.empty: return pd.DataFrame()
+    df_dms = df_dms.rename(columns={'id': 'dms_id'}, errors='ignore')
+
+    lista_articulos = df_dms['c_articulo'].dropna().unique().tolist()
+    sql_items_base = "SELECT C_ARTICULO, C_TEMPORADA, TIPO_CLASIF FROM ITEMS"
+    df_items = ejecutar_consulta_con_chunks(sql_items_base, "C_ARTICULO", lista_articulos, 999, connection, where_clause_base="AND TIPO_CLASIF IN (4, 14)")
+    if df_items.empty: return pd.DataFrame()
+
+    df_dms['mos_id'] = pd.to_numeric(df_dms['mos_id'], errors='coerce')
+    df_ms['mos_id'] = pd.to_numeric(df_ms['mos_id'], errors='coerce')
+    df_merged = pd.merge(df_dms, df_ms, on='mos_id')
+    df_merged = pd.merge(df_merged, df_items[['c_articulo', 'c_temporada']], on='c_articulo', how='inner')
+
+    df_merged['c_lote'] = pd.to_numeric(df_merged['c_lote'], errors='coerce')
+    pos_lotes = lotes.posiciones(df_merged['c_lote'])
+    for col in ['clave_externa', 'id_subvalle', 'd_lote']:
+        df_merged[col] = lotes.buscar(df_merged['c_lote'], col, pos_lotes)
     
+    if 'c_deposito' in df_merged.columns:
+        df_merged['c_deposito'] = pd.to_numeric(df_merged['c_deposito'], errors='coerce')
+        df_merged['d_dorigen'] = depositos.buscar(df_merged['c_deposito'], 'd_deposito')
+    else:
+        df_merged['d_dorigen'] = None
+
+    df_composicion = pd.DataFrame()
+    df_composicion['C_LOTE'] = df_merged['c_lote']
+    df_composicion['C_VARIEDAD_INV'] = df_merged['c_temporada']
+    df_composicion['C_PERIODO'] = df_merged['cosecha']
+    df_composicion['ID_SUBVALLE'] = df_merged['id_subvalle']
+    df_composicion['CANTIDAD'] = df_merged['q_articulo']
+    df_composicion['CLAVE_EXT_LOTE'] = df_merged['clave_externa']
+    df_composicion['MOS_ID'] = df_merged['mos_id']
+    df_composicion['ID'] = df_merged['dms_id']
+    df_composicion['C_TIPO_COMPRO'] = df_merged['c_tipo_compro']
+    df_composicion['F_MOVIMIENTO'] = df_merged['f_movimiento']
+    df_composicion['D_LOTE'] = df_merged.get('d_lote')
+    df_composicion['C_DORIGEN'] = df_merged.get('c_deposito')
+    df_composicion['D_DORIGEN'] = df_merged.get('d_dorigen')
+    df_composicion['ORIGEN'] = 'Ajuste Inv.'
+    
+    return df_composicion
+
+def _ajustes_pushdown(connection: Connection, fecha_desde_str: str, fecha_fin_str: str):
+    # Un solo JOIN en Oracle: viajan sólo las filas y columnas finales de APX_TRAZA_DETALLE
+    sql_ajustes = f"""
+        SELECT dms.C_LOTE, it.C_TEMPORADA AS C_VARIEDAD_INV, dms.COSECHA AS C_PERIODO,
+               ls.ID_SUBVALLE, dms.Q_ARTICULO AS CANTIDAD, ls.CLAVE_EXTERNA AS CLAVE_EXT_LOTE,
+               ms.ID AS MOS_ID, dms.ID AS ID, ms.C_TIPO_COMPRO, ms.F_MOVIMIENTO,
+               ls.D_LOTE, dms.C_DEPOSITO AS C_DORIGEN, SUBSTR(dep.D_DEPOSITO, 1, {MAX_LEN_D_DEPOSITO}) AS D_DORIGEN
+        FROM MOVIM_STOCK ms
+        JOIN DET_MOV_STOCK dms ON dms.MOS_ID = ms.ID
+        JOIN ITEMS it ON it.C_ARTICULO = dms.C_ARTICULO AND it.TIPO_CLASIF IN (4, 14)
+        LEFT JOIN LOTES_STOCK ls ON ls.C_LOTE = dms.C_LOTE
+        LEFT JOIN DEPOSITOS dep ON dep.C_DEPOSITO = dms.C_DEPOSITO
+        WHERE ms.C_TIPO_COMPRO IN ({','.join(map(str, TIPOS_AJUSTE))}) AND ms.F_MOVIMIENTO >= TO_DATE(:f_ini, 'YYYY-MM-DD') AND ms.F_MOVIMIENTO < TO_DATE(:f_fin, 'YYYY-MM-DD') + 1"""
+    df_composicion = pd.read_sql(text(sql_ajustes), connection, params={'f_ini': fecha_desde_str, 'f_fin': fecha_fin_str})
+    df_composicion.columns = df_composicion.columns.str.upper()
+    if df_composicion.empty:
+        yield "No se encontraron ajustes de inventario en el período."
+        return pd.DataFrame()
+    yield f"Ajustes (pushdown): {len(df_composicion)} filas devueltas por Oracle."
+    df_composicion['ORIGEN'] = 'Ajuste Inv.'
+    return df_composicion
+
+def procesar_ajustes_inventario(engine: sqlalchemy.engine.Engine, fecha_desde_str: str, fecha_fin_str: str, db_user: str, lotes: Maestro = None, depositos: Maestro = None):
+    yield "\n--- Iniciando Procesamiento de Ajustes de Inventario (Tipos 31, 95) ---"
     with engine.connect() as connection:
-        sql_movim_ajuste = f"SELECT ID, F_MOVIMIENTO, C_TIPO_COMPRO FROM MOVIM_STOCK WHERE C_TIPO_COMPRO IN ({','.join(map(str, tipos_ajuste))}) AND F_MOVIMIENTO >= TO_DATE(:f_ini, 'YYYY-MM-DD') AND F_MOVIMIENTO < TO_DATE(:f_fin, 'YYYY-MM-DD') + 1"
-        df_ms = pd.read_sql(text(sql_movim_ajuste), connection, params={'f_ini': fecha_desde_str, 'f_fin': fecha_fin_str})
-        if df_ms.empty:
-            yield "No se encontraron ajustes de inventario en el período."
-            return pd.DataFrame()
-        
-        df_ms.columns = df_ms.columns.str.lower()
-        df_ms = df_ms.rename(columns={'id': 'mos_id'}, errors='ignore')
-
-        lista_mos_id = df_ms['mos_id'].dropna().unique().tolist()
-        sql_dms_base = "SELECT ID, MOS_ID, C_LOTE, C_ARTICULO, Q_ARTICULO, COSECHA, C_DEPOSITO FROM DET_MOV_STOCK"
-        df_dms = ejecutar_consulta_con_chunks(sql_dms_base, "MOS_ID", lista_mos_id, 999, connection)
-        if df_dms.empty: return pd.DataFrame()
-        df_dms = df_dms.rename(columns={'id': 'dms_id'}, errors='ignore')
-
-        lista_articulos = df_dms['c_articulo'].dropna().unique().tolist()
-        sql_items_base = "SELECT C_ARTICULO, C_TEMPORADA, TIPO_CLASIF FROM ITEMS"
-        df_items = ejecutar_consulta_con_chunks(sql_items_base, "C_ARTICULO", lista_articulos, 999, connection, where_clause_base="AND TIPO_CLASIF IN (4, 14)")
-        if df_items.empty: return pd.DataFrame()
-
-        df_dms['mos_id'] = pd.to_numeric(df_dms['mos_id'], errors='coerce')
-        df_ms['mos_id'] = pd.to_numeric(df_ms['mos_id'], errors='coerce')
-        df_merged = pd.merge(df_dms, df_ms, on='mos_id')
-        df_merged = pd.merge(df_merged, df_items[['c_articulo', 'c_temporada']], on='c_articulo', how='inner')
-
-        df_merged['c_lote'] = pd.to_numeric(df_merged['c_lote'], errors='coerce')
-        df_lotes['c_lote'] = pd.to_numeric(df_lotes['c_lote'], errors='coerce')
-        lotes_cols_sel = ['c_lote', 'clave_externa', 'id_subvalle', 'd_lote']
-        df_merged = pd.merge(df_merged, df_lotes[lotes_cols_sel], on='c_lote', how='left')
-        
-        if 'c_deposito' in df_merged.columns:
-            df_depositos_sel = df_depositos[['c_deposito', 'd_deposito']].rename(columns={'d_deposito': 'd_dorigen'})
-            df_merged['c_deposito'] = pd.to_numeric(df_merged['c_deposito'], errors='coerce')
-            df_depositos_sel['c_deposito'] = pd.to_numeric(df_depositos_sel['c_deposito'], errors='coerce')
-            df_merged = pd.merge(df_merged, df_depositos_sel, on='c_deposito', how='left')
+        if _modo_sql() == 'pushdown':
+            df_composicion = yield from _ajustes_pushdown(connection, fecha_desde_str, fecha_fin_str)
         else:
-            df_merged['d_dorigen'] = None
-
-        df_composicion = pd.DataFrame()
-        df_composicion['C_LOTE'] = df_merged['c_lote']
-        df_composicion['C_VARIEDAD_INV'] = df_merged['c_temporada']
-        df_composicion['C_PERIODO'] = df_merged['cosecha']
-        df_composicion['ID_SUBVALLE'] = df_merged['id_subvalle']
-        df_composicion['CANTIDAD'] = df_merged['q_articulo']
-        df_composicion['CLAVE_EXT_LOTE'] = df_merged['clave_externa']
-        df_composicion['MOS_ID'] = df_merged['mos_id']
-        df_composicion['ID'] = df_merged['dms_id']
-        df_composicion['C_TIPO_COMPRO'] = df_merged['c_tipo_compro']
-        df_composicion['F_MOVIMIENTO'] = df_merged['f_movimiento']
-        df_composicion['D_LOTE'] = df_merged.get('d_lote')
-        df_composicion['C_DORIGEN'] = df_merged.get('c_deposito')
-        df_composicion['D_DORIGEN'] = df_merged.get('d_dorigen')
-        df_composicion['ORIGEN'] = 'Ajuste Inv.'
-        
+            df_composicion = yield from _ajustes_pandas(connection, fecha_desde_str, fecha_fin_str, lotes, depositos)
+        if df_composicion.empty: return pd.DataFrame()
+
         for col in ['C_LOTE_ORIGEN', 'PORCENTAJE_SI', 'CIU_NUMERO', 'NRO_INSCRIPCION', 'COD_CUARTEL', 'CUARTEL_LOG', 'C_DDESTINO', 'D_DDESTINO']:
             df_composicion[col] = None
 
         yield "Enriqueciendo ajustes con datos de órdenes de trabajo..."
         df_composicion = _enriquecer_con_ordenes_trabajo(df_composicion, engine)
+        return normalizar_detalle(df_composicion)
 
-        for col_lower in ['c_lote', 'mos_id', 'id', 'c_periodo', 'c_tipo_compro', 'c_dorigen']:
-            col_upper = col_lower.upper()
-            if col_upper in df_composicion.columns:
-                 try: df_composicion[col_upper] = pd.to_numeric(df_composicion[col_upper], errors='coerce').astype('Int64')
-                 except Exception:
-                      try: df_composicion[col_upper] = pd.to_numeric(df_composicion[col_upper], errors='coerce').astype('Float64')
-                      except Exception as e: yield f"Advertencia Ajuste Inv: No se pudo convertir {col_lower}: {e}"
-        
-        if 'F_MOVIMIENTO' in df_composicion.columns: df_composicion['F_MOVIMIENTO'] = pd.to_datetime(df_composicion['F_MOVIMIENTO'], errors='coerce')
-        string_cols_lower = ['c_variedad_inv', 'id_subvalle', 'clave_ext_lote', 'd_lote', 'origen', 'd_dorigen'] + [c.lower() for c in COLUMNAS_OT]
-        for col_lower in string_cols_lower:
-             col_upper = col_lower.upper()
-             if col_upper in df_composicion.columns: df_composicion[col_upper] = df_composicion[col_upper].astype(pd.StringDtype())
-        
-        if 'D_DORIGEN' in df_composicion.columns:
-            df_composicion['D_DORIGEN'] = df_composicion['D_DORIGEN'].fillna('').str.slice(0, MAX_LEN_D_DEPOSITO)
-
-        if 'CANTIDAD' in df_composicion.columns: df_composicion['CANTIDAD'] = df_composicion['CANTIDAD'].astype(float)
-
-        final_order = ['C_LOTE', 'C_VARIEDAD_INV', 'C_PERIODO', 'ID_SUBVALLE', 'CANTIDAD', 'CLAVE_EXT_LOTE', 'MOS_ID', 'ID', 'C_TIPO_COMPRO', 'F_MOVIMIENTO', 'C_LOTE_ORIGEN', 'PORCENTAJE_SI', 'CIU_NUMERO', 'NRO_INSCRIPCION', 'COD_CUARTEL', 'CUARTEL_LOG', 'D_LOTE', 'C_DORIGEN', 'D_DORIGEN', 'C_DDESTINO', 'D_DDESTINO', 'ORIGEN'] + COLUMNAS_OT
-        for col in final_order:
-            if col not in df_composicion.columns: df_composicion[col] = None
-        df_composicion = df_composicion.reindex(columns=final_order)
-        return df_composicion
-
-def procesar_transformaciones(engine: sqlalchemy.engine.Engine, fecha_desde_str: str, fecha_fin_str: str, db_user: str, df_lotes: pd.DataFrame, df_depositos: pd.DataFrame):
-    yield "\n--- Iniciando Procesamiento de Transformaciones (Tipos 43, 30, 46) ---"
-    target_table = 'APX_TRAZA_DETALLE'
-    tipos_transformacion = [43, 30, 46]
+def calcular_transferencias(df_procesables: pd.DataFrame, df_composicion_origen: pd.DataFrame) -> pd.DataFrame:
+    """
+    Reparte lo que cada transformación tomó de su lote origen (q_origen_usada) entre los
+    componentes de ese lote, en proporción a su cantidad. Devuelve sólo las filas con
+    cantidad_transferida > 0.
+    """
+    df_composicion_origen = df_composicion_origen.rename(columns={'c_lote': 'c_lote_origen_comp', 'cantidad': 'cantidad_componente_origen'})
+    df_composicion_origen['c_lote_origen_comp'] = pd.to_numeric(df_composicion_origen['c_lote_origen_comp'], errors='coerce')
+    df_composicion_origen['cantidad_componente_origen'] = pd.to_numeric(df_composicion_origen['cantidad_componente_origen'], errors='coerce').fillna(0)
+    # El total se calcula sobre la composición del lote, no sobre el cruce: si varias transformaciones
+    # salen del mismo lote en el mismo paso, cada una se reparte sobre el 100% del lote
+    df_composicion_origen['total_lote_origen'] = df_composicion_origen.groupby('c_lote_origen_comp')['cantidad_componente_origen'].transform('sum')
+
+    df_calculo = pd.merge(df_procesables, df_composicion_origen, left_on='c_lote_origen', right_on='c_lote_origen_comp', how='left')
+    df_calculo['cantidad_componente_origen'] = df_calculo['cantidad_componente_origen'].fillna(0)
+    df_calculo['total_lote_origen'] = pd.to_numeric(df_calculo['total_lote_origen'], errors='coerce').fillna(1).replace(0, 1)
+    df_calculo['q_origen_usada'] = pd.to_numeric(df_calculo['q_origen_usada'], errors='coerce').fillna(0)
+    df_calculo['cantidad_transferida'] = np.round((df_calculo['cantidad_componente_origen'] / df_calculo['total_lote_origen']) * df_calculo['q_origen_usada'], 5)
+
+    return df_calculo[df_calculo['cantidad_transferida'] > 1e-9].copy()
+
+# --- Orden de resolución de transformaciones ---
+# Grafo de lotes origen -> destino de las transformaciones pendientes. Las componentes fuertemente
+# conexas (Tarjan) son los ciclos (A -> B -> A por reclasificaciones). Cada transformación recibe un
+# paso: una transformación sale de su lote origen recién cuando ese lote recibió todo lo que le llega
+# de otras componentes; dentro de un ciclo las transformaciones van de a una en orden cronológico
+# (F_MOVIMIENTO, MOS_ID), cada una con la composición que el lote tiene en ese momento.
+
+def componentes_fuertes(sucesores: dict) -> list:
+    """
+    Componentes fuertemente conexas (Tarjan, iterativo) de un grafo {nodo: [sucesores]}.
+    Se devuelven en orden topológico inverso: cada componente aparece antes que las que le apuntan.
+    """
+    indice, bajo, en_pila = {}, {}, set()
+    pila, componentes = [], []
+    contador = 0
+    for raiz in sucesores:
+        if raiz in indice:
+            continue
+        indice[raiz] = bajo[raiz] = contador
+        contador += 1
+        pila.append(raiz)
+        en_pila.add(raiz)
+        recorrido = [(raiz, iter(sucesores.get(raiz, ())))]
+        while recorrido:
+            nodo, hijos = recorrido[-1]
+            avanzo = False
+            for hijo in hijos:
+                if hijo not in indice:
+                    indice[hijo] = bajo[hijo] = contador
+                    contador += 1
+                    pila.append(hijo)
+                    en_pila.add(hijo)
+                    recorrido.append((hijo, iter(sucesores.get(hijo, ()))))
+                    avanzo = True
+                    break
+                if hijo in en_pila:
+                    bajo[nodo] = min(bajo[nodo], indice[hijo])
+            if avanzo:
+                continue
+            recorrido.pop()
+            if recorrido:
+                padre = recorrido[-1][0]
+                bajo[padre] = min(bajo[padre], bajo[nodo])
+            if bajo[nodo] == indice[nodo]:
+                componente = []
+                while True:
+                    miembro = pila.pop()
+                    en_pila.discard(miembro)
+                    componente.append(miembro)
+                    if miembro == nodo:
+                        break
+                componentes.append(componente)
+    return componentes
+
+def planificar_transformaciones(df: pd.DataFrame):
+    """
+    Paso de resolución de cada fila de `df` (c_lote_origen -> c_lote_destino) y ciclos encontrados.
+    Devuelve (pasos: np.ndarray int alineado con df, ciclos: lista de {'lotes', 'transformaciones'}).
+    """
+    origen = pd.to_numeric(df['c_lote_origen'], errors='coerce')
+    destino = pd.to_numeric(df['c_lote_destino'], errors='coerce')
+    validas = origen.notna() & destino.notna()
+    aristas = pd.DataFrame({'o': origen[validas].astype('int64'), 'd': destino[validas].astype('int64')}).drop_duplicates()
+
+    sucesores: dict = {}
+    for o, d in zip(aristas['o'].tolist(), aristas['d'].tolist()):
+        sucesores.setdefault(o, []).append(d)
+        sucesores.setdefault(d, [])
+    componentes = componentes_fuertes(sucesores)
+    comp_de = {lote: i for i, comp in enumerate(componentes) for lote in comp}
+
+    predecesoras: dict = {}
+    for o, d in zip(aristas['o'].tolist(), aristas['d'].tolist()):
+        if comp_de[o] != comp_de[d]:
+            predecesoras.setdefault(comp_de[d], set()).add(comp_de[o])
+
+    comp_o = np.array([comp_de.get(x, -1) for x in origen.fillna(-1).astype('int64').tolist()], dtype=np.int64)
+    comp_d = np.array([comp_de.get(x, -1) for x in destino.fillna(-1).astype('int64').tolist()], dtype=np.int64)
+    internas = (comp_o >= 0) & (comp_o == comp_d)
+
+    # Tarjan entrega orden topológico inverso: se recorre al revés para fijar los pasos
+    fin = np.zeros(len(componentes), dtype=np.int64)
+    pasos = np.zeros(len(df), dtype=np.int64)
+    ciclos = []
+    for c in range(len(componentes) - 1, -1, -1):
+        base = max((fin[p] + 1 for p in predecesoras.get(c, ())), default=0)
+        fin[c] = base
+        if len(componentes[c]) > 1:
+            filas = np.flatnonzero(internas & (comp_o == c))
+            orden = df.iloc[filas][['f_movimiento', 'mos_id']].copy()
+            orden['f_movimiento'] = pd.to_datetime(orden['f_movimiento'], errors='coerce')
+            rango = orden.groupby(['f_movimiento', 'mos_id'], sort=True, dropna=False).ngroup().to_numpy()
+            pasos[filas] = base + rango
+            fin[c] = base + (int(rango.max()) + 1 if len(rango) else 0)
+            ciclos.append({'lotes': sorted(int(x) for x in componentes[c]), 'transformaciones': int(orden['mos_id'].nunique())})
+    externas = (comp_o >= 0) & ~internas
+    pasos[externas] = fin[comp_o[externas]]
+    return pasos, ciclos
+
+def resolver_transformaciones(engine: sqlalchemy.engine.Engine, db_user: str, df_transform_pendientes: pd.DataFrame, lotes: Maestro, depositos: Maestro, tablas: dict = None):
+    """
+    Resuelve las transformaciones en el orden de planificar_transformaciones: en cada paso toma las
+    transformaciones del paso cuyo lote origen tiene composición en APX_TRAZA_DETALLE, reparte y guarda.
+    Las que no tienen composición de origen quedan pendientes sin frenar al resto.
+    Devuelve (filas guardadas, transformaciones sin resolver con su ciclo, motivo).
+    """
+    target_table = _fisica(tablas, 'APX_TRAZA_DETALLE')
+    df_final_acumulado = pd.DataFrame()
+    motivo = None
+    if df_transform_pendientes.empty:
+        return df_final_acumulado, df_transform_pendientes, motivo
+
+    df_transform_pendientes = df_transform_pendientes.reset_index(drop=True)
+    pasos, ciclos = planificar_transformaciones(df_transform_pendientes)
+    df_transform_pendientes['_paso'] = pasos
+    df_transform_pendientes['ciclo'] = pd.NA
+    if ciclos:
+        yield f"ADVERTENCIA: {len(ciclos)} ciclo(s) en el grafo de transformaciones; se resuelven en orden cronológico:"
+        for n, ciclo in enumerate(ciclos, start=1):
+            lista = ', '.join(map(str, ciclo['lotes'][:10])) + (' ...' if len(ciclo['lotes']) > 10 else '')
+            yield f"  Ciclo {n}: {len(ciclo['lotes'])} lotes ({lista}), {ciclo['transformaciones']} transformaciones."
+            en_ciclo = df_transform_pendientes['c_lote_origen'].isin(ciclo['lotes']) & df_transform_pendientes['c_lote_destino'].isin(ciclo['lotes'])
+            df_transform_pendientes.loc[en_ciclo, 'ciclo'] = n
+    orden_pasos = np.unique(pasos)
+    yield f"Plan de transformaciones: {len(df_transform_pendientes['mos_id'].unique())} transformaciones en {len(orden_pasos)} pasos (orden topológico de lotes)."
 
     with engine.connect() as connection:
-        sql_movim_stock = f"""SELECT ID, F_MOVIMIENTO, C_TIPO_COMPRO FROM MOVIM_STOCK WHERE C_TIPO_COMPRO IN ({','.join(map(str, tipos_transformacion))}) AND F_MOVIMIENTO >= TO_DATE(:fecha_inicio, 'YYYY-MM-DD') AND F_MOVIMIENTO < TO_DATE(:fecha_fin, 'YYYY-MM-DD') + 1 ORDER BY F_MOVIMIENTO ASC, ID ASC"""
-        df_movim_transform = pd.read_sql(text(sql_movim_stock), connection, params={'fecha_inicio': fecha_desde_str, 'fecha_fin': fecha_fin_str})
-        if df_movim_transform.empty:
-            yield "No se encontraron transformaciones en el período."
-            return pd.DataFrame(), pd.DataFrame()
-        
-        df_movim_transform.columns = df_movim_transform.columns.str.lower()
-        df_movim_transform = df_movim_transform.rename(columns={'id': 'mos_id'}, errors='ignore')
-        if 'mos_id' not in df_movim_transform.columns:
-            yield "Error Crítico: 'mos_id' no encontrado."
-            return pd.DataFrame(), pd.DataFrame()
+        for iteracion_actual, paso in enumerate(orden_pasos.tolist(), start=1):
+            df_paso = df_transform_pendientes[df_transform_pendientes['_paso'] == paso]
+            yield f"\n--- Paso de Transformaciones {iteracion_actual}/{len(orden_pasos)} ---"
 
-        lista_mos_id_transform = df_movim_transform['mos_id'].dropna().unique().tolist()
-        sql_dms_base = "SELECT ID, MOS_ID, C_LOTE, Q_ARTICULO, C_DEPOSITO FROM DET_MOV_STOCK"
-        df_dms_transform = ejecutar_consulta_con_chunks(sql_dms_base, "MOS_ID", lista_mos_id_transform, 999, connection)
-        df_dms_transform = df_dms_transform.rename(columns={'id': 'dms_id', 'c_lote': 'c_lote_destino', 'q_articulo': 'q_articulo_destino', 'c_deposito': 'c_deposito_destino'}, errors='ignore')
-
-        sql_dpc_base = "SELECT DMS_ID, MOS_ID, ID, C_LOTE, Q_ARTIC_COMP, C_DEPOSITO FROM DET_PROD_COMP"
-        df_dpc_transform = ejecutar_consulta_con_chunks(sql_dpc_base, "MOS_ID", lista_mos_id_transform, 999, connection)
-        df_dpc_transform = df_dpc_transform.rename(columns={'id': 'dpc_id', 'c_lote': 'c_lote_origen', 'q_artic_comp': 'q_origen_usada', 'c_deposito': 'c_deposito_origen'}, errors='ignore')
-
-        df_transform_base = pd.merge(df_dms_transform, df_dpc_transform, on=['mos_id', 'dms_id'], how='inner', suffixes=('_dest', '_orig'))
-        df_transform_base = pd.merge(df_transform_base, df_movim_transform, on='mos_id', how='left')
+            lotes_origen_necesarios = df_paso['c_lote_origen'].dropna().unique()
         
-        for col in ['c_lote_destino', 'c_lote_origen', 'mos_id', 'dms_id', 'dpc_id']:
-            df_transform_base[col] = pd.to_numeric(df_transform_base[col], errors='coerce')
-        
-        df_transform_pendientes = df_transform_base[df_transform_base['c_lote_destino'] != df_transform_base['c_lote_origen']].copy()
-        
-        df_final_acumulado = pd.DataFrame()
-        df_reporte_faltantes_final = pd.DataFrame()
-        
-        # --- CAMBIO: Bucle dinámico con mecanismos de seguridad ---
-        iteracion_actual = 0
-        max_iteraciones_seguridad = 30 
-
-        while not df_transform_pendientes.empty:
-            iteracion_actual += 1
-            yield f"\n--- Iteración de Transformaciones {iteracion_actual} ---"
-
-            pendientes_antes = len(df_transform_pendientes)
-            
-            if iteracion_actual > max_iteraciones_seguridad:
-                yield f"ADVERTENCIA: Se alcanzó el número máximo de iteraciones de seguridad ({max_iteraciones_seguridad}). Saliendo del bucle."
-                df_reporte_faltantes_final = df_transform_pendientes.copy()
-                break
-            
-            lotes_origen_necesarios = df_transform_pendientes['c_lote_origen'].dropna().unique()
-            
             # Usamos el nombre completo de la tabla para asegurar que lea lo que ya se insertó en la misma sesión
             sql_composicion_select = f"""SELECT C_LOTE, C_VARIEDAD_INV, C_PERIODO, ID_SUBVALLE, CANTIDAD, CLAVE_EXT_LOTE, NRO_INSCRIPCION, COD_CUARTEL, CUARTEL_LOG, CIU_NUMERO FROM {db_user}.{target_table}"""
             df_composicion_origen_actual = ejecutar_consulta_con_chunks(sql_composicion_select, "C_LOTE", lotes_origen_necesarios.tolist(), 999, connection)
-            lotes_origen_encontrados = pd.to_numeric(df_composicion_origen_actual['c_lote'], errors='coerce').dropna().unique()
+            if df_composicion_origen_actual.empty:
+                lotes_origen_encontrados = []
+            else:
+                lotes_origen_encontrados = pd.to_numeric(df_composicion_origen_actual['c_lote'], errors='coerce').dropna().unique()
 
-            df_procesables_ahora = df_transform_pendientes[df_transform_pendientes['c_lote_origen'].isin(lotes_origen_encontrados)]
-            
+            df_procesables_ahora = df_paso[df_paso['c_lote_origen'].isin(lotes_origen_encontrados)]
+        
             if df_procesables_ahora.empty:
-                yield "No se pudieron procesar más transformaciones en esta iteración (Lotes origen no encontrados). Saliendo del bucle."
-                df_reporte_faltantes_final = df_transform_pendientes.copy()
-                break
-
-            yield f"Se procesarán {len(df_procesables_ahora['mos_id'].unique())} transformaciones en esta iteración."
+                yield f"Ningún lote origen de este paso tiene composición: {len(df_paso)} filas quedan pendientes."
+                continue
 
-            df_composicion_origen_actual = df_composicion_origen_actual.rename(columns={'c_lote': 'c_lote_origen_comp', 'cantidad': 'cantidad_componente_origen'})
-            df_composicion_origen_actual['c_lote_origen_comp'] = pd.to_numeric(df_composicion_origen_actual['c_lote_origen_comp'], errors='coerce')
+            yield f"Se procesarán {len(df_procesables_ahora['mos_id'].unique())} transformaciones en este paso."
 
-            df_calculo = pd.merge(df_procesables_ahora, df_composicion_origen_actual, left_on='c_lote_origen', right_on='c_lote_origen_comp', how='left')
-            df_calculo['cantidad_componente_origen'] = pd.to_numeric(df_calculo['cantidad_componente_origen'], errors='coerce').fillna(0)
-            
-            df_calculo['total_lote_origen'] = df_calculo.groupby('c_lote_origen')['cantidad_componente_origen'].transform('sum')
-            df_calculo['total_lote_origen'] = pd.to_numeric(df_calculo['total_lote_origen'], errors='coerce').fillna(1).replace(0, 1)
-            df_calculo['q_origen_usada'] = pd.to_numeric(df_calculo['q_origen_usada'], errors='coerce').fillna(0)
-            df_calculo['cantidad_transferida'] = np.round((df_calculo['cantidad_componente_origen'] / df_calculo['total_lote_origen']) * df_calculo['q_origen_usada'], 5)
-            
-            df_calculo_filtrado = df_calculo[df_calculo['cantidad_transferida'] > 1e-9].copy()
+            df_calculo_filtrado = calcular_transferencias(df_procesables_ahora, df_composicion_origen_actual)
             if df_calculo_filtrado.empty:
-                ids_procesados = df_procesables_ahora['mos_id'].unique()
-                df_transform_pendientes = df_transform_pendientes[~df_transform_pendientes['mos_id'].isin(ids_procesados)]
+                df_transform_pendientes = df_transform_pendientes.drop(index=df_procesables_ahora.index)
                 yield f"Ningún componente resultó en transferencia de cantidad > 0. Quedan {len(df_transform_pendientes['mos_id'].unique())} transformaciones pendientes."
                 continue
 
             cols_a_seleccionar = ['c_lote_destino', 'c_variedad_inv', 'c_periodo', 'id_subvalle', 'cantidad_transferida', 'clave_ext_lote', 'mos_id', 'dms_id', 'c_tipo_compro', 'f_movimiento', 'c_lote_origen', 'ciu_numero', 'nro_inscripcion', 'cod_cuartel', 'cuartel_log', 'c_deposito_origen', 'c_deposito_destino']
             cols_existentes = [col for col in cols_a_seleccionar if col in df_calculo_filtrado.columns]
             df_nuevas_composiciones = df_calculo_filtrado[cols_existentes].copy()
-            df_lotes_min = df_lotes[['c_lote', 'd_lote']].rename(columns={'c_lote':'c_lote_destino', 'd_lote':'d_lote_destino'})
-            df_lotes_min['c_lote_destino'] = pd.to_numeric(df_lotes_min['c_lote_destino'], errors='coerce')
             df_nuevas_composiciones['c_lote_destino'] = pd.to_numeric(df_nuevas_composiciones['c_lote_destino'], errors='coerce')
-            df_nuevas_composiciones = pd.merge(df_nuevas_composiciones, df_lotes_min, on='c_lote_destino', how='left')
-            df_depositos_orig = df_depositos[['c_deposito', 'd_deposito']].rename(columns={'c_deposito':'c_deposito_origen', 'd_deposito':'d_dorigen'})
-            df_depositos_orig['c_deposito_origen'] = pd.to_numeric(df_depositos_orig['c_deposito_origen'], errors='coerce')
-            df_nuevas_composiciones['c_deposito_origen'] = pd.to_numeric(df_nuevas_composiciones['c_deposito_origen'], errors='coerce')
-            df_nuevas_composiciones = pd.merge(df_nuevas_composiciones, df_depositos_orig, on='c_deposito_origen', how='left')
-            df_depositos_dest = df_depositos[['c_deposito', 'd_deposito']].rename(columns={'c_deposito':'c_deposito_destino', 'd_deposito':'d_ddestino'})
-            df_depositos_dest['c_deposito_destino'] = pd.to_numeric(df_depositos_dest['c_deposito_destino'], errors='coerce')
-            df_nuevas_composiciones['c_deposito_destino'] = pd.to_numeric(df_nuevas_composiciones['c_deposito_destino'], errors='coerce')
-            df_nuevas_composiciones = pd.merge(df_nuevas_composiciones, df_depositos_dest, on='c_deposito_destino', how='left')
+            df_nuevas_composiciones['d_lote_destino'] = lotes.buscar(df_nuevas_composiciones['c_lote_destino'], 'd_lote')
+            for col_dep, col_desc in [('c_deposito_origen', 'd_dorigen'), ('c_deposito_destino', 'd_ddestino')]:
+                if col_dep not in df_nuevas_composiciones.columns: df_nuevas_composiciones[col_dep] = np.nan
+                df_nuevas_composiciones[col_dep] = pd.to_numeric(df_nuevas_composiciones[col_dep], errors='coerce')
+                df_nuevas_composiciones[col_desc] = depositos.buscar(df_nuevas_composiciones[col_dep], 'd_deposito')
             df_nuevas_composiciones = df_nuevas_composiciones.rename(columns={'c_lote_destino': 'C_LOTE', 'cantidad_transferida': 'CANTIDAD', 'dms_id': 'ID', 'clave_ext_lote': 'CLAVE_EXT_LOTE', 'd_lote_destino': 'D_LOTE', 'c_deposito_origen': 'C_DORIGEN', 'c_deposito_destino': 'C_DDESTINO', 'c_variedad_inv': 'C_VARIEDAD_INV', 'c_periodo': 'C_PERIODO', 'id_subvalle': 'ID_SUBVALLE', 'mos_id': 'MOS_ID', 'c_tipo_compro': 'C_TIPO_COMPRO', 'f_movimiento': 'F_MOVIMIENTO', 'c_lote_origen': 'C_LOTE_ORIGEN', 'ciu_numero': 'CIU_NUMERO', 'nro_inscripcion': 'NRO_INSCRIPCION', 'cod_cuartel': 'COD_CUARTEL', 'cuartel_log': 'CUARTEL_LOG', 'd_dorigen': 'D_DORIGEN', 'd_ddestino': 'D_DDESTINO'})
             df_nuevas_composiciones['PORCENTAJE_SI'] = None
             origen_map = {43: 'Mezcla', 30: 'Reclasificacion', 46: 'Borras'}
             df_nuevas_composiciones['ORIGEN'] = df_nuevas_composiciones['C_TIPO_COMPRO'].map(origen_map).fillna('Transformacion')
-            
+        
             grouping_keys_upper = ['C_LOTE', 'C_VARIEDAD_INV', 'C_PERIODO', 'ID_SUBVALLE', 'CLAVE_EXT_LOTE', 'MOS_ID', 'ID', 'C_TIPO_COMPRO', 'F_MOVIMIENTO', 'C_LOTE_ORIGEN', 'PORCENTAJE_SI', 'CIU_NUMERO', 'NRO_INSCRIPCION', 'COD_CUARTEL', 'CUARTEL_LOG', 'D_LOTE', 'C_DORIGEN', 'D_DORIGEN', 'C_DDESTINO', 'D_DDESTINO', 'ORIGEN']
             for key in grouping_keys_upper:
                 if key not in df_nuevas_composiciones.columns: df_nuevas_composiciones[key] = None
@@ -500,68 +721,221 @@ def procesar_transformaciones(engine: sqlalchemy.engine.Engine, fecha_desde_str:
                 else: df_nuevas_composiciones[key] = df_nuevas_composiciones[key].apply(lambda x: 'N/A' if pd.isna(x) else str(x))
             df_nuevas_composiciones['CANTIDAD'] = pd.to_numeric(df_nuevas_composiciones['CANTIDAD'], errors='coerce').fillna(0)
             df_final_iteracion = df_nuevas_composiciones.groupby(grouping_keys_upper, dropna=False).agg(CANTIDAD=('CANTIDAD', 'sum')).reset_index().replace('N/A', None)
-            
+        
             if not df_final_iteracion.empty:
-                yield f"Enriqueciendo transformación (iteración {iteracion_actual}) con datos de OT..."
-                df_final_iteracion = _enriquecer_con_ordenes_trabajo(df_final_iteracion, engine)
-
-                for col_upper in ['C_LOTE', 'MOS_ID', 'ID', 'CIU_NUMERO', 'C_PERIODO', 'C_TIPO_COMPRO', 'COD_CUARTEL', 'C_LOTE_ORIGEN', 'PORCENTAJE_SI', 'C_DORIGEN', 'C_DDESTINO']:
-                    if col_upper in df_final_iteracion.columns:
-                        try: df_final_iteracion[col_upper] = pd.to_numeric(df_final_iteracion[col_upper], errors='coerce').astype('Int64')
-                        except Exception:
-                            try: df_final_iteracion[col_upper] = pd.to_numeric(df_final_iteracion[col_upper], errors='coerce').astype('Float64')
-                            except Exception as e: yield f"Advertencia Transform: No se pudo convertir {col_upper}: {e}"
-                if 'F_MOVIMIENTO' in df_final_iteracion.columns: df_final_iteracion['F_MOVIMIENTO'] = pd.to_datetime(df_final_iteracion['F_MOVIMIENTO'], errors='coerce')
-                
-                string_cols_upper = ['C_VARIEDAD_INV', 'ID_SUBVALLE', 'CLAVE_EXT_LOTE', 'NRO_INSCRIPCION', 'CUARTEL_LOG', 'D_LOTE', 'ORIGEN', 'D_DORIGEN', 'D_DDESTINO'] + COLUMNAS_OT
-                for col_upper in string_cols_upper:
-                    if col_upper in df_final_iteracion.columns: df_final_iteracion[col_upper] = df_final_iteracion[col_upper].astype(pd.StringDtype())
-
-                if 'D_DORIGEN' in df_final_iteracion.columns: df_final_iteracion['D_DORIGEN'] = df_final_iteracion['D_DORIGEN'].fillna('').str.slice(0, MAX_LEN_D_DEPOSITO)
-                if 'D_DDESTINO' in df_final_iteracion.columns: df_final_iteracion['D_DDESTINO'] = df_final_iteracion['D_DDESTINO'].fillna('').str.slice(0, MAX_LEN_D_DEPOSITO)
-                if 'CANTIDAD' in df_final_iteracion.columns: df_final_iteracion['CANTIDAD'] = df_final_iteracion['CANTIDAD'].astype(float)
+                yield f"Enriqueciendo transformación (paso {iteracion_actual}) con datos de OT..."
+                df_final_iteracion = normalizar_detalle(_enriquecer_con_ordenes_trabajo(df_final_iteracion, engine))
             
-                final_order = ['C_LOTE', 'C_VARIEDAD_INV', 'C_PERIODO', 'ID_SUBVALLE', 'CANTIDAD', 'CLAVE_EXT_LOTE', 'MOS_ID', 'ID', 'C_TIPO_COMPRO', 'F_MOVIMIENTO', 'C_LOTE_ORIGEN', 'PORCENTAJE_SI', 'CIU_NUMERO', 'NRO_INSCRIPCION', 'COD_CUARTEL', 'CUARTEL_LOG', 'D_LOTE', 'C_DORIGEN', 'D_DORIGEN', 'C_DDESTINO', 'D_DDESTINO', 'ORIGEN'] + COLUMNAS_OT
-                final_order_existing = [col for col in final_order if col in df_final_iteracion.columns]
-                df_final_iteracion = df_final_iteracion.reindex(columns=final_order_existing)
-                
                 yield f"Guardando {len(df_final_iteracion)} nuevas composiciones en la DB..."
-                dtype_map = {'C_LOTE': BigInteger, 'C_VARIEDAD_INV': String(50), 'C_PERIODO': Integer, 'ID_SUBVALLE': String(8), 'CANTIDAD': Numeric(precision=20, scale=5), 'CLAVE_EXT_LOTE': String(100), 'MOS_ID': Integer, 'ID': Integer, 'C_TIPO_COMPRO': Integer, 'F_MOVIMIENTO': DateTime, 'C_LOTE_ORIGEN': BigInteger, 'PORCENTAJE_SI': Numeric(precision=5, scale=2), 'CIU_NUMERO': BigInteger, 'NRO_INSCRIPCION': String(7), 'COD_CUARTEL': Integer, 'CUARTEL_LOG': String(6), 'D_LOTE': String(54), 'C_DORIGEN': Integer, 'D_DORIGEN': String(MAX_LEN_D_DEPOSITO), 'C_DDESTINO': Integer, 'D_DDESTINO': String(MAX_LEN_D_DEPOSITO), 'ORIGEN': String(20)}
-                dtype_map.update({col: String(255) for col in COLUMNAS_OT if 'CANT' not in col})
-                dtype_map['CANT_ART_DESTINO'] = Numeric(precision=20, scale=5)
-                dtype_map['CANT_ART_ORIGEN'] = Numeric(precision=20, scale=5)
-                dtype_map_final = {k: v for k, v in dtype_map.items() if k in df_final_iteracion.columns}
                 try:
-                    df_final_iteracion.to_sql(name=target_table, con=engine, if_exists='append', index=False, dtype=dtype_map_final, chunksize=1000)
-                    yield f"¡Éxito! Datos de la iteración guardados."
+                    df_final_iteracion.to_sql(name=target_table, con=engine, if_exists='append', index=False, dtype=DTYPE_SQL_DETALLE, chunksize=1000)
+                    yield f"¡Éxito! Datos del paso guardados."
                     df_final_acumulado = pd.concat([df_final_acumulado, df_final_iteracion], ignore_index=True)
                 except Exception as e_sql:
-                    yield f"\n--- ERROR AL GUARDAR TRANSFORMACIONES EN BASE DE DATOS (Iteración {iteracion_actual}) ---"
+                    yield f"\n--- ERROR AL GUARDAR TRANSFORMACIONES EN BASE DE DATOS (Paso {iteracion_actual}) ---"
                     yield f"Error: {e_sql}"
+                    raise EtapaFallida(f"transformaciones (paso {iteracion_actual})") from e_sql
 
-            ids_procesados = df_procesables_ahora['mos_id'].unique()
-            df_transform_pendientes = df_transform_pendientes[~df_transform_pendientes['mos_id'].isin(ids_procesados)]
-            
-            pendientes_despues = len(df_transform_pendientes)
-            yield f"Quedan {pendientes_despues} transformaciones pendientes."
-            
-            if pendientes_despues == pendientes_antes:
-                yield "ADVERTENCIA: No se pudo procesar ninguna transformación adicional en esta iteración. Saliendo del bucle para evitar un ciclo infinito."
-                df_reporte_faltantes_final = df_transform_pendientes.copy()
-                break
+            df_transform_pendientes = df_transform_pendientes.drop(index=df_procesables_ahora.index)
+            yield f"Quedan {len(df_transform_pendientes)} transformaciones pendientes."
+
+    if not df_transform_pendientes.empty:
+        motivo = 'SIN_COMPOSICION_ORIGEN'
+    return df_final_acumulado, df_transform_pendientes.drop(columns=['_paso']), motivo
+
+# --- Backlog de transformaciones sin resolver ---
+PENDIENTES_TABLE = 'APX_TRAZA_PENDIENTES'
+CLAVE_PENDIENTE = ['mos_id', 'dms_id', 'dpc_id']
+COLUMNAS_PENDIENTE = CLAVE_PENDIENTE + ['c_lote_destino', 'c_lote_origen', 'q_origen_usada', 'q_articulo_destino', 'c_deposito_origen', 'c_deposito_destino', 'c_tipo_compro', 'f_movimiento']
+
+def cargar_pendientes(connection: Connection, db_user: str) -> pd.DataFrame:
+    """Transformaciones pendientes de corridas anteriores."""
+    sql = f"SELECT {', '.join(c.upper() for c in COLUMNAS_PENDIENTE)}, MOTIVO, F_ALTA, INTENTOS FROM {db_user}.{PENDIENTES_TABLE}"
+    try:
+        df = pd.read_sql(text(sql), connection)
+        df.columns = df.columns.str.lower()
+    except Exception as e:
+        if "ORA-00942" in str(e) or "table or view does not exist" in str(e).lower():
+            return pd.DataFrame(columns=COLUMNAS_PENDIENTE + ['motivo', 'f_alta', 'intentos'])
+        raise
+    for col in CLAVE_PENDIENTE + ['c_lote_destino', 'c_lote_origen']:
+        df[col] = pd.to_numeric(df[col], errors='coerce')
+    return df
+
+def guardar_pendientes(engine: sqlalchemy.engine.Engine, db_user: str, df_restantes: pd.DataFrame, df_previos: pd.DataFrame, motivo: str, lotes_origen: list = None):
+    """
+    Reemplaza en el backlog las entradas consideradas en esta corrida (todas, o las de `lotes_origen`)
+    por las que siguen sin resolver. Conserva F_ALTA de las que ya estaban y suma un intento.
+    Borrado e inserción van en una sola transacción: si algo falla el backlog queda como estaba.
+    Devuelve True si se guardó.
+    """
+    tabla = f"{db_user}.{PENDIENTES_TABLE}"
+    df_nuevo = df_restantes.reindex(columns=COLUMNAS_PENDIENTE).drop_duplicates(subset=CLAVE_PENDIENTE).copy()
+    if not df_previos.empty:
+        df_nuevo = pd.merge(df_nuevo, df_previos[CLAVE_PENDIENTE + ['f_alta', 'intentos']], on=CLAVE_PENDIENTE, how='left')
+    else:
+        df_nuevo['f_alta'] = pd.NaT
+        df_nuevo['intentos'] = 0
+    df_nuevo['f_alta'] = pd.to_datetime(df_nuevo['f_alta'], errors='coerce').fillna(pd.Timestamp(datetime.now()))
+    df_nuevo['intentos'] = pd.to_numeric(df_nuevo['intentos'], errors='coerce').fillna(0).astype(int) + 1
+    df_nuevo['motivo'] = motivo or 'SIN_COMPOSICION_ORIGEN'
+    df_nuevo['f_movimiento'] = pd.to_datetime(df_nuevo['f_movimiento'], errors='coerce')
+    df_nuevo.columns = [c.upper() for c in df_nuevo.columns]
+
+    dtype_map = {'MOS_ID': Integer, 'DMS_ID': Integer, 'DPC_ID': Integer, 'C_LOTE_DESTINO': BigInteger, 'C_LOTE_ORIGEN': BigInteger, 'Q_ORIGEN_USADA': Numeric(precision=20, scale=5), 'Q_ARTICULO_DESTINO': Numeric(precision=20, scale=5), 'C_DEPOSITO_ORIGEN': Integer, 'C_DEPOSITO_DESTINO': Integer, 'C_TIPO_COMPRO': Integer, 'F_MOVIMIENTO': DateTime, 'MOTIVO': String(30), 'F_ALTA': DateTime, 'INTENTOS': Integer}
+    with engine.connect() as connection:
+        try:
+            try:
+                if lotes_origen is None:
+                    connection.execute(text(f"DELETE FROM {tabla}"))
+                else:
+                    for i in range(0, len(lotes_origen), 999):
+                        chunk = [int(x) for x in lotes_origen[i:i + 999]]
+                        connection.execute(text(f"DELETE FROM {tabla} WHERE C_LOTE_ORIGEN IN ({', '.join(map(str, chunk))})"))
+            except Exception as e_delete:
+                # Sin tabla no hay nada que borrar: to_sql la crea
+                if "table or view does not exist" not in str(e_delete).lower():
+                    raise
+                connection.rollback()
+            if not df_nuevo.empty:
+                df_nuevo.to_sql(name=PENDIENTES_TABLE, con=connection, if_exists='append', index=False, dtype=dtype_map, chunksize=1000)
+            connection.commit()
+        except Exception as e_sql:
+            connection.rollback()
+            yield f"\n--- ERROR AL GUARDAR EL BACKLOG DE TRANSFORMACIONES ---"
+            yield f"Error: {e_sql}"
+            yield f"El backlog {tabla} queda como estaba."
+            return False
+        if df_nuevo.empty:
+            yield "Backlog de transformaciones vacío: no quedan pendientes."
+            return True
+        yield f"Backlog: {len(df_nuevo)} transformaciones pendientes guardadas en {tabla} (lotes origen: {df_nuevo['C_LOTE_ORIGEN'].nunique()})."
+        yield _asegurar_indice(connection, tabla, "IX_APX_TRAZA_PEND_ORIGEN", ['C_LOTE_ORIGEN'])
+    return True
+
+def _reporte_faltantes(df_restantes: pd.DataFrame) -> pd.DataFrame:
+    if df_restantes.empty:
+        return pd.DataFrame()
+    columnas = ['mos_id', 'dms_id', 'c_lote_origen', 'c_lote_destino', 'f_movimiento'] + (['ciclo'] if 'ciclo' in df_restantes.columns else [])
+    return df_restantes[columnas].drop_duplicates()
+
+def procesar_transformaciones(engine: sqlalchemy.engine.Engine, fecha_desde_str: str, fecha_fin_str: str, db_user: str, lotes: Maestro, depositos: Maestro, tablas: dict = None):
+    yield "\n--- Iniciando Procesamiento de Transformaciones (Tipos 43, 30, 46) ---"
+    tipos_transformacion = [43, 30, 46]
+
+    with engine.connect() as connection:
+        sql_movim_stock = f"""SELECT ID, F_MOVIMIENTO, C_TIPO_COMPRO FROM MOVIM_STOCK WHERE C_TIPO_COMPRO IN ({','.join(map(str, tipos_transformacion))}) AND F_MOVIMIENTO >= TO_DATE(:fecha_inicio, 'YYYY-MM-DD') AND F_MOVIMIENTO < TO_DATE(:fecha_fin, 'YYYY-MM-DD') + 1 ORDER BY F_MOVIMIENTO ASC, ID ASC"""
+        df_movim_transform = pd.read_sql(text(sql_movim_stock), connection, params={'fecha_inicio': fecha_desde_str, 'fecha_fin': fecha_fin_str})
+        if df_movim_transform.empty:
+            yield "No se encontraron transformaciones en el período."
+            return (yield from _procesar_con_backlog(engine, db_user, pd.DataFrame(columns=COLUMNAS_PENDIENTE), lotes, depositos, tablas))
         
-        if df_transform_pendientes.empty:
-            yield "¡Éxito! Todas las transformaciones fueron procesadas."
+        df_movim_transform.columns = df_movim_transform.columns.str.lower()
+        df_movim_transform = df_movim_transform.rename(columns={'id': 'mos_id'}, errors='ignore')
+        if 'mos_id' not in df_movim_transform.columns:
+            yield "Error Crítico: 'mos_id' no encontrado."
+            return pd.DataFrame(), pd.DataFrame(), None
+
+        lista_mos_id_transform = df_movim_transform['mos_id'].dropna().unique().tolist()
+        sql_dms_base = "SELECT ID, MOS_ID, C_LOTE, Q_ARTICULO, C_DEPOSITO FROM DET_MOV_STOCK"
+        df_dms_transform = ejecutar_consulta_con_chunks(sql_dms_base, "MOS_ID", lista_mos_id_transform, 999, connection)
+        df_dms_transform = df_dms_transform.rename(columns={'id': 'dms_id', 'c_lote': 'c_lote_destino', 'q_articulo': 'q_articulo_destino', 'c_deposito': 'c_deposito_destino'}, errors='ignore')
+
+        sql_dpc_base = "SELECT DMS_ID, MOS_ID, ID, C_LOTE, Q_ARTIC_COMP, C_DEPOSITO FROM DET_PROD_COMP"
+        df_dpc_transform = ejecutar_consulta_con_chunks(sql_dpc_base, "MOS_ID", lista_mos_id_transform, 999, connection)
+        df_dpc_transform = df_dpc_transform.rename(columns={'id': 'dpc_id', 'c_lote': 'c_lote_origen', 'q_artic_comp': 'q_origen_usada', 'c_deposito': 'c_deposito_origen'}, errors='ignore')
+
+        df_transform_base = pd.merge(df_dms_transform, df_dpc_transform, on=['mos_id', 'dms_id'], how='inner', suffixes=('_dest', '_orig'))
+        df_transform_base = pd.merge(df_transform_base, df_movim_transform, on='mos_id', how='left')
+        
+        for col in ['c_lote_destino', 'c_lote_origen', 'mos_id', 'dms_id', 'dpc_id']:
+            df_transform_base[col] = pd.to_numeric(df_transform_base[col], errors='coerce')
+        
+        df_transform_pendientes = df_transform_base[df_transform_base['c_lote_destino'] != df_transform_base['c_lote_origen']].copy()
 
-    if not df_reporte_faltantes_final.empty:
-        df_reporte_faltantes_final = df_reporte_faltantes_final[['mos_id', 'dms_id', 'c_lote_origen', 'c_lote_destino', 'f_movimiento']].drop_duplicates()
+    return (yield from _procesar_con_backlog(engine, db_user, df_transform_pendientes, lotes, depositos, tablas))
+
+def _procesar_con_backlog(engine: sqlalchemy.engine.Engine, db_user: str, df_transform_pendientes: pd.DataFrame, lotes: Maestro, depositos: Maestro, tablas: dict = None):
+    """
+    Resuelve las transformaciones del período junto con el backlog. El backlog no se toca acá:
+    se devuelve lo que hay que guardar (argumentos de guardar_pendientes) y la corrida lo escribe
+    recién después de publicar, así una corrida que no se publica no pierde pendientes.
+    """
+    # Pendientes de corridas anteriores: se reintentan junto con las del período
+    with engine.connect() as connection:
+        df_backlog = cargar_pendientes(connection, db_user)
+    if not df_backlog.empty:
+        yield f"Se incorporan {len(df_backlog)} transformaciones pendientes de corridas anteriores (backlog)."
+        df_transform_pendientes = pd.concat([df_transform_pendientes, df_backlog[COLUMNAS_PENDIENTE]], ignore_index=True)
+        df_transform_pendientes = df_transform_pendientes.drop_duplicates(subset=CLAVE_PENDIENTE, keep='first')
+
+    df_final_acumulado, df_restantes, motivo = yield from resolver_transformaciones(engine, db_user, df_transform_pendientes, lotes, depositos, tablas)
+    if df_restantes.empty:
+        yield "¡Éxito! Todas las transformaciones fueron procesadas."
+    else:
+        yield f"Quedan {len(df_restantes)} transformaciones pendientes; el backlog se actualiza al publicar la corrida."
 
     yield "--- Fin Procesamiento de Transformaciones ---"
-    return df_final_acumulado, df_reporte_faltantes_final
+    backlog = {'df_restantes': df_restantes, 'df_previos': df_backlog, 'motivo': motivo}
+    return df_final_acumulado, _reporte_faltantes(df_restantes), backlog
 
-def procesar_destinos_finales(engine: sqlalchemy.engine.Engine, db_user: str, lotes_con_composicion: list):
+def _destinos_finales_en_servidor(engine: sqlalchemy.engine.Engine, db_user: str, destino_final_table: str, detalle_table: str):
+    """
+    Llena APX_TRAZA_DESTINO_FINAL con INSERT ... SELECT en Oracle (semi-join EXISTS contra
+    APX_TRAZA_DETALLE): los lotes no viajan al cliente. Borrado e inserciones en una sola
+    transacción, así los lectores ven la tabla anterior hasta el commit.
+    Devuelve False si la tabla no existe (se crea por el camino pandas + to_sql).
+    """
+    columnas = "C_LOTE, TIPO_DESTINO, CANTIDAD_USADA, F_MOVIMIENTO_DESTINO, MOS_ID_DESTINO"
+    sql_dpc = f"""
+        INSERT INTO {destino_final_table} ({columnas})
+        SELECT dpc.C_LOTE, CASE ms.C_TIPO_COMPRO WHEN 41 THEN 'PRODUCCION' WHEN 44 THEN 'CONCENTRACION' END,
+               dpc.Q_ARTIC_COMP, ms.F_MOVIMIENTO, ms.ID
+        FROM DET_PROD_COMP dpc JOIN MOVIM_STOCK ms ON dpc.MOS_ID = ms.ID
+        WHERE ms.C_TIPO_COMPRO IN (41, 44)
+          AND EXISTS (SELECT 1 FROM {detalle_table} d WHERE d.C_LOTE = dpc.C_LOTE)"""
+    sql_dfv = f"""
+        INSERT INTO {destino_final_table} ({columnas})
+        SELECT dfv.C_LOTE_STOCK, 'DESPACHADO', dfv.Q_ARTICULO, fv.F_FACTURA, fv.ID
+        FROM DET_FAC_VEN dfv JOIN FACTURA_VENTAS fv ON dfv.FAC_ID = fv.ID
+        WHERE fv.C_TIPO_COMPRO = 3
+          AND EXISTS (SELECT 1 FROM {detalle_table} d WHERE d.C_LOTE = dfv.C_LOTE_STOCK)"""
+    with engine.connect() as connection:
+        try:
+            yield f"Reemplazando {destino_final_table} en el servidor (INSERT ... SELECT)..."
+            borrados = connection.execute(text(f"DELETE FROM {destino_final_table}")).rowcount
+            n_dpc = connection.execute(text(sql_dpc)).rowcount
+            n_dfv = connection.execute(text(sql_dfv)).rowcount
+            connection.commit()
+        except Exception as e_sql:
+            connection.rollback()
+            if "table or view does not exist" in str(e_sql).lower():
+                yield f"La tabla {destino_final_table} no existe. Se creará con el camino en memoria."
+                return False
+            yield f"\n--- ERROR AL GUARDAR DESTINOS FINALES EN BASE DE DATOS ---"
+            yield f"Error: {e_sql}"
+            raise EtapaFallida("destinos finales") from e_sql
+    yield f"{borrados} registros anteriores borrados."
+    yield f"Se insertaron {n_dpc} destinos en Producción/Concentración y {n_dfv} en Despachos."
+    if n_dpc + n_dfv == 0:
+        yield "No se encontró ningún destino final para los lotes procesados."
+    return True
+
+def procesar_destinos_finales(engine: sqlalchemy.engine.Engine, db_user: str, lotes_con_composicion: list = None, tablas: dict = None):
+    """
+    Destinos finales de los lotes con composición. En COMPOSICION_MODO_SQL=pushdown se resuelve
+    en Oracle y `lotes_con_composicion` no se usa (los lotes salen de APX_TRAZA_DETALLE).
+    """
     yield "\n--- Iniciando Procesamiento de Destinos Finales ---"
-    destino_final_table = f"{db_user}.APX_TRAZA_DESTINO_FINAL"
+    destino_final_table = f"{db_user}.{_fisica(tablas, 'APX_TRAZA_DESTINO_FINAL')}"
+    detalle_table = f"{db_user}.{_fisica(tablas, 'APX_TRAZA_DETALLE')}"
+
+    if _modo_sql() == 'pushdown':
+        hecho = yield from _destinos_finales_en_servidor(engine, db_user, destino_final_table, detalle_table)
+        if hecho:
+            return
+        with engine.connect() as connection:
+            lotes_con_composicion = pd.read_sql(text(f"SELECT DISTINCT C_LOTE FROM {detalle_table}"), connection)['c_lote'].tolist()
     
     with engine.connect() as connection:
         try:
@@ -618,15 +992,498 @@ def procesar_destinos_finales(engine: sqlalchemy.engine.Engine, db_user: str, lo
         except Exception as e_sql:
             yield f"\n--- ERROR AL GUARDAR DESTINOS FINALES EN BASE DE DATOS ---"
             yield f"Error: {e_sql}"
+            raise EtapaFallida("destinos finales") from e_sql
 
 
-def ejecutar_proceso_completo(fecha_inicio_str: str, fecha_fin_str: str):
-    cred_file_path = Path(r"C:\projectdj\acceso.pwd")
-    tns_alias = "CGGBD1"
-    tns_admin_dir = r"C:\oracle\instantclient_21_8\network\admin"
+# --- Resumen de composición por lote ---
+COLUMNAS_RESUMEN_CLAVE = ['C_LOTE', 'C_VARIEDAD_INV', 'C_PERIODO', 'ID_SUBVALLE']
+
+def calcular_composicion_resumen(frames: list) -> pd.DataFrame:
+    """
+    Agrupa las filas de APX_TRAZA_DETALLE generadas en la corrida por
+    (C_LOTE, C_VARIEDAD_INV, C_PERIODO, ID_SUBVALLE) y calcula litros y
+    porcentaje sobre el total de cada lote.
+    """
+    partes = []
+    for df in frames:
+        if df is None or df.empty: continue
+        parte = df.reindex(columns=COLUMNAS_RESUMEN_CLAVE + ['CANTIDAD']).copy()
+        parte['C_LOTE'] = pd.to_numeric(parte['C_LOTE'], errors='coerce').astype('Int64')
+        parte['C_PERIODO'] = pd.to_numeric(parte['C_PERIODO'], errors='coerce').astype('Int64')
+        parte['C_VARIEDAD_INV'] = parte['C_VARIEDAD_INV'].astype(pd.StringDtype())
+        parte['ID_SUBVALLE'] = parte['ID_SUBVALLE'].astype(pd.StringDtype())
+        parte['CANTIDAD'] = pd.to_numeric(parte['CANTIDAD'], errors='coerce').fillna(0.0).astype(float)
+        partes.append(parte)
+    if not partes:
+        return pd.DataFrame(columns=COLUMNAS_RESUMEN_CLAVE + ['CANTIDAD', 'PORCENTAJE'])
+
+    df_detalle = pd.concat(partes, ignore_index=True)
+    df_detalle = df_detalle[df_detalle['C_LOTE'].notna()]
+    df_resumen = df_detalle.groupby(COLUMNAS_RESUMEN_CLAVE, dropna=False, sort=False)['CANTIDAD'].sum().reset_index()
+    total_lote = df_resumen.groupby('C_LOTE')['CANTIDAD'].transform('sum')
+    df_resumen['PORCENTAJE'] = np.round(df_resumen['CANTIDAD'] / total_lote.where(total_lote > 0) * 100.0, 4)
+    df_resumen['CANTIDAD'] = np.round(df_resumen['CANTIDAD'], 5)
+    return df_resumen.reindex(columns=COLUMNAS_RESUMEN_CLAVE + ['CANTIDAD', 'PORCENTAJE'])
+
+def _asegurar_indice(connection: Connection, tabla: str, nombre_indice: str, columnas: list) -> str:
+    try:
+        connection.execute(text(f"CREATE INDEX {nombre_indice} ON {tabla} ({', '.join(columnas)})"))
+        return f"Índice {nombre_indice} creado sobre {tabla} ({', '.join(columnas)})."
+    except Exception as e_idx:
+        # ORA-00955: nombre ya usado / ORA-01408: columnas ya indexadas -> el índice ya existe
+        if "ORA-00955" in str(e_idx) or "ORA-01408" in str(e_idx):
+            return f"Índice sobre {tabla} ({', '.join(columnas)}) ya existente."
+        return f"Advertencia: no se pudo crear el índice {nombre_indice}: {e_idx}"
+
+def procesar_composicion_resumen(engine: sqlalchemy.engine.Engine, db_user: str, frames: list, tablas: dict = None):
+    yield "\n--- Iniciando Resumen de Composición por Lote ---"
+    resumen_table_base = _fisica(tablas, "APX_TRAZA_COMPOSICION_RESUMEN")
+    resumen_table = f"{db_user}.{resumen_table_base}"
+
+    df_resumen = calcular_composicion_resumen(frames)
+    yield f"Se calcularon {len(df_resumen)} filas de resumen para {df_resumen['C_LOTE'].nunique()} lotes."
+
+    with engine.connect() as connection:
+        try:
+            yield f"Limpiando la tabla de resumen: {resumen_table}..."
+            connection.execute(text(f"DELETE FROM {resumen_table}"))
+            connection.commit()
+        except Exception as e_delete:
+            connection.rollback()
+            if "table or view does not exist" in str(e_delete).lower():
+                yield f"La tabla {resumen_table} no existe. Se creará automáticamente."
+            else:
+                yield f"--- ADVERTENCIA AL BORRAR DATOS DE {resumen_table} ---"
+                yield f"Error: {e_delete}"
+
+    if df_resumen.empty:
+        yield "No hay composición para resumir."
+        return
+
+    dtype_map_resumen = {'C_LOTE': BigInteger, 'C_VARIEDAD_INV': String(50), 'C_PERIODO': Integer, 'ID_SUBVALLE': String(8), 'CANTIDAD': Numeric(precision=20, scale=5), 'PORCENTAJE': Numeric(precision=9, scale=4)}
+    try:
+        df_resumen.to_sql(name=resumen_table_base, con=engine, if_exists='append', index=False, dtype=dtype_map_resumen, chunksize=1000)
+        yield f"¡Éxito! {len(df_resumen)} registros de resumen guardados en {resumen_table}."
+    except Exception as e_sql:
+        yield f"\n--- ERROR AL GUARDAR RESUMEN DE COMPOSICIÓN EN BASE DE DATOS ---"
+        yield f"Error: {e_sql}"
+        raise EtapaFallida("resumen de composición") from e_sql
+
+    with engine.connect() as connection:
+        yield _asegurar_indice(connection, resumen_table, _nombre_indice("IX_APX_TRAZA_COMP_RES_LOTE", resumen_table_base), ['C_LOTE'])
+
+
+def _cierre_dependientes(df_backlog: pd.DataFrame, lotes_origen: list) -> list:
+    """Lotes origen pedidos más los destinos que dependen de ellos dentro del backlog (en cadena)."""
+    lotes = {int(x) for x in lotes_origen}
+    while True:
+        destinos = df_backlog.loc[df_backlog['c_lote_origen'].isin(lotes), 'c_lote_destino'].dropna().astype('int64')
+        nuevos = set(destinos.tolist()) - lotes
+        if not nuevos:
+            return sorted(lotes)
+        lotes |= nuevos
+
+def actualizar_composicion_resumen(engine: sqlalchemy.engine.Engine, db_user: str, lotes: list):
+    """Recalcula el resumen sólo de `lotes`, leyendo su composición actual de APX_TRAZA_DETALLE."""
+    lotes = sorted({int(x) for x in lotes})
+    if not lotes:
+        return
+    with engine.connect() as connection:
+        tablas = tablas_vigentes(connection, db_user)
+        resumen_table_base = _fisica(tablas, "APX_TRAZA_COMPOSICION_RESUMEN")
+        resumen_table = f"{db_user}.{resumen_table_base}"
+        sql_detalle = f"SELECT C_LOTE, C_VARIEDAD_INV, C_PERIODO, ID_SUBVALLE, CANTIDAD FROM {db_user}.{_fisica(tablas, 'APX_TRAZA_DETALLE')}"
+        df_detalle = ejecutar_consulta_con_chunks(sql_detalle, "C_LOTE", lotes, 999, connection)
+        df_detalle.columns = [c.upper() for c in df_detalle.columns]
+        try:
+            for i in range(0, len(lotes), 999):
+                chunk = lotes[i:i + 999]
+                connection.execute(text(f"DELETE FROM {resumen_table} WHERE C_LOTE IN ({', '.join(map(str, chunk))})"))
+            connection.commit()
+        except Exception as e_delete:
+            connection.rollback()
+            if "table or view does not exist" not in str(e_delete).lower():
+                yield f"--- ADVERTENCIA AL BORRAR DATOS DE {resumen_table} ---"
+                yield f"Error: {e_delete}"
+                return
+
+    df_resumen = calcular_composicion_resumen([df_detalle])
+    if df_resumen.empty:
+        yield "No hay composición para resumir en los lotes afectados."
+        return
+    dtype_map_resumen = {'C_LOTE': BigInteger, 'C_VARIEDAD_INV': String(50), 'C_PERIODO': Integer, 'ID_SUBVALLE': String(8), 'CANTIDAD': Numeric(precision=20, scale=5), 'PORCENTAJE': Numeric(precision=9, scale=4)}
+    try:
+        df_resumen.to_sql(name=resumen_table_base, con=engine, if_exists='append', index=False, dtype=dtype_map_resumen, chunksize=1000)
+        yield f"Resumen actualizado para {df_resumen['C_LOTE'].nunique()} lotes ({len(df_resumen)} registros)."
+    except Exception as e_sql:
+        yield f"\n--- ERROR AL ACTUALIZAR RESUMEN DE COMPOSICIÓN ---"
+        yield f"Error: {e_sql}"
+
+def reprocesar_pendientes(lotes_origen: list = None):
+    """
+    Reintenta sólo el backlog de transformaciones (APX_TRAZA_PENDIENTES) contra la composición
+    actual de APX_TRAZA_DETALLE, sin volver a correr compras/descubes/ajustes del período.
+    Con `lotes_origen` (p.ej. lotes que acaban de recibir compras o ajustes) se toman sólo las
+    entradas de esos lotes y las que dependen de ellas; si no, todo el backlog.
+    Se recalcula el resumen de los lotes que recibieron composición; los destinos finales y las
+    transformaciones ya resueltas aguas abajo se actualizan en la próxima corrida completa.
+    """
+    engine = None
+    yield "\nIniciando reproceso del backlog de transformaciones..."
+    try:
+        engine, db_user = yield from _conectar()
+        if engine is None:
+            return
+
+        with engine.connect() as connection:
+            df_backlog = cargar_pendientes(connection, db_user)
+        alcance = None
+        if lotes_origen:
+            alcance = _cierre_dependientes(df_backlog, lotes_origen)
+            df_backlog = df_backlog[df_backlog['c_lote_origen'].isin(alcance)]
+            yield f"Lotes origen pedidos: {len(lotes_origen)}; con dependientes en el backlog: {len(alcance)}."
+        if df_backlog.empty:
+            yield "No hay transformaciones pendientes para reprocesar."
+            return
+        yield f"Se reintentan {len(df_backlog)} transformaciones pendientes."
+
+        with engine.connect() as connection:
+            # Maestros sólo para los lotes destino involucrados (no todo LOTES_STOCK)
+            df_lotes = ejecutar_consulta_con_chunks("SELECT C_LOTE, D_LOTE FROM LOTES_STOCK", "C_LOTE", df_backlog['c_lote_destino'].dropna().astype('int64').unique().tolist(), 999, connection)
+            df_depositos = pd.read_sql(text("SELECT C_DEPOSITO, D_DEPOSITO FROM DEPOSITOS"), connection)
+            df_depositos.columns = df_depositos.columns.str.lower()
+            depositos = Maestro(df_depositos, 'c_deposito', ['d_deposito'])
+            # Se escribe directo en las tablas publicadas (no hay staging en el reproceso)
+            tablas = tablas_vigentes(connection, db_user)
+        lotes = Maestro(df_lotes, 'c_lote', ['d_lote'])
+
+        df_resueltas, df_restantes, motivo = yield from resolver_transformaciones(engine, db_user, df_backlog[COLUMNAS_PENDIENTE].copy(), lotes, depositos, tablas)
+        yield f"Resueltas: {len(df_backlog) - len(df_restantes)}; siguen pendientes: {len(df_restantes)}."
+        yield from guardar_pendientes(engine, db_user, df_restantes, df_backlog, motivo, lotes_origen=alcance)
+
+        if not df_resueltas.empty:
+            yield from actualizar_composicion_resumen(engine, db_user, df_resueltas['C_LOTE'].dropna().unique().tolist())
+            yield from exportar_grafo(engine, db_user, tablas)
+            yield from marcar_generacion(engine, db_user)
+    except EtapaFallida as e_etapa: yield f"\n--- REPROCESO INCOMPLETO ---: falló la etapa de {e_etapa}. No se exporta el grafo."
+    except sqlalchemy.exc.DatabaseError as db_err: yield f"\n--- ERROR DE BASE DE DATOS ---: {db_err}"
+    except Exception as e: yield f"\n--- ERROR INESPERADO ---: {e}\n{traceback.format_exc()}"
+    finally:
+        if engine: engine.dispose(); yield "\nConexión a base de datos cerrada."
+        yield "Reproceso finalizado."
+
+
+# --- Publicación de las tablas de la corrida (staging + cambio de sinónimo) ---
+# Cada tabla publicada tiene dos tablas físicas <TABLA>_A / <TABLA>_B y un sinónimo <TABLA>
+# que apunta a la vigente (es lo que lee el API). La corrida vacía la otra con TRUNCATE
+# (sin undo), escribe ahí y, sólo si termina bien, cambia el sinónimo con
+# CREATE OR REPLACE SYNONYM, que es atómico: los lectores nunca ven la tabla vacía ni a medio armar.
+# La primera vez, la tabla real existente se renombra a <TABLA>_A y se crea el sinónimo.
+# COMPOSICION_PUBLICACION=directo vuelve al DELETE + append sobre la tabla real.
+TABLAS_PUBLICADAS = ['APX_TRAZA_DETALLE', 'APX_TRAZA_DESTINO_FINAL', 'APX_TRAZA_COMPOSICION_RESUMEN']
+
+def _modo_publicacion() -> str:
+    modo = (os.getenv('COMPOSICION_PUBLICACION') or 'swap').strip().lower()
+    return modo if modo in ('swap', 'directo') else 'swap'
+
+def _fisica(tablas: dict, base: str) -> str:
+    """Tabla física donde se lee/escribe `base` en esta corrida (la misma si no hay staging)."""
+    return (tablas or {}).get(base, base)
+
+def _nombre_indice(nombre: str, tabla_fisica: str) -> str:
+    """Los nombres de índice son únicos por esquema: uno por tabla física _A / _B."""
+    return f"{nombre}{tabla_fisica[-2:]}" if tabla_fisica.endswith(('_A', '_B')) else nombre
+
+def _tipo_objeto(connection: Connection, db_user: str, nombre: str):
+    row = connection.execute(
+        text("SELECT OBJECT_TYPE FROM ALL_OBJECTS WHERE OWNER = :owner AND OBJECT_NAME = :nombre AND OBJECT_TYPE IN ('TABLE', 'SYNONYM')"),
+        {'owner': db_user.upper(), 'nombre': nombre},
+    ).first()
+    return row[0] if row else None
+
+def _tabla_activa(connection: Connection, db_user: str, base: str):
+    """Tabla física a la que apunta `base` (sinónimo), `base` si todavía es tabla, o None si no existe."""
+    tipo = _tipo_objeto(connection, db_user, base)
+    if tipo == 'SYNONYM':
+        return connection.execute(
+            text("SELECT TABLE_NAME FROM ALL_SYNONYMS WHERE OWNER = :owner AND SYNONYM_NAME = :nombre"),
+            {'owner': db_user.upper(), 'nombre': base},
+        ).scalar()
+    return base if tipo == 'TABLE' else None
+
+def tablas_vigentes(connection: Connection, db_user: str) -> dict:
+    """Tablas físicas publicadas ahora (para escrituras incrementales fuera de una corrida completa)."""
+    tablas = {}
+    for base in TABLAS_PUBLICADAS:
+        try:
+            activa = _tabla_activa(connection, db_user, base)
+        except Exception:
+            activa = None
+        if activa:
+            tablas[base] = activa
+    return tablas
+
+def preparar_staging(engine: sqlalchemy.engine.Engine, db_user: str):
+    """Deja vacía la tabla de staging de cada tabla publicada y devuelve {tabla: staging}."""
+    tablas = {}
+    with engine.connect() as connection:
+        for base in TABLAS_PUBLICADAS:
+            activa = _tabla_activa(connection, db_user, base)
+            if activa == base:
+                yield f"Migrando {db_user}.{base} a tabla física {base}_A + sinónimo (una sola vez)..."
+                connection.execute(text(f"ALTER TABLE {db_user}.{base} RENAME TO {base}_A"))
+                try:
+                    connection.execute(text(f"CREATE SYNONYM {db_user}.{base} FOR {db_user}.{base}_A"))
+                except Exception:
+                    # Sin privilegio CREATE SYNONYM: se deja la tabla como estaba
+                    connection.execute(text(f"ALTER TABLE {db_user}.{base}_A RENAME TO {base}"))
+                    raise
+                activa = f"{base}_A"
+            staging = f"{base}_B" if activa == f"{base}_A" else f"{base}_A"
+            if _tipo_objeto(connection, db_user, staging) == 'TABLE':
+                connection.execute(text(f"TRUNCATE TABLE {db_user}.{staging}"))
+            elif activa:
+                connection.execute(text(f"CREATE TABLE {db_user}.{staging} AS SELECT * FROM {db_user}.{activa} WHERE 1=0"))
+            tablas[base] = staging
+            yield f"Staging de {base}: {staging} (publicada: {activa or 'ninguna'})."
+        connection.commit()
+    return tablas
+
+def publicar_staging(engine: sqlalchemy.engine.Engine, db_user: str, tablas: dict):
+    """Apunta cada sinónimo a su staging. Sólo se llama si la corrida terminó bien."""
+    with engine.connect() as connection:
+        for base, staging in tablas.items():
+            if _tipo_objeto(connection, db_user, staging) != 'TABLE':
+                yield f"Advertencia: {staging} no existe (la corrida no generó datos); {base} queda como estaba."
+                continue
+            connection.execute(text(f"CREATE OR REPLACE SYNONYM {db_user}.{base} FOR {db_user}.{staging}"))
+            yield f"Publicado: {db_user}.{base} -> {staging}."
+
+# --- Grafo de lotes para el API (CSR en archivos .npy) ---
+# Cada corrida exporta las aristas C_LOTE <- C_LOTE_ORIGEN de APX_TRAZA_DETALLE a una carpeta
+# GRAFO_LOTES_DIR/grafo_<fecha>/ y después apunta el archivo CURRENT a esa carpeta con os.replace
+# (atómico): el API mapea los .npy en memoria (mmap) y cambia de versión al ver el CURRENT nuevo.
+#   lotes.npy            int64 [n]      C_LOTE ordenados (destinos y orígenes)
+#   atras_ptr.npy        int64 [n+1]    aristas del lote i: atras_ptr[i]:atras_ptr[i+1] (por fecha, MOS_ID)
+#   destino / origen     int32 [m]      índice en lotes (-1: sin lote origen, p.ej. compras)
+#   cantidad float64, mos_id int64, fecha datetime64[s], tipo int16, c_dorigen / c_ddestino int32 [m]
+#   adelante_ptr int64 [n+1], adelante_arista int32 [k]: aristas en las que el lote i es origen
+GRAFO_VERSION = 1
+GRAFO_CONSERVAR = 3
+
+def _dir_grafo() -> str:
+    return (os.getenv('GRAFO_LOTES_DIR') or '').strip()
+
+def _enteros(serie: pd.Series, dtype: str, nulo: int) -> np.ndarray:
+    return pd.to_numeric(serie, errors='coerce').fillna(nulo).astype(dtype).to_numpy()
+
+def armar_grafo(df: pd.DataFrame) -> dict:
+    """Arrays CSR (hacia atrás y hacia adelante) a partir de las filas de APX_TRAZA_DETALLE (columnas en minúscula)."""
+    c_lote = pd.to_numeric(df['c_lote'], errors='coerce')
+    df = df[c_lote.notna()]
+    destino_lote = c_lote[c_lote.notna()].astype('int64').to_numpy()
+    origen_lote = _enteros(df['c_lote_origen'], 'int64', -1)
+    lotes = np.unique(np.concatenate([destino_lote, origen_lote[origen_lote >= 0]]))
+    n = len(lotes)
+
+    destino = np.searchsorted(lotes, destino_lote).astype('int32')
+    origen = np.where(origen_lote >= 0, np.searchsorted(lotes, origen_lote), -1).astype('int32')
+    fecha = pd.to_datetime(df['f_movimiento'], errors='coerce').to_numpy().astype('datetime64[s]')
+    mos_id = _enteros(df['mos_id'], 'int64', -1)
+
+    orden = np.lexsort((mos_id, fecha.astype('int64'), destino))
+    g = {
+        'lotes': lotes,
+        'destino': destino[orden],
+        'origen': origen[orden],
+        'cantidad': pd.to_numeric(df['cantidad'], errors='coerce').fillna(0.0).to_numpy(dtype='float64')[orden],
+        'mos_id': mos_id[orden],
+        'fecha': fecha[orden],
+        'tipo': _enteros(df['c_tipo_compro'], 'int16', -1)[orden],
+        'c_dorigen': _enteros(df['c_dorigen'], 'int32', -1)[orden],
+        'c_ddestino': _enteros(df['c_ddestino'], 'int32', -1)[orden],
+    }
+    g['atras_ptr'] = np.concatenate([[0], np.cumsum(np.bincount(g['destino'], minlength=n))]).astype('int64')
+    con_origen = np.flatnonzero(g['origen'] >= 0)
+    g['adelante_arista'] = con_origen[np.argsort(g['origen'][con_origen], kind='stable')].astype('int32')
+    g['adelante_ptr'] = np.concatenate([[0], np.cumsum(np.bincount(g['origen'][con_origen], minlength=n))]).astype('int64')
+    return g
+
+def escribir_grafo(directorio: str, grafo: dict, meta: dict) -> Path:
+    """Escribe la versión en una carpeta temporal, la renombra y recién entonces cambia CURRENT."""
+    base = Path(directorio)
+    base.mkdir(parents=True, exist_ok=True)
+    nombre = f"grafo_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
+    tmp = base / f".{nombre}.tmp"
+    tmp.mkdir()
+    for clave, arr in grafo.items():
+        np.save(tmp / f"{clave}.npy", np.ascontiguousarray(arr))
+    (tmp / 'meta.json').write_text(json.dumps({**meta, 'version': GRAFO_VERSION}, ensure_ascii=False), encoding='utf-8')
+    final = base / nombre
+    os.replace(tmp, final)
+    puntero = base / 'CURRENT.tmp'
+    puntero.write_text(nombre, encoding='utf-8')
+    os.replace(puntero, base / 'CURRENT')
+    # Versiones viejas: se conservan algunas (un proceso del API puede seguir leyendo la anterior)
+    for viejo in sorted(base.glob('grafo_*'))[:-GRAFO_CONSERVAR]:
+        shutil.rmtree(viejo, ignore_errors=True)
+    return final
+
+def exportar_grafo(engine: sqlalchemy.engine.Engine, db_user: str, tablas: dict = None):
+    directorio = _dir_grafo()
+    if not directorio:
+        return
+    yield "\n--- Exportando grafo de lotes para el API ---"
+    detalle_table = f"{db_user}.{_fisica(tablas, 'APX_TRAZA_DETALLE')}"
+    try:
+        t0 = datetime.now()
+        with engine.connect() as connection:
+            df = pd.read_sql(text(f"SELECT C_LOTE, C_LOTE_ORIGEN, CANTIDAD, MOS_ID, F_MOVIMIENTO, C_TIPO_COMPRO, C_DORIGEN, C_DDESTINO FROM {detalle_table}"), connection)
+        df.columns = df.columns.str.lower()
+        grafo = armar_grafo(df)
+        ruta = escribir_grafo(directorio, grafo, {'filas': int(len(grafo['destino'])), 'lotes': int(len(grafo['lotes'])), 'creado': datetime.now().isoformat(timespec='seconds')})
+        yield f"Grafo de lotes: {len(grafo['lotes'])} lotes, {len(grafo['destino'])} aristas en {(datetime.now() - t0).total_seconds():.1f}s -> {ruta}"
+    except Exception as e_grafo:
+        yield f"Advertencia: no se pudo exportar el grafo de lotes: {e_grafo}"
+
+# --- Generación de la composición ---
+# Contador de una fila que cada corrida (y cada reproceso que cambió algo) incrementa al publicar.
+# El API lo lee junto con los datos de referencia y lo usa en el ETag de las trazas: mientras no
+# cambie, las respuestas de /api/trazabilidad siguen vigentes.
+GENERACION_TABLE = 'APX_TRAZA_GENERACION'
+
+def marcar_generacion(engine: sqlalchemy.engine.Engine, db_user: str):
+    tabla = f"{db_user}.{GENERACION_TABLE}"
+    try:
+        with engine.connect() as connection:
+            try:
+                filas = connection.execute(text(f"UPDATE {tabla} SET GENERACION = GENERACION + 1, F_CORRIDA = SYSDATE")).rowcount
+            except Exception as e:
+                if "ORA-00942" not in str(e) and "table or view does not exist" not in str(e).lower():
+                    raise
+                connection.rollback()
+                connection.execute(text(f"CREATE TABLE {tabla} (GENERACION NUMBER(12) NOT NULL, F_CORRIDA DATE)"))
+                filas = 0
+            if not filas:
+                connection.execute(text(f"INSERT INTO {tabla} (GENERACION, F_CORRIDA) VALUES (1, SYSDATE)"))
+            generacion = connection.execute(text(f"SELECT MAX(GENERACION) FROM {tabla}")).scalar()
+            connection.commit()
+        yield f"Generación de la composición: {generacion}."
+    except Exception as e_gen:
+        yield f"Advertencia: no se pudo registrar la generación en {tabla}: {e_gen}"
+
+# --- Entradas declaradas por etapa ---
+# Cada etapa declara los datasets que consume. Se extraen a demanda (cuando una etapa los
+# lee por primera vez) y se reutilizan en las siguientes; lo que ninguna etapa lee no se consulta.
+def _extraer_lotes(datos: "DatosCorrida") -> Maestro:
+    with datos.engine.connect() as connection:
+        df = pd.read_sql(text("SELECT C_LOTE, CLAVE_EXTERNA, ID_SUBVALLE, D_LOTE FROM LOTES_STOCK"), connection)
+    df.columns = df.columns.str.lower()
+    return Maestro(df, 'c_lote', ['clave_externa', 'id_subvalle', 'd_lote'])
+
+def _extraer_depositos(datos: "DatosCorrida") -> Maestro:
+    with datos.engine.connect() as connection:
+        df = pd.read_sql(text("SELECT C_DEPOSITO, D_DEPOSITO FROM DEPOSITOS"), connection)
+    df.columns = df.columns.str.lower()
+    return Maestro(df, 'c_deposito', ['d_deposito'])
+
+def _extraer_movim_descubes(datos: "DatosCorrida") -> pd.DataFrame:
+    sql_movim_stock_desc = f"""SELECT ID, F_MOVIMIENTO, C_TIPO_COMPRO FROM MOVIM_STOCK WHERE C_TIPO_COMPRO = 28 AND F_MOVIMIENTO >= TO_DATE(:f_ini, 'YYYY-MM-DD') AND F_MOVIMIENTO < TO_DATE(:f_fin, 'YYYY-MM-DD') + 1"""
+    with datos.engine.connect() as connection:
+        return pd.read_sql(text(sql_movim_stock_desc), connection, params={'f_ini': datos.fecha_desde, 'f_fin': datos.fecha_fin})
+
+def _extraer_det_mov_descubes(datos: "DatosCorrida") -> pd.DataFrame:
+    df_ms = datos.get('movim_descubes', 'det_mov_descubes')
+    id_col_name_ms = 'id' if 'id' in df_ms.columns else 'ID'
+    lista_mos_id_desc = df_ms[id_col_name_ms].dropna().unique().tolist() if id_col_name_ms in df_ms.columns else []
+    with datos.engine.connect() as connection:
+        return ejecutar_consulta_con_chunks("SELECT ID, MOS_ID, C_LOTE, Q_ARTICULO FROM DET_MOV_STOCK", "MOS_ID", lista_mos_id_desc, 999, connection)
+
+DATASETS = {
+    'lotes': ("LOTES_STOCK completo (maestro compartido, sólo lectura)", _extraer_lotes),
+    'depositos': ("DEPOSITOS completo (maestro compartido, sólo lectura)", _extraer_depositos),
+    'movim_descubes': ("MOVIM_STOCK tipo 28 del período", _extraer_movim_descubes),
+    'det_mov_descubes': ("DET_MOV_STOCK de los descubes del período", _extraer_det_mov_descubes),
+}
+
+ENTRADAS_ETAPA = {
+    'compras': ['lotes', 'depositos'],
+    'descubes': ['movim_descubes', 'det_mov_descubes'],
+    'ajustes': ['lotes', 'depositos'],
+    'transformaciones': ['lotes', 'depositos'],
+}
+# En COMPOSICION_MODO_SQL=pushdown compras y ajustes cruzan LOTES_STOCK / DEPOSITOS en Oracle
+ENTRADAS_ETAPA_PUSHDOWN = {
+    'compras': [],
+    'ajustes': [],
+}
+
+def entradas_etapa(etapa: str) -> list:
+    if _modo_sql() == 'pushdown' and etapa in ENTRADAS_ETAPA_PUSHDOWN:
+        return ENTRADAS_ETAPA_PUSHDOWN[etapa]
+    return ENTRADAS_ETAPA[etapa]
+
+class DatosCorrida:
+    """Datasets de una corrida: se extraen la primera vez que se piden y se registra quién los pidió."""
+
+    def __init__(self, engine: sqlalchemy.engine.Engine, fecha_desde: str, fecha_fin: str):
+        self.engine = engine
+        self.fecha_desde = fecha_desde
+        self.fecha_fin = fecha_fin
+        self._cache = {}
+        self._pedidos = {}
+        self._stats = {}
+
+    def get(self, nombre: str, etapa: str):
+        self._pedidos.setdefault(nombre, [])
+        if etapa not in self._pedidos[nombre]:
+            self._pedidos[nombre].append(etapa)
+        if nombre not in self._cache:
+            t0 = datetime.now()
+            self._cache[nombre] = DATASETS[nombre][1](self)
+            self._stats[nombre] = (len(self._cache[nombre]), (datetime.now() - t0).total_seconds())
+        return self._cache[nombre]
+
+    def entradas(self, etapa: str) -> "_Entradas":
+        return _Entradas(self, etapa)
+
+    def reporte(self) -> list:
+        lineas = ["\n--- Datasets extraídos en la corrida ---"]
+        for nombre, (filas, segundos) in self._stats.items():
+            lineas.append(f"{nombre}: {DATASETS[nombre][0]}; {filas} filas en {segundos:.1f}s; pedido por: {', '.join(self._pedidos[nombre])}")
+        no_usados = [n for n in DATASETS if n not in self._stats]
+        if no_usados:
+            lineas.append(f"No extraídos (ninguna etapa los leyó): {', '.join(no_usados)}")
+        return lineas
+
+class _Entradas:
+    """Vista de una etapa sobre DatosCorrida: sólo deja leer lo que la etapa declaró en ENTRADAS_ETAPA."""
+
+    def __init__(self, datos: DatosCorrida, etapa: str):
+        self._datos = datos
+        self._etapa = etapa
+
+    def __getitem__(self, nombre: str):
+        if nombre not in entradas_etapa(self._etapa):
+            raise KeyError(f"La etapa '{self._etapa}' no declara la entrada '{nombre}' en ENTRADAS_ETAPA.")
+        return self._datos.get(nombre, self._etapa)
+
+    def opcional(self, nombre: str):
+        """El dataset si la etapa lo declara; None si no (p.ej. modo pushdown)."""
+        if nombre not in entradas_etapa(self._etapa):
+            return None
+        return self[nombre]
+
+
+CRED_FILE_PATH = Path(r"C:\projectdj\acceso.pwd")
+TNS_ALIAS = "CGGBD1"
+TNS_ADMIN_DIR = r"C:\oracle\instantclient_21_8\network\admin"
+
+def _conectar():
+    """Lee las credenciales y abre el engine. Devuelve (engine, db_user) o (None, None) si falla."""
+    cred_file_path = CRED_FILE_PATH
     db_user = None
     db_pass = None
-    ORACLE_IN_CLAUSE_LIMIT = 999
 
     yield f"Intentando leer credenciales desde: {cred_file_path}"
     try:
@@ -638,96 +1495,91 @@ def ejecutar_proceso_completo(fecha_inicio_str: str, fecha_fin_str: str):
         yield "Credenciales leídas desde el archivo."
     except Exception as file_err: 
         yield f"Error crítico al leer credenciales: {file_err}"
-        return
+        return None, None
 
     if not db_user or not db_pass:
         yield "Usuario o contraseña no encontrados en el archivo de credenciales."
-        return
+        return None, None
 
-    dsn = f"oracle+oracledb://{db_user}:{db_pass}@{tns_alias}"
+    dsn = f"oracle+oracledb://{db_user}:{db_pass}@{TNS_ALIAS}"
+    yield f"Intentando conectar a Oracle usando TNS Alias '{TNS_ALIAS}'..."
+    try:
+        engine = create_engine(dsn, connect_args={'config_dir': TNS_ADMIN_DIR})
+        with engine.connect() as connection_test:
+            yield "¡Conexión a la base de datos exitosa!"
+    except Exception as conn_err: 
+        yield f"Error de conexión: {conn_err}"
+        return None, None
+    return engine, db_user
+
+def ejecutar_proceso_completo(fecha_inicio_str: str, fecha_fin_str: str):
     engine = None
+    datos = None
     yield "\nIniciando proceso de trazabilidad..."
     try:
-        yield f"Intentando conectar a Oracle usando TNS Alias '{tns_alias}'..."
-        try:
-             engine = create_engine(dsn, connect_args={'config_dir': tns_admin_dir})
-             with engine.connect() as connection_test:
-                 yield "¡Conexión a la base de datos exitosa!"
-        except Exception as conn_err: 
-            yield f"Error de conexión: {conn_err}"
+        engine, db_user = yield from _conectar()
+        if engine is None:
             return
 
-        target_table_name_base = "APX_TRAZA_DETALLE"
-        full_target_table_name = f"{db_user}.{target_table_name_base.upper()}"
-
-        with engine.connect() as connection:
+        tablas = {}
+        if _modo_publicacion() == 'swap':
             try:
-                yield f"\nIntentando borrar todos los registros de la tabla {full_target_table_name}..."
-                delete_stmt = text(f"DELETE FROM {full_target_table_name}")
-                result = connection.execute(delete_stmt)
-                connection.commit()
-                yield f"¡Éxito! {result.rowcount} registros borrados de {full_target_table_name}."
-            except Exception as e_delete:
-                yield f"--- ERROR AL BORRAR DATOS DE {full_target_table_name} ---"
-                yield f"Error detallado: {e_delete}"
-                yield "Por favor, verifique los permisos del usuario o la existencia de la tabla."
-                yield "El script continuará, pero los resultados pueden ser acumulativos si el borrado falló."
-                try: connection.rollback()
-                except: pass
+                tablas = yield from preparar_staging(engine, db_user)
+            except Exception as e_stg:
+                yield f"Advertencia: no se pudo preparar el staging ({e_stg}). Se escribe directo sobre las tablas publicadas."
+                tablas = {}
 
-        yield f"\nProcesando datos entre {fecha_inicio_str} y {fecha_fin_str}"
+        target_table_name_base = _fisica(tablas, "APX_TRAZA_DETALLE")
+        full_target_table_name = f"{db_user}.{target_table_name_base.upper()}"
 
-        yield "\nExtrayendo datos maestros comunes..."
-        with engine.connect() as connection:
-            sql_lotes_stock_all = "SELECT C_LOTE, CLAVE_EXTERNA, ID_SUBVALLE, D_LOTE FROM LOTES_STOCK"
-            df_lotes_maestro = pd.read_sql(text(sql_lotes_stock_all), connection)
-            df_lotes_maestro.columns = df_lotes_maestro.columns.str.lower()
-            sql_cuartel_logico_all = "SELECT CUART_COD, CODIGO, ID_SUBVALLE FROM CUARTEL_LOGICO"
-            df_cl_maestro = pd.read_sql(text(sql_cuartel_logico_all), connection)
-            df_cl_maestro.columns = df_cl_maestro.columns.str.lower()
-            sql_depositos_all = "SELECT C_DEPOSITO, D_DEPOSITO FROM DEPOSITOS"
-            df_depositos_maestro = pd.read_sql(text(sql_depositos_all), connection)
-            df_depositos_maestro.columns = df_depositos_maestro.columns.str.lower()
-        yield "Datos maestros extraídos."
-        
-        df_compras = yield from procesar_compras(engine, fecha_inicio_str, fecha_fin_str, db_user, df_lotes_maestro.copy(), df_depositos_maestro.copy())
+        if not tablas:
+            with engine.connect() as connection:
+                try:
+                    yield f"\nIntentando borrar todos los registros de la tabla {full_target_table_name}..."
+                    delete_stmt = text(f"DELETE FROM {full_target_table_name}")
+                    result = connection.execute(delete_stmt)
+                    connection.commit()
+                    yield f"¡Éxito! {result.rowcount} registros borrados de {full_target_table_name}."
+                except Exception as e_delete:
+                    yield f"--- ERROR AL BORRAR DATOS DE {full_target_table_name} ---"
+                    yield f"Error detallado: {e_delete}"
+                    yield "Por favor, verifique los permisos del usuario o la existencia de la tabla."
+                    yield "El script continuará, pero los resultados pueden ser acumulativos si el borrado falló."
+                    try: connection.rollback()
+                    except: pass
+
+        yield f"\nProcesando datos entre {fecha_inicio_str} y {fecha_fin_str} (modo SQL de compras/ajustes: {_modo_sql()})"
+
+        datos = DatosCorrida(engine, fecha_inicio_str, fecha_fin_str)
+
+        entradas = datos.entradas('compras')
+        df_compras = yield from procesar_compras(engine, fecha_inicio_str, fecha_fin_str, db_user, entradas.opcional('lotes'), entradas.opcional('depositos'))
         if not df_compras.empty:
-            df_compras.to_sql(name=target_table_name_base, con=engine, if_exists='append', index=False, chunksize=1000)
+            df_compras.to_sql(name=target_table_name_base, con=engine, if_exists='append', index=False, dtype=DTYPE_SQL_DETALLE, chunksize=1000)
             yield f"¡Éxito! {len(df_compras)} registros de compras guardados."
         
         yield "\n--- Iniciando Procesamiento de Descubes (Tipo 28) ---"
-        with engine.connect() as connection:
-            sql_movim_stock_desc = f"""SELECT ID, F_MOVIMIENTO, C_TIPO_COMPRO FROM MOVIM_STOCK WHERE C_TIPO_COMPRO = 28 AND F_MOVIMIENTO >= TO_DATE(:f_ini, 'YYYY-MM-DD') AND F_MOVIMIENTO < TO_DATE(:f_fin, 'YYYY-MM-DD') + 1"""
-            df_movim_stock_desc = pd.read_sql(text(sql_movim_stock_desc), connection, params={'f_ini': fecha_inicio_str, 'f_fin': fecha_fin_str})
-            if not df_movim_stock_desc.empty:
-                id_col_name_ms = 'id' if 'id' in df_movim_stock_desc.columns else 'ID'
-                lista_mos_id_desc = df_movim_stock_desc[id_col_name_ms].dropna().unique().tolist()
-                sql_dms_base = "SELECT ID, MOS_ID, C_LOTE, Q_ARTICULO FROM DET_MOV_STOCK"
-                df_dms_desc = ejecutar_consulta_con_chunks(sql_dms_base, "MOS_ID", lista_mos_id_desc, ORACLE_IN_CLAUSE_LIMIT, connection)
-                sql_cd_base = "SELECT MOS_ID, COS_NUMERO, Q_KILOS, DEP_C_DEPOSITO FROM COSECHA_DEPOSITO"
-                df_cd_desc = ejecutar_consulta_con_chunks(sql_cd_base, "MOS_ID", lista_mos_id_desc, ORACLE_IN_CLAUSE_LIMIT, connection)
-                id_col_name_cd_cos = 'cos_numero' if 'cos_numero' in df_cd_desc.columns else 'COS_NUMERO'
-                lista_cos_numero_desc = df_cd_desc[id_col_name_cd_cos].dropna().unique().tolist() if not df_cd_desc.empty and id_col_name_cd_cos in df_cd_desc.columns else []
-                sql_cosecha_base = "SELECT NUMERO, C_VARIEDAD_INV, C_PERIODO, ID_SUBVALLE, VIÑ_NRO_INSCRIPCION FROM COSECHA"
-                df_cosecha_desc = ejecutar_consulta_con_chunks(sql_cosecha_base, "NUMERO", lista_cos_numero_desc, ORACLE_IN_CLAUSE_LIMIT, connection)
-                sql_cc_base = "SELECT CSC_NUMERO, CCU_COD_CUARTEL, CCU_CUART_LOG, ID_SUBVALLE FROM COSECHA_CUARTELES"
-                df_cc_desc = ejecutar_consulta_con_chunks(sql_cc_base, "CSC_NUMERO", lista_cos_numero_desc, ORACLE_IN_CLAUSE_LIMIT, connection)
-                datos_descubes_dict = {"movim_stock": df_movim_stock_desc, "det_mov_stock": df_dms_desc, "cosecha_deposito": df_cd_desc, "cosecha": df_cosecha_desc, "cosecha_cuarteles": df_cc_desc}
-                df_composicion_descubes_real = procesar_descubes(datos_descubes_dict, df_lotes_maestro.copy(), df_cl_maestro.copy(), df_depositos_maestro.copy())
-                if not df_composicion_descubes_real.empty:
-                    yield "Enriqueciendo descubes con datos de órdenes de trabajo..."
-                    df_composicion_descubes_real = _enriquecer_con_ordenes_trabajo(df_composicion_descubes_real, engine)
-                    df_composicion_descubes_real.to_sql(name=target_table_name_base, con=engine, if_exists='append', index=False, chunksize=1000)
-                    yield f"¡Éxito! {len(df_composicion_descubes_real)} registros de descubes guardados."
-            else: yield "No hay movimientos de descube en el período para procesar."
-            yield "--- Fin Procesamiento de Descubes ---"
-
-        df_ajustes_result = yield from procesar_ajustes_inventario(engine, fecha_inicio_str, fecha_fin_str, db_user, df_lotes_maestro.copy(), df_depositos_maestro.copy())
+        df_composicion_descubes_real = pd.DataFrame()
+        entradas = datos.entradas('descubes')
+        if not entradas['movim_descubes'].empty:
+            datos_descubes_dict = {"movim_stock": entradas['movim_descubes'], "det_mov_stock": entradas['det_mov_descubes']}
+            df_composicion_descubes_real = procesar_descubes(datos_descubes_dict)
+            if not df_composicion_descubes_real.empty:
+                yield "Enriqueciendo descubes con datos de órdenes de trabajo..."
+                df_composicion_descubes_real = normalizar_detalle(_enriquecer_con_ordenes_trabajo(df_composicion_descubes_real, engine))
+                df_composicion_descubes_real.to_sql(name=target_table_name_base, con=engine, if_exists='append', index=False, dtype=DTYPE_SQL_DETALLE, chunksize=1000)
+                yield f"¡Éxito! {len(df_composicion_descubes_real)} registros de descubes guardados."
+        else: yield "No hay movimientos de descube en el período para procesar."
+        yield "--- Fin Procesamiento de Descubes ---"
+
+        entradas = datos.entradas('ajustes')
+        df_ajustes_result = yield from procesar_ajustes_inventario(engine, fecha_inicio_str, fecha_fin_str, db_user, entradas.opcional('lotes'), entradas.opcional('depositos'))
         if not df_ajustes_result.empty:
-            df_ajustes_result.to_sql(name=target_table_name_base, con=engine, if_exists='append', index=False, chunksize=1000)
+            df_ajustes_result.to_sql(name=target_table_name_base, con=engine, if_exists='append', index=False, dtype=DTYPE_SQL_DETALLE, chunksize=1000)
             yield f"¡Éxito! {len(df_ajustes_result)} registros de ajustes guardados."
 
-        df_transform_result, df_reporte_faltantes_transformaciones = yield from procesar_transformaciones(engine, fecha_inicio_str, fecha_fin_str, db_user, df_lotes_maestro.copy(), df_depositos_maestro.copy())
+        entradas = datos.entradas('transformaciones')
+        df_transform_result, df_reporte_faltantes_transformaciones, backlog = yield from procesar_transformaciones(engine, fecha_inicio_str, fecha_fin_str, db_user, entradas['lotes'], entradas['depositos'], tablas)
 
         if df_reporte_faltantes_transformaciones is not None and not df_reporte_faltantes_transformaciones.empty:
             nombre_reporte_faltantes = "reporte_lotes_origen_sin_composicion.csv"
@@ -739,14 +1591,39 @@ def ejecutar_proceso_completo(fecha_inicio_str: str, fecha_fin_str: str):
         else:
             yield "\nNo se encontraron lotes origen sin composición durante las transformaciones."
             
+        # Índices para el API: trazas y composiciones a fecha (as_of) por lote y F_MOVIMIENTO, y
+        # descendientes por C_LOTE_ORIGEN cuando no hay grafo exportado.
+        # Se crean después de la carga; en staging, TRUNCATE los conserva para las corridas siguientes.
         with engine.connect() as connection:
-            lotes_con_composicion = pd.read_sql(text(f"SELECT DISTINCT C_LOTE FROM {full_target_table_name}"), connection)['c_lote'].tolist()
-        yield from procesar_destinos_finales(engine, db_user, lotes_con_composicion)
+            yield _asegurar_indice(connection, full_target_table_name, _nombre_indice("IX_APX_TRAZA_DET_LOTE_FEC", target_table_name_base), ['C_LOTE', 'F_MOVIMIENTO'])
+            yield _asegurar_indice(connection, full_target_table_name, _nombre_indice("IX_APX_TRAZA_DET_ORIGEN", target_table_name_base), ['C_LOTE_ORIGEN'])
+
+        lotes_con_composicion = None
+        if _modo_sql() != 'pushdown':
+            with engine.connect() as connection:
+                lotes_con_composicion = pd.read_sql(text(f"SELECT DISTINCT C_LOTE FROM {full_target_table_name}"), connection)['c_lote'].tolist()
+        yield from procesar_destinos_finales(engine, db_user, lotes_con_composicion, tablas)
+
+        yield from procesar_composicion_resumen(engine, db_user, [df_compras, df_composicion_descubes_real, df_ajustes_result, df_transform_result], tablas)
+
+        if tablas:
+            yield "\n--- Publicando tablas de la corrida ---"
+            yield from publicar_staging(engine, db_user, tablas)
+
+        # El backlog vive fuera del staging: se reemplaza recién con la corrida publicada
+        if backlog is not None:
+            yield from guardar_pendientes(engine, db_user, **backlog)
+
+        yield from exportar_grafo(engine, db_user, tablas)
+        yield from marcar_generacion(engine, db_user)
         
+    except EtapaFallida as e_etapa: yield f"\n--- CORRIDA INCOMPLETA ---: falló la etapa de {e_etapa}. No se publican las tablas de la corrida, no se actualiza el backlog ni se exporta el grafo."
     except sqlalchemy.exc.DatabaseError as db_err: yield f"\n--- ERROR DE BASE DE DATOS ---: {db_err}"
     except KeyError as key_err: yield f"\n--- ERROR DE CLAVE (KeyError) ---: {key_err}\n{traceback.format_exc()}"
     except Exception as e: yield f"\n--- ERROR INESPERADO ---: {e}\n{traceback.format_exc()}"
     finally:
+        if datos is not None:
+            for linea in datos.reporte(): yield linea
         if engine: engine.dispose(); yield "\nConexión a base de datos cerrada."
         yield "Proceso finalizado."
 
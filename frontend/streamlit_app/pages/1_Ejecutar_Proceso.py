@@ -1,5 +1,6 @@
 import os
 import json
+import time
 import httpx
 import streamlit as st
 from datetime import date, timedelta
@@ -9,14 +10,19 @@ st.set_page_config(page_title="Ejecutar Proceso", page_icon="🛠️", layout="w
 # Config: URL base del backend
 BACKEND_BASE_URL = os.getenv("BACKEND_BASE_URL", "http://localhost:8000")
 RUN_URL = f"{BACKEND_BASE_URL}/api/composicion/run"
+LOGS_URL = f"{BACKEND_BASE_URL}/api/composicion/logs"
+# El visor junta las líneas que llegan y dibuja sólo las nuevas cada LOG_RENDER_SECONDS
+LOG_RENDER_SECONDS = float(os.getenv("LOG_RENDER_SECONDS", "0.5"))
+LOG_TAIL_BYTES = int(os.getenv("LOG_TAIL_BYTES", "262144"))
 
 st.title("🛠️ Ejecutar Proceso de Composición Enológica")
 
 # Estado de la vista
 if "running" not in st.session_state:
     st.session_state.running = False
-if "logs" not in st.session_state:
-    st.session_state.logs = []
+if "run" not in st.session_state:
+    # La corrida sobrevive a un refresh de la página a través de la URL (?run=...)
+    st.session_state.run = st.query_params.get("run")
 
 col1, col2 = st.columns([1, 1])
 with col1:
@@ -27,12 +33,68 @@ with col2:
 run_btn = st.button("▶️ Ejecutar", type="primary", disabled=st.session_state.running)
 
 status_placeholder = st.empty()
-logs_placeholder = st.empty()
+metric_placeholder = st.empty()
+logs_box = st.container(height=520)
 
 
-def append_log(line: str):
-    st.session_state.logs.append(line)
-    logs_placeholder.code("\n".join(st.session_state.logs[-2000:]), language="text", wrap_lines=True)
+class LogView:
+    """
+    Visor incremental: las líneas se acumulan y cada LOG_RENDER_SECONDS se agrega un bloque
+    sólo con las nuevas (no se vuelve a dibujar lo que ya está en pantalla).
+    """
+    def __init__(self, box):
+        self.box = box
+        self.pendientes = []
+        self.ultimo = 0.0
+
+    def add(self, lines, force: bool = False):
+        self.pendientes.extend(lines)
+        if force or time.monotonic() - self.ultimo >= LOG_RENDER_SECONDS:
+            self.flush()
+
+    def flush(self):
+        if self.pendientes:
+            self.box.code("\n".join(self.pendientes), language="text", wrap_lines=True)
+            self.pendientes = []
+        self.ultimo = time.monotonic()
+
+
+def set_run(run):
+    st.session_state.run = run
+    if run:
+        st.query_params["run"] = run
+
+
+def fetch_log(client: httpx.Client, run: str, offset: int) -> dict:
+    r = client.get(f"{LOGS_URL}/{run}", params={"offset": offset, "limit": 1024 * 1024})
+    r.raise_for_status()
+    return r.json()
+
+
+def follow_log(run: str):
+    """Log guardado de una corrida (las últimas LOG_TAIL_BYTES); si sigue en curso, lo sigue por offset."""
+    view = LogView(logs_box)
+    offset = -LOG_TAIL_BYTES
+    try:
+        with httpx.Client(timeout=30.0) as client:
+            while True:
+                data = fetch_log(client, run, offset)
+                if data["offset"] > 0 and offset < 0:
+                    view.add([f"... (se muestran los últimos {LOG_TAIL_BYTES // 1024} KB del log)"])
+                if data["text"]:
+                    view.add(data["text"].splitlines(), force=True)
+                offset = data["next_offset"]
+                if data["eof"] and not data["activo"]:
+                    break
+                if data["eof"]:
+                    status_placeholder.info(f"⏳ Corrida {run} en curso (siguiendo el log)...")
+                    time.sleep(1.0)
+        status_placeholder.caption(f"Log de la corrida {run}")
+    except httpx.HTTPStatusError as he:
+        status_placeholder.warning(f"No se pudo leer el log de {run}: HTTP {he.response.status_code}")
+    except Exception as e:
+        status_placeholder.warning(f"No se pudo leer el log de {run}: {e}")
+    view.flush()
 
 
 def parse_sse_stream_line_mode(lines_iter):
@@ -70,7 +132,8 @@ if run_btn:
         st.error("⚠️ La fecha *hasta* no puede ser anterior a la fecha *desde*.")
     else:
         st.session_state.running = True
-        st.session_state.logs = []
+        set_run(None)
+        view = LogView(logs_box)
         status_placeholder.info("⏳ Ejecutando proceso... (logs en vivo)")
 
         payload = {"fecha_desde": f_desde.strftime("%Y-%m-%d"),
@@ -91,17 +154,26 @@ if run_btn:
                     for evt in parse_sse_stream_line_mode(r.iter_lines()):
                         ev = evt.get("event")
                         data = evt.get("data", {})
-                        if ev == "log":
+                        if ev == "run":
+                            set_run(data.get("run"))
+                        elif ev == "log":
                             msg = data.get("msg", "")
                             ts = data.get("ts", "")
-                            append_log(f"{ts} {msg}")
+                            view.add([f"{ts} {msg}"])
+                        elif ev == "logs":
+                            view.add([f"{it.get('ts', '')} {it.get('msg', '')}" for it in data.get("items", [])])
+                        elif ev == "metric":
+                            metric_placeholder.caption(
+                                f"⏱️ {data.get('elapsed_s', 0)} s · CPU {data.get('cpu_s', 0)} s · "
+                                f"memoria {data.get('rss_mb') or '-'} MB"
+                            )
                         elif ev == "error":
-                            append_log(f"[ERROR] {data}")
+                            view.add([f"[ERROR] {data}"], force=True)
                             status_placeholder.error(f"❌ Proceso con error: {data.get('message','')}")
                             break
                         elif ev == "done":
                             got_done = True
-                            append_log("[OK] Proceso finalizado.")
+                            view.add(["[OK] Proceso finalizado."], force=True)
                             status_placeholder.success("✅ Proceso finalizado.")
                             break
         except Exception as e:
@@ -111,7 +183,22 @@ if run_btn:
             else:
                 status_placeholder.error(f"❌ Error de conexión: {e}")
         finally:
+            view.flush()
             st.session_state.running = False
+elif st.session_state.run:
+    follow_log(st.session_state.run)
+
+with st.expander("Logs de corridas anteriores"):
+    try:
+        runs = httpx.get(LOGS_URL, params={"limit": 30}, timeout=10.0).json().get("items", [])
+    except Exception:
+        runs = []
+    opciones = [r["run"] for r in runs]
+    elegida = st.selectbox("Corrida", opciones, index=None, placeholder="Elegí una corrida",
+                           format_func=lambda r: r + (" (en curso)" if any(x["run"] == r and x["activo"] for x in runs) else ""))
+    if elegida and elegida != st.session_state.run:
+        set_run(elegida)
+        st.rerun()
 
 st.caption(f"Backend: {RUN_URL}")
 st.caption("Los logs completos se guardan en disco (config `LOGS_OUT_DIR`, por defecto ./outputs/logs).")
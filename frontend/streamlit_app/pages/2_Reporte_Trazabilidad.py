@@ -1,8 +1,10 @@
 # frontend/streamlit_app/pages/2_Reporte_Trazabilidad.py
 import os
 import json
-from typing import Dict, List, Optional, DefaultDict
-from collections import defaultdict
+import threading
+from typing import Callable, Dict, List, Optional, DefaultDict
+from collections import OrderedDict, defaultdict
+from urllib.parse import urlencode
 
 import httpx
 import streamlit as st
@@ -13,6 +15,9 @@ st.set_page_config(page_title="Reporte de Trazabilidad", page_icon="🧭", layou
 # Configuración: URL base del backend
 BACKEND_BASE_URL = os.getenv("BACKEND_BASE_URL", "http://localhost:8000")
 TRACE_URL_TMPL = f"{BACKEND_BASE_URL}/api/trazabilidad/lote/{{c_lote}}"
+CHILDREN_URL_TMPL = f"{BACKEND_BASE_URL}/api/trazabilidad/lote/{{c_lote}}/children"
+# Respuestas guardadas para revalidar con If-None-Match (las más recientes)
+HTTP_CACHE_MAX = int(os.getenv("TRACE_HTTP_CACHE_MAX", "256"))
 
 def _fmt_date_iso(iso_str: str | None) -> str:
     """Convierte 'YYYY-MM-DD' o 'YYYY-MM-DDTHH:MM:SS' a 'dd-mm-yyyy'."""
@@ -53,6 +58,30 @@ def safe_get(d: dict, path: List[str], default=None):
             return default
     return cur
 
+def decode_columnar(payload) -> List[dict]:
+    """
+    Decodifica origenes/timeline pedidos con format=columnar:
+    {"schema": [...], "dicts": {col: [...]}, "columns": {col: [...] | None}, "n": N}
+    Si ya viene como lista de dicts, se devuelve tal cual.
+    """
+    if not isinstance(payload, dict) or payload.get("formato") != "columnar":
+        return payload or []
+    n = int(payload.get("n") or 0)
+    schema = payload.get("schema") or []
+    dicts = payload.get("dicts") or {}
+    columns = payload.get("columns") or {}
+    cols = {}
+    for col in schema:
+        values = columns.get(col)
+        if values is None:
+            cols[col] = [None] * n
+        elif col in dicts:
+            d = dicts[col]
+            cols[col] = [None if c is None else d[c] for c in values]
+        else:
+            cols[col] = values
+    return [{col: cols[col][i] for col in schema} for i in range(n)]
+
 # ---------- UI: Encabezado ----------
 st.title("🧭 Reporte de Trazabilidad (por C_LOTE)")
 st.caption(f"Backend: {BACKEND_BASE_URL}")
@@ -62,34 +91,97 @@ with st.container():
     with col1:
         c_lote = st.text_input("C_LOTE a trazar", placeholder="Ej.: 28200001502002").strip()
     with col2:
-        max_depth = st.number_input("Profundidad (niveles)", min_value=1, max_value=50, value=10, step=1)
+        max_depth = st.number_input("Profundidad (niveles)", min_value=1, max_value=50, value=10, step=1,
+                                    help="Con «Árbol bajo demanda» no se usa: la traza trae sólo el primer nivel.")
     with col3:
         tolerance_pct = st.number_input("Tolerancia balance (%)", min_value=0.0, max_value=5.0, value=0.5, step=0.1)
     with col4:
         includes = st.multiselect("Incluir secciones", ["timeline", "destinos"], default=[])
 
-    c1, c2 = st.columns([1, 4])
+    c1, c2, c3, c4 = st.columns([1, 2, 2, 1.4])
     with c1:
         run_btn = st.button("🔎 Consultar", type="primary", use_container_width=True)
     with c2:
         show_raw = st.checkbox("Ver JSON bruto (debug)")
+        lazy_tree = st.checkbox("Árbol bajo demanda", value=False,
+                                help="Trae el primer nivel y cada subárbol recién al expandirlo (recomendado para árboles grandes). "
+                                     "Ignora la profundidad: el conteo de orígenes, la línea de tiempo y los destinos del árbol "
+                                     "cubren sólo el primer nivel.")
+    with c3:
+        destinos_arbol = st.checkbox("Destinos de todo el árbol", disabled=("destinos" not in includes))
+    with c4:
+        as_of = st.date_input("A la fecha (opcional)", value=None, format="DD/MM/YYYY")
 
 st.divider()
 
 # ---------- Llamada a la API ----------
-@st.cache_data(show_spinner=False, ttl=60)
-def fetch_trace(c_lote: str, max_depth: int, tolerance: float, includes: List[str]) -> dict:
+@st.cache_resource
+def _http() -> httpx.Client:
+    """Cliente compartido por todas las sesiones: conexiones keep-alive al backend."""
+    return httpx.Client(timeout=30.0)
+
+@st.cache_resource
+def _respuestas() -> dict:
+    return {"lock": threading.Lock(), "items": OrderedDict()}
+
+def get_json(url: str, params: dict, preparar: Optional[Callable[[dict], dict]] = None) -> dict:
+    """
+    GET con revalidación: si ya hay una respuesta con ETag se pide con If-None-Match y un 304
+    devuelve la guardada (el backend no recalcula nada hasta la próxima corrida de composición).
+    `preparar` se aplica una sola vez, al guardar la respuesta nueva.
+    """
+    clave = f"{url}?{urlencode(sorted(params.items()))}"
+    cache = _respuestas()
+    with cache["lock"]:
+        previo = cache["items"].get(clave)
+    r = _http().get(url, params=params, headers={"If-None-Match": previo[0]} if previo else {})
+    if r.status_code == 304 and previo:
+        with cache["lock"]:
+            if clave in cache["items"]:
+                cache["items"].move_to_end(clave)
+        return previo[1]
+    r.raise_for_status()
+    data = r.json()
+    if preparar is not None:
+        data = preparar(data)
+    etag = r.headers.get("etag")
+    if etag:
+        with cache["lock"]:
+            cache["items"][clave] = (etag, data)
+            cache["items"].move_to_end(clave)
+            while len(cache["items"]) > HTTP_CACHE_MAX:
+                cache["items"].popitem(last=False)
+    return data
+
+def _decode_trace(data: dict) -> dict:
+    if isinstance(data, dict):
+        data["origenes"] = decode_columnar(data.get("origenes"))
+        data["timeline"] = decode_columnar(data.get("timeline"))
+    return data
+
+def fetch_trace(c_lote: str, max_depth: int, tolerance: float, includes: List[str], destinos_alcance: str = "raiz",
+                as_of: Optional[str] = None) -> dict:
     params = {
         "max_depth": max_depth,
         "tolerance": tolerance,
+        "destinos_alcance": destinos_alcance,
+        "format": "columnar",
     }
     if includes:
         params["include"] = ",".join(includes)
-    url = TRACE_URL_TMPL.format(c_lote=c_lote)
-    with httpx.Client(timeout=30.0) as client:
-        r = client.get(url, params=params)
-        r.raise_for_status()
-        return r.json()
+    if as_of:
+        params["as_of"] = as_of
+    return get_json(TRACE_URL_TMPL.format(c_lote=c_lote), params, _decode_trace)
+
+def fetch_children(c_lote: str, node: Optional[str], nivel: int, as_of: Optional[str], hasta: Optional[str]) -> List[dict]:
+    params = {"nivel": nivel}
+    if node:
+        params["node"] = node
+    if as_of:
+        params["as_of"] = as_of
+    if hasta:
+        params["hasta"] = hasta
+    return get_json(CHILDREN_URL_TMPL.format(c_lote=c_lote), params).get("children") or []
 
 def badge_ok(ok: bool) -> str:
     return "🟢 OK" if ok else "🔴 Revisar"
@@ -166,18 +258,56 @@ def render_tree(nodes: List[dict]):
         with st.expander(exp_label, expanded=(r.get("nivel", 0) == 0)):
             walk(r, level=0)
 
+def render_lazy_tree(c_lote: str, as_of: Optional[str], node: Optional[str] = None, nivel: int = 0,
+                     hasta: Optional[str] = None, key: str = "arbol"):
+    """
+    Árbol bajo demanda: pide un nivel por vez a /children y sólo baja por los nodos que el
+    usuario abre (el estado de cada nodo queda en session_state y sobrevive a los reruns).
+    """
+    try:
+        hijos = fetch_children(c_lote, node, nivel, as_of, hasta)
+    except Exception as e:
+        st.error(f"❌ No se pudo expandir el nivel {nivel + 1}: {e}")
+        return
+    if not hijos and nivel == 0:
+        st.info("Sin nodos de trazabilidad para mostrar.")
+        return
+    for ch in hijos:
+        render_node_line(ch, indent=nivel)
+        n_hijos = ch.get("n_children") or 0
+        if n_hijos and ch.get("c_lote_origen"):
+            clave = f"{key}/{ch['node_id']}"
+            pad = "\u2003" * (nivel + 1)
+            if st.checkbox(f"{pad}▸ {n_hijos} orígenes del lote {ch['c_lote_origen']}", key=clave):
+                render_lazy_tree(c_lote, as_of, ch["c_lote_origen"], nivel + 1, ch.get("hasta"), clave)
+
 # ---------- Ejecución ----------
+# La consulta queda en session_state: expandir un nodo del árbol bajo demanda vuelve a ejecutar la página
 if run_btn:
     if not c_lote:
         st.warning("Ingresa un **C_LOTE** para consultar.")
         st.stop()
+    st.session_state["traza_consulta"] = {
+        "c_lote": c_lote,
+        "max_depth": int(max_depth),
+        "tolerance": float(tolerance_pct) / 100.0,
+        "includes": includes,
+        "destinos_alcance": "arbol" if destinos_arbol else "raiz",
+        "as_of": as_of.isoformat() if as_of else None,
+        "lazy": lazy_tree,
+    }
 
+consulta = st.session_state.get("traza_consulta")
+if consulta:
     try:
+        # Bajo demanda alcanza con el primer nivel para encabezado, KPIs y balance
         data = fetch_trace(
-            c_lote=c_lote,
-            max_depth=int(max_depth),
-            tolerance=float(tolerance_pct) / 100.0,
-            includes=includes,
+            c_lote=consulta["c_lote"],
+            max_depth=1 if consulta["lazy"] else consulta["max_depth"],
+            tolerance=consulta["tolerance"],
+            includes=consulta["includes"],
+            destinos_alcance=consulta["destinos_alcance"],
+            as_of=consulta["as_of"],
         )
     except httpx.HTTPStatusError as he:
         st.error(f"❌ Error HTTP {he.response.status_code}: {he.response.text[:300]}")
@@ -209,11 +339,13 @@ if run_btn:
     # Fechas en dd-mm-yyyy
     c4.metric("Fecha inicio", _fmt_date_iso(ident.get("fecha_inicio")))
     c5.metric("Fecha fin", _fmt_date_iso(ident.get("fecha_fin")))    
+    if ident.get("as_of"):
+        st.caption(f"Traza al {_fmt_date_iso(ident.get('as_of'))}: sólo movimientos hasta ese día.")
 
     st.subheader("📊 KPIs")
     k1, k2, k3, k4, k5, k6 = st.columns(6)
     k1.metric("Lts destino", fmt(kpis.get("lts_destino")))
-    k2.metric("# Orígenes (nodos)", f"{len(origenes):,}")
+    k2.metric("# Orígenes (nivel 1)" if consulta["lazy"] else "# Orígenes (nodos)", f"{len(origenes):,}")
     k3.metric("% Rdto. final", pct(kpis.get("rendimiento_final_pct")))
     k4.metric("Brix ini/fin", f'{fmt(kpis.get("brix_ini"),1)} / {fmt(kpis.get("brix_fin"),1)}')
     k5.metric("Densidad ini/fin", f'{fmt(kpis.get("densidad_ini"),3)} / {fmt(kpis.get("densidad_fin"),3)}')
@@ -247,11 +379,16 @@ if run_btn:
 
     # ---------- Sección: Orígenes (árbol) ----------
     st.subheader("🌳 Orígenes hacia atrás")
-    render_tree(origenes)
+    if consulta["lazy"]:
+        st.caption("Árbol bajo demanda: se ignora la profundidad pedida. El conteo de orígenes, la línea de tiempo "
+                   "y los destinos del árbol cubren sólo el primer nivel.")
+        render_lazy_tree(consulta["c_lote"], consulta["as_of"])
+    else:
+        render_tree(origenes)
 
     # ---------- Sección: Timeline ----------
-    if "timeline" in includes and data.get("timeline"):
-        st.subheader("🗓️ Línea de tiempo")
+    if "timeline" in consulta["includes"] and data.get("timeline"):
+        st.subheader("🗓️ Línea de tiempo" + (" (primer nivel)" if consulta["lazy"] else ""))
         try:
             tl = sorted(data["timeline"], key=lambda x: x.get("fecha") or "")
         except Exception:
@@ -268,14 +405,18 @@ if run_btn:
         ])
 
     # ---------- Sección: Destinos ----------
-    if "destinos" in includes and data.get("destinos"):
+    if "destinos" in consulta["includes"] and data.get("destinos"):
         st.subheader("📦 Destinos / Despachos")
+        if consulta["lazy"] and consulta["destinos_alcance"] == "arbol":
+            st.caption("Árbol bajo demanda: destinos del lote y de sus orígenes de primer nivel.")
         dst = data["destinos"]
         st.table([
             {
-                "Fecha": d.get("fecha", "—"),
+                "C_LOTE": d.get("c_lote", "—") or "—",
+                "Fecha": _fmt_date_iso(d.get("fecha")),
                 "Destino": d.get("destino", "—"),
                 "Volumen (Lts)": fmt(d.get("volumen_lts")),
+                "OT / Factura": d.get("mos_id_destino", "—") or "—",
                 "Guía": d.get("guia", "—") or "—",
                 "FEL": d.get("fel", "—") or "—",
             }